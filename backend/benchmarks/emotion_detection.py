@@ -0,0 +1,185 @@
+"""
+表情認識の速度・再現率のベンチマーク
+元の解像度で検出する従来の方法を基準に、縮小して検出した場合と、
+前回の顔の周辺を追跡した場合(--track。動画の連続したフレーム向け)の処理時間と、
+基準の顔をどれだけ検出できたか(再現率)・表情の一致率を比較する
+
+使い方 (backendディレクトリで実行):
+    uv run python -m benchmarks.emotion_detection 画像やディレクトリ、動画のパス ...
+    uv run python -m benchmarks.emotion_detection clip.mp4 --widths 320,480,640,960
+    uv run python -m benchmarks.emotion_detection clip.mp4 --frame-step 1 --track 10
+"""
+
+import argparse
+import glob
+import os
+import statistics
+import time
+
+import cv2
+
+from src.image_processor import emotion
+from src.image_processor.roi_tracker import RoiTracker
+
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png", ".bmp")
+
+
+def load_frames(paths, max_frames, frame_step):
+    """
+    画像・ディレクトリ内の画像・動画からフレームを読み込む
+    """
+    frames = []
+    for path in paths:
+        if os.path.isdir(path):
+            files = sorted(
+                f
+                for f in glob.glob(os.path.join(path, "*"))
+                if f.lower().endswith(IMAGE_EXTENSIONS)
+            )
+        else:
+            files = [path]
+
+        for file in files:
+            if file.lower().endswith(IMAGE_EXTENSIONS):
+                frame = cv2.imread(file)
+                if frame is not None:
+                    frames.append(frame)
+                continue
+
+            # 動画 (RTSPのURLも可) はframe_step毎に読み込む
+            cap = cv2.VideoCapture(file)
+            index = 0
+            while len(frames) < max_frames:
+                ret, frame = cap.read()
+                if not ret:
+                    break
+                if index % frame_step == 0:
+                    frames.append(frame)
+                index += 1
+            cap.release()
+
+        if len(frames) >= max_frames:
+            break
+    return frames[:max_frames]
+
+
+def iou(a, b):
+    ax, ay, aw, ah = a[:4]
+    bx, by, bw, bh = b[:4]
+    w = min(ax + aw, bx + bw) - max(ax, bx)
+    h = min(ay + ah, by + bh) - max(ay, by)
+    if w <= 0 or h <= 0:
+        return 0.0
+    inter = w * h
+    return inter / (aw * ah + bw * bh - inter)
+
+
+def match(baseline, results, threshold):
+    """
+    基準の顔と検出した顔をIoUで対応付け、(一致した顔の数, 表情も一致した数)を返す
+    """
+    matched = labels = 0
+    used = set()
+    for base in baseline:
+        best, best_iou = None, threshold
+        for i, result in enumerate(results):
+            overlap = iou(base, result)
+            if i not in used and overlap >= best_iou:
+                best, best_iou = i, overlap
+        if best is not None:
+            used.add(best)
+            matched += 1
+            labels += results[best][4] == base[4]
+    return matched, labels
+
+
+def run(grays, face_width, smile_width, repeat, roi_tracker=None):
+    """
+    全フレームを検出し、(フレーム毎の処理時間の中央値(ms), フレーム毎の結果)を返す
+    roi_trackerは状態を持つため、指定した場合は各フレーム1回だけ計測する
+    """
+    if roi_tracker is not None:
+        repeat = 1
+    times = []
+    results = []
+    for gray in grays:
+        best = None
+        for _ in range(repeat):
+            start = time.perf_counter()
+            result = emotion.detect_emotions(
+                None,
+                gray=gray,
+                face_width=face_width,
+                smile_width=smile_width,
+                roi_tracker=roi_tracker,
+            )
+            elapsed = time.perf_counter() - start
+            best = elapsed if best is None else min(best, elapsed)
+        times.append(best * 1000)
+        results.append(result)
+    return statistics.median(times), results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("inputs", nargs="+", help="画像・ディレクトリ・動画のパス")
+    parser.add_argument(
+        "--widths",
+        default="320,480,640,960",
+        help="顔検出を行う幅(px)のカンマ区切り (基準は元の解像度)",
+    )
+    parser.add_argument(
+        "--smile-width", type=int, default=160, help="笑顔判定に使う顔領域の最大幅(px)"
+    )
+    parser.add_argument("--max-frames", type=int, default=100)
+    parser.add_argument("--frame-step", type=int, default=10, help="動画を読む間隔")
+    parser.add_argument("--repeat", type=int, default=3, help="各フレームの計測回数")
+    parser.add_argument("--iou", type=float, default=0.5, help="同じ顔とみなすIoU")
+    parser.add_argument(
+        "--track",
+        type=int,
+        default=0,
+        help="顔の周辺を追跡し、このフレーム数毎に画像全体から検出し直す (0の場合は比較しない)",
+    )
+    args = parser.parse_args()
+
+    frames = load_frames(args.inputs, args.max_frames, args.frame_step)
+    if not frames:
+        parser.error("フレームを読み込めませんでした")
+    grays = [cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY) for frame in frames]
+    height, width = grays[0].shape
+    print(f"{len(grays)} frames ({width}x{height})")
+
+    # 基準: 元の解像度で顔検出し、顔領域もそのままの大きさで笑顔判定する (従来の方法)
+    base_ms, baseline = run(grays, 0, 0, args.repeat)
+    total = sum(len(faces) for faces in baseline)
+    print(f"{'mode':>16} {'ms/frame':>9} {'speedup':>8} {'recall':>7} {'label':>6} {'faces':>6}")
+    print(f"{'full':>16} {base_ms:9.1f} {1.0:8.2f} {1.0:7.3f} {1.0:6.3f} {total:6d}")
+
+    modes = [
+        (f"w={face_width}/s={args.smile_width}", face_width, None)
+        for face_width in (int(w) for w in args.widths.split(",") if w.strip())
+    ]
+    if args.track > 0:
+        modes.append((f"track={args.track}", None, RoiTracker(args.track)))
+
+    for name, face_width, roi_tracker in modes:
+        ms, results = run(
+            grays, face_width, args.smile_width, args.repeat, roi_tracker
+        )
+        matched = labels = found = 0
+        for base, result in zip(baseline, results):
+            m, lab = match(base, result, args.iou)
+            matched += m
+            labels += lab
+            found += len(result)
+        recall = matched / total if total else float("nan")
+        agreement = labels / matched if matched else float("nan")
+        print(
+            f"{name:>16} {ms:9.1f} {base_ms / ms if ms else 0:8.2f} "
+            f"{recall:7.3f} {agreement:6.3f} {found:6d}"
+        )
+
+
+if __name__ == "__main__":
+    main()
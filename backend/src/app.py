@@ -1,16 +1,37 @@
 from fastapi import FastAPI, Request, HTTPException
-from fastapi.responses import Response, StreamingResponse
+from fastapi.responses import FileResponse, Response, StreamingResponse
 from pydantic import BaseModel
+from typing import Optional
+import os
 import threading
+from functools import partial
 
-from src.image_processor.emotion import to_emotion_frame
 from src.image_processor.mesh_points import (
     to_mesh_frame,
     extract_face_features,
+    extract_multi_face_features,
+)
+from src.image_processor.pipeline import Pipeline, parse_stages
+from src.image_processor.face_tracker import FaceTracker
+from src.image_processor.motion import parse_zones
+from src.image_processor.emotion import configure_emotion_detection
+from src.image_processor.object_detection import (
+    init_detection_service,
+    close_detection_service,
+    get_detection_service,
+    find_objects,
+)
+from src.image_processor.face_mesh_engine import (
+    FaceMeshEngine,
+    init_face_mesh_pool,
+    close_face_mesh_pool,
 )
 
 from fastapi.middleware.cors import CORSMiddleware
 from src.camera.my_camera import MyCamera
+from src.camera.async_stream import iterate_in_thread
+from src.camera.inference_scheduler import InferenceScheduler
+from src.camera.motion_gate import MotionGate
 
 app = FastAPI()
 
@@ -23,9 +44,152 @@ app.add_middleware(
 )
 
 # カメラインスタンス
-from src.config import IP_ADDRESS, CAMERA, PASSWORD, PORT, STREAM, ONVIF_PORT
+from src.config import (
+    IP_ADDRESS,
+    CAMERA,
+    PASSWORD,
+    PORT,
+    STREAM,
+    ONVIF_PORT,
+    SNAPSHOT_MAX_STALENESS,
+    CAPTURE_LINGER_SECONDS,
+    FACE_MESH_POOL_SIZE,
+    MAX_NUM_FACES,
+    STREAM_QUEUE_SIZE,
+    INFERENCE_EVERY_N,
+    MOTION_ZONES,
+    CLIP_DIR,
+    CLIP_PRE_SECONDS,
+    CLIP_POST_SECONDS,
+    CLIP_BUFFER_MB,
+    PTZ_STATUS_INTERVAL,
+    DETECTION_WORKERS,
+    DETECTION_MAX_BATCH,
+    DETECTION_MAX_WAIT_MS,
+    INFERENCE_MOTION_GATE,
+    INFERENCE_KEEPALIVE_SECONDS,
+    INFERENCE_MOTION_HOLD_SECONDS,
+    EMOTION_DETECT_WIDTH,
+    EMOTION_SMILE_ROI_WIDTH,
+    FACE_REDETECT_INTERVAL,
+)
+
+my_camera = MyCamera(
+    IP_ADDRESS,
+    CAMERA,
+    PASSWORD,
+    PORT,
+    STREAM,
+    ONVIF_PORT,
+    snapshot_max_staleness=SNAPSHOT_MAX_STALENESS,
+    capture_linger=CAPTURE_LINGER_SECONDS,
+    motion_zones=parse_zones(MOTION_ZONES),
+    clip_dir=CLIP_DIR or None,
+    clip_pre_seconds=CLIP_PRE_SECONDS,
+    clip_post_seconds=CLIP_POST_SECONDS,
+    clip_buffer_bytes=CLIP_BUFFER_MB * 1024 * 1024,
+)
+
+
+# スナップショットの顔の追跡ID
+# (配信ではスケジューラ毎に、追跡モードのFaceMeshと合わせて作成する)
+snapshot_face_tracker = FaceTracker()
+
+
+def create_motion_gate() -> Optional[MotionGate]:
+    """
+    推論を動体検知で間引くゲートを作成する (無効な場合はNone)
+    背景モデルはカメラの動体検知と共有する
+    """
+    if not INFERENCE_MOTION_GATE:
+        return None
+    return MotionGate(
+        my_camera.detect_motion,
+        keepalive=INFERENCE_KEEPALIVE_SECONDS,
+        hold=INFERENCE_MOTION_HOLD_SECONDS,
+    )
+
+
+# mode=objectsのスナップショットで最後に検出したフレームの連番と結果
+# (同じフレームへの問い合わせ・映像に変化が無い間は推論し直さない)
+snapshot_objects = (None, None)
+snapshot_objects_lock = threading.Lock()
+snapshot_objects_gate = create_motion_gate()
+
+# 配信の推論スケジューラ (パイプライン名をキーに全視聴者で共有する)
+# 推論は配信とは独立した周期で行い、途中のフレームには最新の推論結果を描画する
+schedulers: dict[str, InferenceScheduler] = {}
+schedulers_lock = threading.Lock()
+
+# 配信のメッシュで使う追跡モードのFaceMesh (パイプライン名をキーにスケジューラ毎に1つ)
+# 追跡状態は連続したフレームから引き継ぐため、推論の順序が異なるスケジューラ間では共有しない
+stream_face_mesh_engines: dict[str, FaceMeshEngine] = {}
+
+
+def get_stream_scheduler(names: tuple) -> InferenceScheduler:
+    """
+    プロセッサの組み合わせに対応する配信用スケジューラを返す (無ければ作成して開始する)
+    """
+    name = "+".join(names)
+    with schedulers_lock:
+        scheduler = schedulers.get(name)
+        if scheduler is None:
+            face_mesh_engine = None
+            if "mesh" in names:
+                face_mesh_engine = FaceMeshEngine(
+                    static_image_mode=False, max_num_faces=MAX_NUM_FACES
+                )
+                stream_face_mesh_engines[name] = face_mesh_engine
+            pipeline = Pipeline(
+                names,
+                face_mesh_engine=face_mesh_engine,
+                face_tracker=FaceTracker(),
+                redetect_interval=FACE_REDETECT_INTERVAL,
+            )
+            scheduler = InferenceScheduler(
+                pipeline.name,
+                pipeline.infer,
+                lambda frame, results, scale: pipeline.render(frame, results, scale),
+                every_n=INFERENCE_EVERY_N,
+                gate=create_motion_gate(),
+            )
+            scheduler.start()
+            schedulers[name] = scheduler
+        return scheduler
+
+
+@app.on_event("startup")
+def startup_event():
+    """
+    アプリケーション起動時にFaceMeshのプールと物体検出の推論サービスを作成し、
+    録画を開始する
+    """
+    init_face_mesh_pool(FACE_MESH_POOL_SIZE, MAX_NUM_FACES)
+    init_detection_service(
+        DETECTION_WORKERS, DETECTION_MAX_BATCH, DETECTION_MAX_WAIT_MS / 1000
+    )
+    configure_emotion_detection(EMOTION_DETECT_WIDTH, EMOTION_SMILE_ROI_WIDTH)
+    my_camera.ptz_worker.start()
+    my_camera.ptz.start_status_polling(PTZ_STATUS_INTERVAL)
+    my_camera.start_recording()
+
+
+@app.on_event("shutdown")
+def shutdown_event():
+    """
+    アプリケーション終了時にRTSP接続とFaceMesh、物体検出の推論サービスを閉じる
+    """
+    with schedulers_lock:
+        for scheduler in schedulers.values():
+            scheduler.stop()
+        engines = list(stream_face_mesh_engines.values())
+        stream_face_mesh_engines.clear()
+    my_camera.close()
+    close_face_mesh_pool()
+    close_detection_service()
+    for engine in engines:
+        engine.close()
 
-my_camera = MyCamera(IP_ADDRESS, CAMERA, PASSWORD, PORT, STREAM, ONVIF_PORT)
 
 """
 PTZ (パン・チルト・ズーム) 操作エンドポイント
@@ -39,38 +203,207 @@ class PanTiltRequest(BaseModel):
 
 @app.post("/pan_tilt")
 async def ptz(request: PanTiltRequest):
+    """
+    移動の指示をPTZのワーカーに積み、移動の完了を待たずに指示のIDを返す
+    同じ方向の連続した指示は1つの移動にまとめ、逆方向の指示は実行中の移動を取り消す
+    """
     direction = request.direction
     duration = request.duration
 
     if direction not in ["up", "down", "left", "right"]:
         raise HTTPException(status_code=400, detail="Invalid direction")
+    if duration <= 0:
+        raise HTTPException(status_code=400, detail="Invalid duration")
 
+    command_id = my_camera.ptz_worker.submit(direction, duration)
+    return {
+        "status": "accepted",
+        "command_id": command_id,
+        "message": f"Camera will move {direction} for {duration} seconds",
+    }
+
+
+@app.get("/pan_tilt/{command_id}")
+async def ptz_status(command_id: str):
+    """
+    移動の指示の状態 (queued, running, merged, done, cancelled, failed) を返す
+    """
+    status = my_camera.ptz_worker.status(command_id)
+    if status is None:
+        raise HTTPException(status_code=404, detail="Unknown command")
+    return status
+
+
+class PTZMoveRequest(BaseModel):
+    pan: float  # パン (-1.0〜1.0。相対移動の場合は移動量)
+    tilt: float  # チルト (-1.0〜1.0。相対移動の場合は移動量)
+    zoom: Optional[float] = None  # ズーム (未指定の場合は変更しない)
+
+
+class PTZPresetRequest(BaseModel):
+    name: str  # プリセット名
+
+
+"""
+以下のPTZ操作はSOAPの呼び出しを待つため、同期関数としてスレッドプールで実行する
+移動の前に、PTZのワーカーで実行中のパン・チルトは取り消す
+"""
+
+
+@app.post("/ptz/absolute")
+def ptz_absolute(request: PTZMoveRequest):
+    """
+    指定した位置へ移動する
+    """
     try:
-        my_camera.pan_tilt(direction, duration)
-        return {
-            "status": "success",
-            "message": f"Camera moved {direction} for {duration} seconds",
-        }
-    except Exception as e:
+        my_camera.ptz_worker.cancel()
+        my_camera.ptz.absolute_move(request.pan, request.tilt, request.zoom)
+    except RuntimeError as e:
         raise HTTPException(status_code=500, detail=str(e))
+    return {"status": "success"}
+
+
+@app.post("/ptz/relative")
+def ptz_relative(request: PTZMoveRequest):
+    """
+    現在の位置から指定した量だけ移動する
+    """
+    try:
+        my_camera.ptz_worker.cancel()
+        my_camera.ptz.relative_move(request.pan, request.tilt, request.zoom)
+    except RuntimeError as e:
+        raise HTTPException(status_code=500, detail=str(e))
+    return {"status": "success"}
+
+
+@app.get("/ptz/position")
+def ptz_position():
+    """
+    定期的に取得している位置を返す (カメラには問い合わせない)
+    """
+    position = my_camera.ptz.position()
+    if position is None:
+        raise HTTPException(status_code=503, detail="位置をまだ取得していません")
+    return position
+
+
+@app.get("/ptz/presets")
+def ptz_presets():
+    """
+    プリセットの一覧を返す (一覧はキャッシュし、登録・削除時に取得し直す)
+    """
+    try:
+        return {"presets": my_camera.ptz.get_presets()}
+    except RuntimeError as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+@app.post("/ptz/presets")
+def ptz_save_preset(request: PTZPresetRequest):
+    """
+    現在の位置を名前付きのプリセットとして登録する (同じ名前があれば上書き)
+    """
+    try:
+        token = my_camera.ptz.set_preset(request.name)
+    except RuntimeError as e:
+        raise HTTPException(status_code=500, detail=str(e))
+    return {"status": "success", "token": token}
+
+
+@app.delete("/ptz/presets/{name}")
+def ptz_remove_preset(name: str):
+    """
+    名前を指定してプリセットを削除する
+    """
+    try:
+        preset = my_camera.ptz.find_preset(name)
+        if preset is None:
+            raise HTTPException(status_code=404, detail="プリセットがありません")
+        my_camera.ptz.remove_preset(preset["token"])
+    except RuntimeError as e:
+        raise HTTPException(status_code=500, detail=str(e))
+    return {"status": "success"}
+
+
+@app.post("/ptz/presets/{name}/goto")
+def ptz_goto_preset(name: str):
+    """
+    名前を指定してプリセットの位置へ移動する
+    """
+    try:
+        preset = my_camera.ptz.find_preset(name)
+        if preset is None:
+            raise HTTPException(status_code=404, detail="プリセットがありません")
+        my_camera.move_initial_position(name)
+    except RuntimeError as e:
+        raise HTTPException(status_code=500, detail=str(e))
+    return {"status": "success"}
+
+
+@app.get("/ptz/health")
+def ptz_health(force: bool = False):
+    """
+    ONVIF接続の状態を返す (forceを指定すると必ずカメラに問い合わせる)
+    """
+    return my_camera.ptz.health_check(force=force)
 
 
 """
 ストリーミング取得エンドポイント
+クエリパラメータ`stages`(カンマ区切り)により適用する処理を組み合わせ可能 (指定順に適用)
+    - "mesh": 顔のメッシュポイントを描画
+    - "emotion": 顔と表情のラベルを描画
+    - "objects": 物体検出の結果を描画
+    - "binarize": 2値化した画像に置き換え
+クエリパラメータ`mode`は処理を1つだけ指定する場合の別名
+推論はカメラのフレームレートとは独立に行い、途中のフレームには最新の推論結果を描画する
+クエリパラメータ`quality`(JPEG品質 1-100)、`width`(幅px)で画質を指定可能
+クエリパラメータ`fps`で配信の最大フレームレートを指定可能 (イベントサービスの動体検知用など)
 """
 
 
 @app.get("/video")
-async def video_feed(request: Request):
+async def video_feed(
+    request: Request,
+    mode: str = None,
+    stages: str = None,
+    quality: int = None,
+    width: int = None,
+    fps: float = None,
+):
     stop_event = threading.Event()
 
+    stages = stages or mode
+    if stages is None:
+        scheduler = None
+    else:
+        try:
+            scheduler = get_stream_scheduler(parse_stages(stages))
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+    if quality is not None and not 1 <= quality <= 100:
+        raise HTTPException(status_code=400, detail="不正なqualityです")
+    if fps is not None and fps <= 0:
+        raise HTTPException(status_code=400, detail="不正なfpsです")
+
+    # フレームの取得・変換・エンコードはワーカースレッドで行う同期ジェネレーター
+    def produce_chunks():
+        return my_camera.frame_generator(
+            stop_event,
+            quality=quality,
+            width=width,
+            scheduler=scheduler,
+            max_fps=fps,
+        )
+
     # クライアントが切断した場合にストリーミングを停止するための非同期ジェネレーター
+    # 遅いクライアントは古いフレームを捨てるため、他のエンドポイントやクライアントを待たせない
     async def video_stream():
-        generator = my_camera.frame_generator(stop_event)
         try:
-            for chunk in generator:
+            async for chunk in iterate_in_thread(
+                produce_chunks, stop_event, max_queue=STREAM_QUEUE_SIZE
+            ):
                 if await request.is_disconnected():
-                    stop_event.set()
                     break
                 yield chunk
         finally:
@@ -87,29 +420,142 @@ async def video_feed(request: Request):
     - None: 通常のJPEG画像を返す
     - "mesh": 顔のメッシュポイントを描画したJPEG画像を返す
     - "features": 顔の特徴点の座標リストをJSONで返す
+    - "faces": 検出した全ての顔の特徴と追跡IDのリストをJSONで返す
+    - "objects": 物体検出の結果(クラス・信頼度・ボックス)をJSONで返す (JPEGはエンコードしない)
+クエリパラメータ`stages`(カンマ区切り)で/videoと同じ処理を組み合わせたJPEG画像を返す
+クエリパラメータ`max_age`で許容するフレームの古さ(秒)を指定可能
 """
 
 
+def get_snapshot_objects(hub_frame):
+    """
+    フレームの物体検出結果を(検出したフレームの連番, Detections)で返す
+    直前と同じフレームや、映像に変化が無い場合は保持している結果を返す
+    """
+    global snapshot_objects
+    with snapshot_objects_lock:
+        seq, detections = snapshot_objects
+    if seq == hub_frame.seq:
+        return seq, detections
+    if snapshot_objects_gate is not None and not snapshot_objects_gate.should_run(
+        hub_frame, has_result=detections is not None
+    ):
+        return seq, detections
+
+    detections = find_objects(hub_frame.image)
+    with snapshot_objects_lock:
+        snapshot_objects = (hub_frame.seq, detections)
+    return hub_frame.seq, detections
+
+
 @app.get("/snapshot")
-def face(mode: str = None):
-    if mode is None:
-        frame_bytes, _ = my_camera.get_frame()
+def face(mode: str = None, stages: str = None, max_age: float = None):
+    if stages is not None:
+        try:
+            pipeline = Pipeline(parse_stages(stages))
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+        frame_bytes, _ = my_camera.get_frame(
+            transform_func=pipeline,
+            transform_name=f"snapshot:{pipeline.name}",
+            max_staleness=max_age,
+        )
+    elif mode is None:
+        frame_bytes, _ = my_camera.get_frame(max_staleness=max_age)
     elif mode == "mesh":
-        frame_bytes, _ = my_camera.get_frame(transform_func=to_mesh_frame)
+        frame_bytes, _ = my_camera.get_frame(
+            transform_func=to_mesh_frame,
+            transform_name="snapshot_mesh",
+            max_staleness=max_age,
+        )
     elif mode == "features":
-        _, features = my_camera.get_frame(extract_func=extract_face_features)
+        _, features = my_camera.get_frame(
+            extract_func=extract_face_features, max_staleness=max_age
+        )
         if features is None:
-            return HTTPException(status_code=500, detail="特徴を検知できませんでした")
+            raise HTTPException(status_code=500, detail="特徴を検知できませんでした")
         return features
+    elif mode == "faces":
+        _, faces = my_camera.get_frame(
+            extract_func=partial(
+                extract_multi_face_features, tracker=snapshot_face_tracker
+            ),
+            max_staleness=max_age,
+        )
+        if faces is None:
+            raise HTTPException(status_code=500, detail="フレームを取得できませんでした")
+        return faces
+    elif mode == "objects":
+        hub_frame = my_camera.get_latest_frame(max_age)
+        if hub_frame is None:
+            raise HTTPException(status_code=500, detail="フレームを取得できませんでした")
+        try:
+            seq, detections = get_snapshot_objects(hub_frame)
+        except RuntimeError as e:
+            raise HTTPException(status_code=500, detail=str(e))
+        return {
+            "seq": hub_frame.seq,
+            "timestamp": hub_frame.timestamp,
+            # 検出したフレームの連番 (映像に変化が無く推論を省略した場合はseqより古い)
+            "result_seq": seq,
+            **detections.to_dict(),
+        }
     else:
-        return HTTPException(status_code=400, detail="不正なmodeです")
+        raise HTTPException(status_code=400, detail="不正なmodeです")
 
     if frame_bytes is None:
-        return HTTPException(status_code=500, detail="フレームを取得できませんでした")
+        raise HTTPException(status_code=500, detail="フレームを取得できませんでした")
 
     return Response(content=frame_bytes, media_type="image/jpeg")
 
 
+"""
+配信の推論状況取得エンドポイント
+"""
+
+
+@app.get("/stats")
+async def stats():
+    """
+    処理の組み合わせごとの推論レート(inference_fps)と推論を省略したフレームの割合(skip_ratio)、
+    物体検出のバッチ推論の状況(detection)を返す
+    """
+    with schedulers_lock:
+        active = list(schedulers.values())
+    return {
+        "inference": [scheduler.stats() for scheduler in active],
+        "detection": get_detection_service().stats(),
+    }
+
+
+"""
+録画取得エンドポイント
+"""
+
+
+@app.get("/clips")
+def clips():
+    """
+    保存済みの録画(MJPEG)のファイル名を新しい順に返す
+    """
+    if my_camera.clip_recorder is None:
+        return {"clips": []}
+    return {"clips": my_camera.clip_recorder.list_clips()}
+
+
+@app.get("/clips/{name}")
+def clip(name: str):
+    """
+    録画ファイルを返す
+    """
+    recorder = my_camera.clip_recorder
+    if recorder is None or name not in recorder.list_clips():
+        raise HTTPException(status_code=404, detail="録画がありません")
+    return FileResponse(
+        os.path.join(recorder.clip_dir, name), media_type="video/x-motion-jpeg"
+    )
+
+
 """
 イベント情報取得エンドポイント
 """
@@ -118,11 +564,13 @@ def face(mode: str = None):
 @app.get("/event")
 async def event():
     """
-    現在のis_motionフラグと最後の検知時間を返すエンドポイント
+    現在のis_motionフラグと最後の検知時間、検知エリア毎の状態、変化した範囲を返すエンドポイント
     """
     return {
         "is_motion": my_camera.is_motion,
         "last_motion_time": my_camera.last_motion_time,
+        "zones": my_camera.motion_zones,
+        "region": my_camera.motion_region,
     }
 
 
@@ -0,0 +1,72 @@
+import asyncio
+import threading
+import logging
+from typing import AsyncGenerator, Callable, Iterator, TypeVar
+
+logger = logging.getLogger("uvicorn")
+
+T = TypeVar("T")
+
+_END = object()
+
+
+class _WorkerError:
+    def __init__(self, exc: BaseException):
+        self.exc = exc
+
+
+async def iterate_in_thread(
+    generator_factory: Callable[[], Iterator[T]],
+    stop_event: threading.Event,
+    max_queue: int = 2,
+) -> AsyncGenerator[T, None]:
+    """
+    同期ジェネレータを専用のワーカースレッドで回し、有界のasyncio.Queue経由で
+    非同期に受け取る。フレームの取得・変換・エンコードがイベントループを塞がない。
+    キューが満杯のときは最も古い要素を捨てるため、遅いクライアントはフレームを落とし、
+    ワーカー側に背圧はかからない。
+    ジェネレータの生成と終了(finally)はワーカースレッド内で行われる。
+    """
+    loop = asyncio.get_running_loop()
+    queue: asyncio.Queue = asyncio.Queue(maxsize=max_queue)
+
+    def put_latest(item):
+        # イベントループ上で実行される
+        if queue.full():
+            queue.get_nowait()
+        queue.put_nowait(item)
+
+    def publish(item) -> bool:
+        try:
+            loop.call_soon_threadsafe(put_latest, item)
+            return True
+        except RuntimeError:
+            # イベントループが既に閉じている
+            return False
+
+    def worker():
+        generator = generator_factory()
+        try:
+            for item in generator:
+                if stop_event.is_set() or not publish(item):
+                    break
+        except Exception as e:
+            logger.exception("ストリーミングのワーカーでエラーが発生しました")
+            publish(_WorkerError(e))
+        finally:
+            generator.close()
+            publish(_END)
+
+    thread = threading.Thread(target=worker, daemon=True)
+    thread.start()
+
+    try:
+        while True:
+            item = await queue.get()
+            if item is _END:
+                break
+            if isinstance(item, _WorkerError):
+                raise item.exc
+            yield item
+    finally:
+        stop_event.set()
@@ -0,0 +1,310 @@
+import os
+import queue
+import threading
+import time
+import logging
+import numpy as np
+from typing import Callable, List, Optional, Tuple
+
+from src.camera.frame_hub import FrameHub, HubFrame
+from src.camera.jpeg_cache import JpegCache
+
+logger = logging.getLogger("uvicorn")
+
+"""
+動体検知をきっかけにした録画
+直近のエンコード済みフレームをリングバッファに保持し、検知時に前後のフレームをまとめて書き出す
+"""
+
+
+class FrameRing:
+    """
+    エンコード済みフレームを保持する、容量固定のリングバッファ。
+    バイト列は起動時に確保したcapacity_bytesのバッファに詰めて書き、
+    フレームの位置・長さ・時刻は最大max_frames件の配列で管理する。
+    容量を超えると古いフレームから上書きするため、メモリ使用量は一定。
+    """
+
+    def __init__(self, capacity_bytes: int, max_frames: int = 4096):
+        self._buf = bytearray(capacity_bytes)
+        self._offsets = np.zeros(max_frames, dtype=np.int64)
+        self._lengths = np.zeros(max_frames, dtype=np.int64)
+        self._timestamps = np.zeros(max_frames, dtype=np.float64)
+        self._seqs = np.zeros(max_frames, dtype=np.int64)
+        self._start = 0  # 最も古いフレームの枠
+        self._count = 0
+        self._head = 0  # 次に書き込むバイト位置
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        with self._lock:
+            return self._count
+
+    def _evict_oldest(self):
+        self._start = (self._start + 1) % len(self._offsets)
+        self._count -= 1
+
+    def append(self, seq: int, timestamp: float, data: bytes) -> bool:
+        """
+        フレームを追加する。バッファより大きいフレームは追加せずFalseを返す。
+        """
+        size = len(data)
+        capacity = len(self._buf)
+        if size > capacity:
+            return False
+
+        with self._lock:
+            head = self._head
+            if head + size > capacity:
+                # 末尾に収まらなければ先頭に戻る。末尾に残った前周のフレームは最も古いので捨てる
+                while self._count and self._offsets[self._start] >= head:
+                    self._evict_oldest()
+                head = 0
+
+            # 書き込む範囲に重なる古いフレームを捨てる
+            while self._count:
+                offset = self._offsets[self._start]
+                if offset >= head + size or offset + self._lengths[self._start] <= head:
+                    break
+                self._evict_oldest()
+            if self._count == len(self._offsets):
+                self._evict_oldest()
+
+            self._buf[head : head + size] = data
+            slot = (self._start + self._count) % len(self._offsets)
+            self._offsets[slot] = head
+            self._lengths[slot] = size
+            self._timestamps[slot] = timestamp
+            self._seqs[slot] = seq
+            self._count += 1
+            self._head = head + size
+        return True
+
+    def frames_since(self, timestamp: float) -> List[Tuple[int, float, bytes]]:
+        """
+        timestamp以降のフレームを古い順に(連番, 時刻, バイト列)のリストでコピーして返す
+        """
+        with self._lock:
+            slots = (self._start + np.arange(self._count)) % len(self._offsets)
+            slots = slots[self._timestamps[slots] >= timestamp]
+            return [
+                (
+                    int(self._seqs[slot]),
+                    float(self._timestamps[slot]),
+                    bytes(
+                        self._buf[
+                            self._offsets[slot] : self._offsets[slot]
+                            + self._lengths[slot]
+                        ]
+                    ),
+                )
+                for slot in slots
+            ]
+
+    def clear(self):
+        with self._lock:
+            self._start = self._count = self._head = 0
+
+
+class _ClipWriter:
+    """
+    クリップをファイルに書き出すバックグラウンドスレッド。
+    キューに溜まったフレームはまとめて連結し、1回の追記で書き込む。
+    キューが溢れた場合はフレームを捨て、キャプチャを待たせない。
+    """
+
+    def __init__(self, max_queue: int = 512, batch_size: int = 32):
+        self._queue: "queue.Queue[tuple]" = queue.Queue(maxsize=max_queue)
+        self._batch_size = batch_size
+        self._dropped = 0
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def open(self, path: str):
+        self._put(("open", path), block=True)
+
+    def write(self, data: bytes):
+        self._put(("frame", data), block=False)
+
+    def close_clip(self):
+        self._put(("close", None), block=True)
+
+    def stop(self):
+        self._put(("stop", None), block=True)
+        self._thread.join(timeout=5.0)
+
+    def _put(self, item: tuple, block: bool):
+        try:
+            self._queue.put(item, block=block, timeout=1.0 if block else None)
+        except queue.Full:
+            self._dropped += 1
+            if self._dropped % 100 == 1:
+                logger.warning("録画の書き込みが追いつかないためフレームを捨てました")
+
+    def _run(self):
+        file = None
+        while True:
+            items = [self._queue.get()]
+            # 溜まっている分をまとめて取り出す
+            while len(items) < self._batch_size:
+                try:
+                    items.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            frames: List[bytes] = []
+            for kind, value in items:
+                if kind == "frame":
+                    frames.append(value)
+                    continue
+
+                # 区切りの前に溜めたフレームを書き込む
+                file = self._flush(file, frames)
+                frames = []
+                if kind == "open":
+                    try:
+                        file = open(value, "ab")
+                    except OSError:
+                        logger.exception("録画ファイルを開けませんでした: %s", value)
+                elif file is not None:
+                    file.close()
+                    file = None
+                if kind == "stop":
+                    return
+            file = self._flush(file, frames)
+
+    def _flush(self, file, frames: List[bytes]):
+        if file is None or not frames:
+            return file
+        try:
+            file.write(b"".join(frames))
+            return file
+        except OSError:
+            logger.exception("録画ファイルに書き込めませんでした")
+            file.close()
+            return None
+
+
+class ClipRecorder:
+    """
+    ハブを購読して各フレームをエンコードし、直近のフレームをFrameRingに保持する録画器。
+    detect_motion(hub_frame)がTrueを返すと、pre_seconds前からのフレームと、
+    最後に動体を検知してからpost_seconds後までのフレームを1つのクリップとして書き出す。
+    クリップは連結したJPEG(MJPEG)ファイルとしてclip_dirに保存する。
+    エンコード結果はJpegCacheを通すため、同じ画質の配信とエンコードを共有する。
+    """
+
+    def __init__(
+        self,
+        hub: FrameHub,
+        jpeg_cache: JpegCache,
+        detect_motion: Callable[[HubFrame], bool],
+        clip_dir: str,
+        pre_seconds: float = 5.0,
+        post_seconds: float = 10.0,
+        buffer_bytes: int = 64 * 1024 * 1024,
+        quality: Optional[int] = 80,
+        width: Optional[int] = 1280,
+    ):
+        self._hub = hub
+        self._jpeg_cache = jpeg_cache
+        self._detect_motion = detect_motion
+        self.clip_dir = clip_dir
+        self._pre_seconds = pre_seconds
+        self._post_seconds = post_seconds
+        self._quality = quality
+        self._width = width
+
+        self._ring = FrameRing(buffer_bytes)
+        self._writer: Optional[_ClipWriter] = None
+        self._thread: Optional[threading.Thread] = None
+        self._stop_event = threading.Event()
+        self._lock = threading.Lock()
+
+    def start(self):
+        with self._lock:
+            if self._thread is not None:
+                return
+            os.makedirs(self.clip_dir, exist_ok=True)
+            self._writer = _ClipWriter()
+            self._stop_event = threading.Event()
+            self._thread = threading.Thread(
+                target=self._run, args=(self._stop_event,), daemon=True
+            )
+            self._thread.start()
+
+    def stop(self):
+        with self._lock:
+            thread, self._thread = self._thread, None
+            self._stop_event.set()
+        if thread is not None:
+            thread.join(timeout=5.0)
+        if self._writer is not None:
+            self._writer.stop()
+            self._writer = None
+        self._ring.clear()
+
+    def list_clips(self) -> List[str]:
+        """
+        保存済みのクリップのファイル名を新しい順に返す
+        """
+        if not os.path.isdir(self.clip_dir):
+            return []
+        return sorted(
+            (name for name in os.listdir(self.clip_dir) if name.endswith(".mjpeg")),
+            reverse=True,
+        )
+
+    def _run(self, stop_event: threading.Event):
+        recording_until = 0.0
+        last_seq = 0
+
+        with self._hub.subscription():
+            while not stop_event.is_set():
+                hub_frame = self._hub.wait_frame(last_seq, timeout=1.0)
+                if hub_frame is None:
+                    continue
+                last_seq = hub_frame.seq
+
+                encoded = self._jpeg_cache.get(
+                    hub_frame, quality=self._quality, width=self._width
+                )
+                if encoded is None:
+                    continue
+                self._ring.append(hub_frame.seq, hub_frame.timestamp, encoded.jpeg)
+
+                try:
+                    motion = self._detect_motion(hub_frame)
+                except Exception:
+                    logger.exception("録画用の動体検知に失敗しました")
+                    motion = False
+
+                if not recording_until:
+                    if motion:
+                        # 新しいクリップを開き、保持している直前のフレームから書き出す
+                        self._start_clip(hub_frame)
+                        recording_until = hub_frame.timestamp + self._post_seconds
+                    continue
+
+                # 録画中は最後に動体を検知してからpost_seconds経つまで書き出す
+                self._writer.write(encoded.jpeg)
+                if motion:
+                    recording_until = hub_frame.timestamp + self._post_seconds
+                elif hub_frame.timestamp >= recording_until:
+                    self._writer.close_clip()
+                    recording_until = 0.0
+
+            if recording_until:
+                self._writer.close_clip()
+
+    def _start_clip(self, hub_frame: HubFrame):
+        name = time.strftime("%Y%m%d-%H%M%S", time.localtime(hub_frame.timestamp))
+        path = os.path.join(self.clip_dir, f"{name}-{hub_frame.seq}.mjpeg")
+        logger.info("録画を開始します: %s", path)
+
+        self._writer.open(path)
+        # 検知したフレームまでの直前のフレーム(検知したフレームを含む)
+        for _, _, data in self._ring.frames_since(
+            hub_frame.timestamp - self._pre_seconds
+        ):
+            self._writer.write(data)
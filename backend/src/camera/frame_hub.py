@@ -0,0 +1,181 @@
+import cv2
+import threading
+import time
+import logging
+from contextlib import contextmanager
+from dataclasses import dataclass
+from typing import Callable, Iterator, Optional
+
+logger = logging.getLogger("uvicorn")
+
+
+@dataclass(frozen=True)
+class HubFrame:
+    """
+    ハブが配信する1フレーム。
+    seqは取得順の連番、timestampは取得時刻(time.time())。
+    imageは全購読者で共有されるため、読み取り専用として扱うこと。
+    """
+
+    seq: int
+    timestamp: float
+    image: cv2.Mat
+
+
+class FrameHub:
+    """
+    1本のVideoCaptureを保持するバックグラウンドスレッドで最新フレームを読み続け、
+    任意数の購読者へ配信するハブ。
+    購読者がいる間だけキャプチャを開き、全員が離れてからlinger秒経過したら閉じる。
+    (lingerの間はキャプチャを温めておき、直後のスナップショットを即座に返せるようにする)
+    """
+
+    def __init__(
+        self,
+        open_capture: Callable[[], Optional[cv2.VideoCapture]],
+        reconnect_interval: float = 2.0,
+        linger: float = 0.0,
+    ):
+        self._open_capture = open_capture
+        self._reconnect_interval = reconnect_interval
+        self._linger = linger
+
+        self._cond = threading.Condition()
+        self._latest: Optional[HubFrame] = None
+        self._seq = 0
+        self._subscribers = 0
+        self._idle_since = 0.0
+        self._thread: Optional[threading.Thread] = None
+        self._stop_event: Optional[threading.Event] = None
+
+    @property
+    def seq(self) -> int:
+        """最後に配信したフレームの連番"""
+        with self._cond:
+            return self._seq
+
+    @property
+    def is_running(self) -> bool:
+        """キャプチャスレッドが動作中(linger中を含む)かどうか"""
+        with self._cond:
+            return self._thread is not None
+
+    def subscribe(self):
+        """
+        購読者を登録する。キャプチャスレッドが止まっていれば起動する。
+        """
+        with self._cond:
+            self._subscribers += 1
+            if self._thread is None:
+                self._start_locked()
+
+    def unsubscribe(self):
+        """
+        購読者を解除する。購読者がいなくなればlinger秒後にキャプチャスレッドを停止する。
+        """
+        with self._cond:
+            self._subscribers = max(self._subscribers - 1, 0)
+            if self._subscribers == 0:
+                self._idle_since = time.time()
+                if self._linger <= 0:
+                    self._stop_locked()
+
+    @contextmanager
+    def subscription(self) -> Iterator["FrameHub"]:
+        self.subscribe()
+        try:
+            yield self
+        finally:
+            self.unsubscribe()
+
+    def latest(self) -> Optional[HubFrame]:
+        """最新フレームを返す(無ければNone)"""
+        with self._cond:
+            return self._latest
+
+    def wait_frame(
+        self, after_seq: int = 0, timeout: float = 5.0
+    ) -> Optional[HubFrame]:
+        """
+        連番がafter_seqより新しいフレームが届くまで待って返す。
+        after_seq=0なら、現在の最新フレームがあれば即座に返す。
+        timeout秒以内に届かなければNoneを返す。
+        """
+        with self._cond:
+            self._cond.wait_for(
+                lambda: self._latest is not None and self._latest.seq > after_seq,
+                timeout=timeout,
+            )
+            if self._latest is None or self._latest.seq <= after_seq:
+                return None
+            return self._latest
+
+    def stop(self):
+        """購読者の有無に関わらずキャプチャスレッドを停止する"""
+        with self._cond:
+            self._subscribers = 0
+            self._stop_locked()
+
+    def _start_locked(self):
+        # 前回接続時の古いフレームは配信しない
+        self._latest = None
+        # 停止処理中の古いスレッドは自分のstop_eventを見て終了する
+        self._stop_event = threading.Event()
+        self._thread = threading.Thread(
+            target=self._run, args=(self._stop_event,), daemon=True
+        )
+        self._thread.start()
+
+    def _stop_locked(self):
+        if self._stop_event is not None:
+            self._stop_event.set()
+        self._stop_event = None
+        self._thread = None
+
+    def _idle_expired_locked(self) -> bool:
+        # 購読者がいないままlinger秒経過したか
+        return (
+            self._subscribers == 0
+            and time.time() - self._idle_since >= self._linger
+        )
+
+    def _run(self, stop_event: threading.Event):
+        """
+        キャプチャスレッド本体。
+        読み取りに失敗したらキャプチャを開き直す。
+        購読者がいないままlinger秒経過したら自ら停止する。
+        """
+        cap = None
+        try:
+            while not stop_event.is_set():
+                with self._cond:
+                    if self._idle_expired_locked() and not stop_event.is_set():
+                        self._stop_locked()
+                        break
+
+                if cap is None:
+                    cap = self._open_capture()
+                    if cap is None:
+                        logger.warning("RTSPストリームを開けませんでした。再接続します")
+                        stop_event.wait(self._reconnect_interval)
+                        continue
+                    logger.info("RTSP connection opened (frame hub)")
+
+                success, frame = cap.read()
+                if not success:
+                    logger.warning("フレームを読み取れませんでした。再接続します")
+                    cap.release()
+                    cap = None
+                    stop_event.wait(self._reconnect_interval)
+                    continue
+
+                with self._cond:
+                    if stop_event.is_set():
+                        break
+                    self._seq += 1
+                    self._latest = HubFrame(self._seq, time.time(), frame)
+                    self._cond.notify_all()
+        finally:
+            if cap is not None:
+                cap.release()
+            logger.info("RTSP connection closed (frame hub)")
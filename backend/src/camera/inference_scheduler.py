@@ -0,0 +1,168 @@
+import cv2
+import threading
+import time
+import logging
+from collections import deque
+from typing import Any, Callable, Optional
+
+from src.camera.frame_hub import HubFrame
+from src.camera.motion_gate import MotionGate
+
+logger = logging.getLogger("uvicorn")
+
+
+class InferenceScheduler:
+    """
+    推論(infer_func)を配信とは独立した周期でワーカースレッドで実行し、
+    最新の推論結果を途中のフレームにも描画(render_func)するスケジューラ。
+    推論がカメラのフレームレートより遅くても配信は遅れず、推論はCPUが許す限り回る。
+
+    every_n=0の場合はワーカーが空き次第最新フレームで推論し、
+    every_n=Nの場合はNフレーム毎に(ワーカーが空いていれば)推論する。
+    推論待ちのフレームは常に最新の1枚だけを保持し、古いものは捨てる。
+    gateが指定されていれば、映像に変化が無い間は推論せず直前の結果を描画し続ける。
+
+    render_func(frame, result, scale)のscaleは、描画するフレームの幅と
+    推論したフレームの幅の比率(縮小配信時の座標変換用)。
+    """
+
+    def __init__(
+        self,
+        name: str,
+        infer_func: Callable[[cv2.Mat], Any],
+        render_func: Callable[[cv2.Mat, Any, float], cv2.Mat],
+        every_n: int = 0,
+        stats_window: float = 5.0,
+        gate: Optional[MotionGate] = None,
+    ):
+        self.name = name
+        self._infer_func = infer_func
+        self._render_func = render_func
+        self._every_n = every_n
+        self._stats_window = stats_window
+        self._gate = gate
+
+        self._cond = threading.Condition()
+        self._pending: Optional[HubFrame] = None
+        self._last_submitted_seq = 0
+        self._result: Any = None
+        self._result_width = 0
+        self._result_seq = 0
+        self._stop_event = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+        # 統計
+        self._frames = 0
+        self._inferences = 0
+        self._last_latency = 0.0
+        self._frame_times: deque = deque()
+        self._inference_times: deque = deque()
+
+    def start(self):
+        with self._cond:
+            if self._thread is not None:
+                return
+            self._stop_event = threading.Event()
+            self._thread = threading.Thread(
+                target=self._run, args=(self._stop_event,), daemon=True
+            )
+            self._thread.start()
+
+    def stop(self):
+        with self._cond:
+            self._stop_event.set()
+            self._thread = None
+            self._cond.notify_all()
+
+    def submit(self, hub_frame: HubFrame):
+        """
+        配信したフレームを推論候補として登録する(待たない)。
+        複数の視聴者から同じフレームが登録されても1度として数える。
+        """
+        with self._cond:
+            if hub_frame.seq <= self._last_submitted_seq:
+                return
+            self._last_submitted_seq = hub_frame.seq
+            self._frames += 1
+            now = time.time()
+            self._frame_times.append(now)
+            self._trim(now)
+
+            if self._every_n and self._frames % self._every_n != 0:
+                return
+            # ワーカーが処理中なら未処理の候補を新しいフレームで置き換える
+            self._pending = hub_frame
+            self._cond.notify_all()
+
+    def render(self, frame: cv2.Mat) -> cv2.Mat:
+        """
+        最新の推論結果をフレームに描画する。結果が無ければそのまま返す。
+        """
+        with self._cond:
+            result = self._result
+            result_width = self._result_width
+        if result is None:
+            return frame
+        scale = frame.shape[1] / result_width if result_width else 1.0
+        return self._render_func(frame, result, scale)
+
+    def stats(self) -> dict:
+        """
+        直近stats_window秒の推論レートと、推論を省略したフレームの割合を返す
+        """
+        with self._cond:
+            now = time.time()
+            self._trim(now)
+            frames = len(self._frame_times)
+            inferences = len(self._inference_times)
+            return {
+                "name": self.name,
+                "inference_fps": inferences / self._stats_window,
+                "stream_fps": frames / self._stats_window,
+                "skip_ratio": 1.0 - inferences / frames if frames else 0.0,
+                "last_latency": self._last_latency,
+                "total_frames": self._frames,
+                "total_inferences": self._inferences,
+                "result_seq": self._result_seq,
+                "gate": self._gate.stats() if self._gate is not None else None,
+            }
+
+    def _trim(self, now: float):
+        for times in (self._frame_times, self._inference_times):
+            while times and now - times[0] > self._stats_window:
+                times.popleft()
+
+    def _run(self, stop_event: threading.Event):
+        while True:
+            with self._cond:
+                self._cond.wait_for(
+                    lambda: self._pending is not None or stop_event.is_set()
+                )
+                if stop_event.is_set():
+                    return
+                hub_frame = self._pending
+                self._pending = None
+                has_result = self._result is not None
+
+            # 映像に変化が無ければ推論せず、直前の結果を使い続ける
+            if self._gate is not None and not self._gate.should_run(
+                hub_frame, has_result
+            ):
+                continue
+
+            start = time.time()
+            try:
+                result = self._infer_func(hub_frame.image)
+            except Exception:
+                logger.exception("推論に失敗しました (%s)", self.name)
+                continue
+            end = time.time()
+
+            with self._cond:
+                self._result = result
+                self._result_width = hub_frame.image.shape[1]
+                self._result_seq = hub_frame.seq
+                self._inferences += 1
+                self._inference_times.append(end)
+                self._last_latency = end - start
+                self._trim(end)
@@ -0,0 +1,128 @@
+import cv2
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Callable, Hashable, Optional, Tuple
+
+from src.camera.frame_hub import HubFrame
+
+MULTIPART_FOOTER = b"\r\n"
+
+
+def _multipart_header(seq: int, length: int) -> bytes:
+    """
+    MJPEG配信用のmultipartのパートヘッダ。
+    Content-LengthとX-Frame-Seq(ハブのフレーム連番)は、イベントサービスなど
+    プログラムから配信を読む側がフレームの切り出しと対応付けに使う。
+    """
+    return (
+        b"--frame\r\nContent-Type: image/jpeg\r\n"
+        b"Content-Length: %d\r\nX-Frame-Seq: %d\r\n\r\n" % (length, seq)
+    )
+
+
+@dataclass(frozen=True)
+class EncodedFrame:
+    """
+    エンコード済みの1フレーム。
+    jpegはJPEGのバイト列、chunkはMJPEG配信用にmultipartの区切りを付けたバイト列。
+    """
+
+    seq: int
+    jpeg: bytes
+    chunk: bytes
+
+
+class _Entry:
+    def __init__(self):
+        self.ready = threading.Event()
+        self.encoded: Optional[EncodedFrame] = None
+
+
+class JpegCache:
+    """
+    (フレーム連番, 変換名, 品質, 幅)をキーに、エンコード済みフレームを保持するキャッシュ。
+    同じキーの変換・エンコードは1度だけ行い、同時に要求された場合は先行する処理の完了を待つ。
+    視聴者が増えてもエンコード回数はフレーム・画質毎に1回で済む。
+    """
+
+    def __init__(self, max_entries: int = 32):
+        self._max_entries = max_entries
+        self._entries: "OrderedDict[Tuple[Hashable, ...], _Entry]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(
+        self,
+        hub_frame: HubFrame,
+        transform_name: Optional[Hashable] = None,
+        transform_func: Optional[Callable[[cv2.Mat], cv2.Mat]] = None,
+        quality: Optional[int] = None,
+        width: Optional[int] = None,
+    ) -> Optional[EncodedFrame]:
+        """
+        hub_frameを変換・縮小・エンコードした結果を返す。
+        transform_nameは変換結果を共有してよい変換の識別子。
+        Noneの場合はtransform_funcそのものを識別子とする。
+        エンコードに失敗した場合はNoneを返す。
+        """
+        if transform_name is None and transform_func is not None:
+            transform_name = transform_func
+        key = (hub_frame.seq, transform_name, quality, width)
+
+        with self._lock:
+            entry = self._entries.get(key)
+            owner = entry is None
+            if owner:
+                entry = _Entry()
+                self._entries[key] = entry
+                while len(self._entries) > self._max_entries:
+                    self._entries.popitem(last=False)
+            else:
+                self._entries.move_to_end(key)
+
+        if not owner:
+            entry.ready.wait()
+            return entry.encoded
+
+        try:
+            entry.encoded = self._encode(
+                hub_frame, transform_func, quality, width
+            )
+        finally:
+            if entry.encoded is None:
+                # 失敗した結果は保持しない
+                with self._lock:
+                    if self._entries.get(key) is entry:
+                        del self._entries[key]
+            entry.ready.set()
+        return entry.encoded
+
+    def _encode(
+        self,
+        hub_frame: HubFrame,
+        transform_func: Optional[Callable[[cv2.Mat], cv2.Mat]],
+        quality: Optional[int],
+        width: Optional[int],
+    ) -> Optional[EncodedFrame]:
+        frame = hub_frame.image
+
+        # 縮小
+        if width and width < frame.shape[1]:
+            height = round(frame.shape[0] * width / frame.shape[1])
+            frame = cv2.resize(frame, (width, height), interpolation=cv2.INTER_AREA)
+
+        # 画像変換
+        if transform_func:
+            frame = transform_func(frame)
+
+        params = [] if quality is None else [cv2.IMWRITE_JPEG_QUALITY, quality]
+        ret, buffer = cv2.imencode(".jpg", frame, params)
+        if not ret:
+            return None
+
+        jpeg = buffer.tobytes()
+        return EncodedFrame(
+            hub_frame.seq,
+            jpeg,
+            _multipart_header(hub_frame.seq, len(jpeg)) + jpeg + MULTIPART_FOOTER,
+        )
@@ -0,0 +1,70 @@
+import threading
+from typing import Callable
+
+from src.camera.frame_hub import HubFrame
+
+"""
+動体検知による推論の間引き
+映像に変化が無い間は重い推論(顔・表情・物体検出)を行わず、直前の結果を使い回す
+"""
+
+
+class MotionGate:
+    """
+    フレーム毎に推論が必要かを判定するゲート。次の場合に推論する。
+    - 動体を検知したフレームと、最後に検知してからhold秒以内のフレーム
+    - 最後の推論からkeepalive秒経ったフレーム (静止した人物などの結果を更新する)
+    - まだ推論結果が無い場合
+    detect_motion(hub_frame)は動体の有無を返す関数 (MyCamera.detect_motionなど)。
+    """
+
+    def __init__(
+        self,
+        detect_motion: Callable[[HubFrame], bool],
+        keepalive: float = 30.0,
+        hold: float = 2.0,
+    ):
+        self._detect_motion = detect_motion
+        self.keepalive = keepalive
+        self.hold = hold
+
+        self._lock = threading.Lock()
+        self._last_motion = 0.0
+        self._last_run = 0.0
+
+        # 統計
+        self._passed = 0
+        self._blocked = 0
+
+    def should_run(self, hub_frame: HubFrame, has_result: bool = True) -> bool:
+        """
+        hub_frameで推論すべきかを返す。Trueを返した場合は推論したものとして記録する。
+        """
+        motion = self._detect_motion(hub_frame)
+        now = hub_frame.timestamp
+        with self._lock:
+            if motion:
+                self._last_motion = now
+            run = (
+                not has_result
+                or now - self._last_motion <= self.hold
+                or now - self._last_run >= self.keepalive
+            )
+            if run:
+                self._last_run = now
+                self._passed += 1
+            else:
+                self._blocked += 1
+            return run
+
+    def stats(self) -> dict:
+        with self._lock:
+            total = self._passed + self._blocked
+            return {
+                "keepalive": self.keepalive,
+                "hold": self.hold,
+                "passed": self._passed,
+                "blocked": self._blocked,
+                "blocked_ratio": self._blocked / total if total else 0.0,
+                "last_motion": self._last_motion or None,
+            }
@@ -3,7 +3,15 @@ import threading
 import time
 import logging
 from onvif import ONVIFCamera
-from typing import Callable, Generator, Optional, Dict
+from typing import Callable, Generator, List, Optional, Dict, Tuple
+
+from src.camera.frame_hub import FrameHub, HubFrame
+from src.camera.jpeg_cache import JpegCache
+from src.camera.clip_recorder import ClipRecorder
+from src.camera.ptz_service import PTZService
+from src.camera.ptz_worker import PAN_TILT_VELOCITIES, PTZWorker
+from src.camera.inference_scheduler import InferenceScheduler
+from src.image_processor.motion import MotionDetector, MotionZone
 
 logger = logging.getLogger("uvicorn")
 
@@ -17,6 +25,13 @@ class MyCamera:
         port: int = 554,
         stream_path: str = "stream1",
         onvif_port: int = 2020,
+        snapshot_max_staleness: float = 1.0,
+        capture_linger: float = 30.0,
+        motion_zones: Optional[List[MotionZone]] = None,
+        clip_dir: Optional[str] = None,
+        clip_pre_seconds: float = 5.0,
+        clip_post_seconds: float = 10.0,
+        clip_buffer_bytes: int = 64 * 1024 * 1024,
     ):
         # カメラ接続用
         self.ip_address = ip_address
@@ -34,8 +49,58 @@ class MyCamera:
         # 動体検知用の状態
         self.is_motion = False
         self.last_motion_time = None
-        self.prev_frame = None
-        self.prev_frame_time = 0
+        self.motion_detector = MotionDetector(zones=motion_zones)
+        # 検知エリア毎の状態 (name, active, ratio)
+        self.motion_zones: List[dict] = []
+        # 動体がある場合に変化した範囲 (x1, y1, x2, y2。画像に対する比率)
+        self.motion_region: Optional[Tuple[float, float, float, float]] = None
+        # 動体検知済みのフレーム連番 (複数の視聴者から同じフレームを二重に検知しない)
+        self._motion_seq = 0
+        self._motion_lock = threading.Lock()
+
+        # スナップショットとして許容する最新フレームの古さ(秒)
+        self.snapshot_max_staleness = snapshot_max_staleness
+
+        # 全コンシューマで共有するフレームハブ (RTSP接続は1本のみ)
+        self.hub = FrameHub(self._open_capture, linger=capture_linger)
+
+        # 変換・エンコード結果を視聴者間で共有するキャッシュ
+        self.jpeg_cache = JpegCache()
+
+        # PTZ操作 (ONVIFの接続は最初の操作時に作成し、使い回す)
+        self.ptz = PTZService(self._connect_onvif_camera)
+        # パン・チルトの指示を非同期に実行するワーカー
+        self.ptz_worker = PTZWorker(self.ptz)
+
+        # 動体検知をきっかけにした録画 (clip_dir未指定の場合は録画しない)
+        self.clip_recorder: Optional[ClipRecorder] = None
+        if clip_dir:
+            self.clip_recorder = ClipRecorder(
+                self.hub,
+                self.jpeg_cache,
+                self.detect_motion,
+                clip_dir,
+                pre_seconds=clip_pre_seconds,
+                post_seconds=clip_post_seconds,
+                buffer_bytes=clip_buffer_bytes,
+            )
+
+    def start_recording(self):
+        """
+        録画を開始する。録画中はハブを購読し続けるため、RTSP接続は常に開いたままになる。
+        """
+        if self.clip_recorder is not None:
+            self.clip_recorder.start()
+
+    def close(self):
+        """
+        PTZのワーカー・位置の取得・録画・フレームハブを停止し、RTSP接続を閉じる。
+        """
+        self.ptz_worker.stop()
+        self.ptz.stop_status_polling()
+        if self.clip_recorder is not None:
+            self.clip_recorder.stop()
+        self.hub.stop()
 
     def _open_capture(self) -> Optional[cv2.VideoCapture]:
         """
@@ -49,48 +114,58 @@ class MyCamera:
             return None
         return cap
 
-    def _read_latest_frame(self, cap: cv2.VideoCapture) -> Optional[cv2.Mat]:
+    def get_latest_frame(
+        self, max_staleness: Optional[float] = None, timeout: float = 10.0
+    ) -> Optional[HubFrame]:
         """
-        古いフレームを捨てて最新のフレームを取得する。
-        取得できなければNoneを返す。
+        ハブが保持する最新フレームを返す。
+        max_staleness秒より新しいフレームがあればコピーせずそのまま返し、
+        無ければハブを購読して(キャプチャが止まっていれば開いて)次のフレームを待つ。
+        購読解除後もキャプチャはlinger秒間温めておくため、連続したスナップショットは
+        RTSP接続を開き直さない。
         """
-        success = False
-        frame = None
-        for _ in range(5):
-            success, frame = cap.read()
-        if not success:
-            return None
-        return frame
+        if max_staleness is None:
+            max_staleness = self.snapshot_max_staleness
+
+        hub_frame = self.hub.latest()
+        if hub_frame is not None and time.time() - hub_frame.timestamp <= max_staleness:
+            return hub_frame
+
+        after_seq = hub_frame.seq if hub_frame is not None else 0
+        with self.hub.subscription():
+            return self.hub.wait_frame(after_seq, timeout=timeout)
 
-    def get_frame(self, transform_func=None, extract_func=None):
+    def get_frame(
+        self,
+        transform_func=None,
+        extract_func=None,
+        max_staleness=None,
+        transform_name=None,
+    ):
         """
         最新の1フレームをJPEGエンコードして返す。
         transform_funcが指定されていればフレームに適用する。
+        extract_funcが指定されていれば変換前のフレームから特徴を抽出する。
+        フレームはハブの最新フレームを使うため、配信中であれば新たなRTSP接続は開かない。
+        同じフレーム・変換のエンコード結果はストリーミングと共有する。
         """
-        cap = self._open_capture()
-        if cap is None:
+        hub_frame = self.get_latest_frame(max_staleness)
+        if hub_frame is None:
             return None, None
 
-        frame = self._read_latest_frame(cap)
-        cap.release()
-
-        if frame is None:
+        # 画像変換・エンコード
+        encoded = self.jpeg_cache.get(
+            hub_frame, transform_name=transform_name, transform_func=transform_func
+        )
+        if encoded is None:
             return None, None
 
-        # 画像変換
-        if transform_func:
-            frame = transform_func(frame)
-
-        ret, buffer = cv2.imencode(".jpg", frame)
-        if not ret:
-            return None
-
         # 特徴抽出
         features = None
         if extract_func:
-            features = extract_func(frame)
+            features = extract_func(hub_frame.image)
 
-        return buffer.tobytes(), features
+        return encoded.jpeg, features
 
     def frame_generator(
         self,
@@ -98,16 +173,39 @@ class MyCamera:
         enable_motion_detection: bool = False,
         transform_func: Optional[Callable[[cv2.Mat], cv2.Mat]] = None,
         max_seconds: int = 604800,
+        transform_name: Optional[str] = None,
+        quality: Optional[int] = None,
+        width: Optional[int] = None,
+        scheduler: Optional[InferenceScheduler] = None,
+        max_fps: Optional[float] = None,
     ) -> Generator[bytes, None, None]:
         """
         ストリーミング用のフレームを連続で返すジェネレータ。
         stop_eventがセットされるまで、またはmax_secondsを超えるまでフレームを取得し続ける。
         transform_funcが指定されていればフレームに適用する。
-        5秒おきにprev_frameを格納し、現在のフレームと差があるときのみis_motionフラグをTrueにする。
+        quality(JPEG品質)、width(幅)が指定されていれば、その画質でエンコードする。
+        変換・エンコード結果はtransform_name・画質が同じ視聴者間で共有し、各フレーム1度だけ処理する。
+        schedulerが指定されていれば、推論はスケジューラに任せて最新の推論結果を描画する
+        (transform_func・transform_nameより優先する)。
+        max_fpsが指定されていれば、配信するフレームをそのレートまで間引く。
+        enable_motion_detection=Trueの場合、各フレームを背景モデルと比較し、差があるときのみ
+        is_motionフラグをTrueにする。
+        フレームはハブから購読するため、視聴者が増えてもRTSP接続とデコードは1本分で済む。
         """
-        cap = self._open_capture()
-        if cap is None:
+        if scheduler is not None:
+            transform_func = scheduler.render
+            transform_name = scheduler.name
+
+        self.hub.subscribe()
+
+        # 最初のフレームが届かなければ接続できていないとみなす
+        hub_frame = self.hub.wait_frame(0, timeout=10.0)
+        if hub_frame is None:
+            self.hub.unsubscribe()
             raise RuntimeError("RTSPストリームを開けませんでした")
+        last_seq = hub_frame.seq - 1
+        min_interval = 1.0 / max_fps if max_fps else 0.0
+        last_sent_time = 0.0
 
         start_time = time.time()
 
@@ -122,73 +220,66 @@ class MyCamera:
                     )
                     break
 
-                frame = self._read_latest_frame(cap)
-                if frame is None:
+                hub_frame = self.hub.wait_frame(last_seq, timeout=1.0)
+                if hub_frame is None:
                     continue
-                
+                last_seq = hub_frame.seq
 
-                if self.prev_frame is None:
-                    # 初期化
-                    self.prev_frame = frame.copy()
-                    self.prev_frame_time = time.time()
-                    continue
-                
                 # 動体検知
                 if enable_motion_detection:
-                    current_time = time.time()
-                    if (current_time - self.prev_frame_time) >= 5:
-                        # 現在のフレームとprev_frameを白黒化、ぼかし
-                        prev_gray = cv2.cvtColor(self.prev_frame, cv2.COLOR_BGR2GRAY)
-                        curr_gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
-                        prev_gray = cv2.GaussianBlur(prev_gray, (21, 21), 0)
-                        curr_gray = cv2.GaussianBlur(curr_gray, (21, 21), 0)
-
-                        # フレーム間の差分抽出
-                        frame_delta = cv2.absdiff(prev_gray, curr_gray)
-                        _, thresh_img = cv2.threshold(
-                            frame_delta, 50, 255, cv2.THRESH_BINARY
-                        )
-                        contours, _ = cv2.findContours(
-                            thresh_img, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE
-                        )
-                        
-                        # 十分な大きさの動体があれば、is_motionをTrueに
-                        self.is_motion = False
-                        for cnt in contours:
-                            if cv2.contourArea(cnt) > 5000:
-                                self.is_motion = True
-                                break
-
-                        if self.is_motion:
-                            self.last_motion_time = current_time
-
-                        # 最後に時間とフレームをを更新する
-                        self.prev_frame = frame.copy()
-                        self.prev_frame_time = current_time
-
-                # リアルタイムの画像変換
-                if transform_func:
-                    frame = transform_func(frame)
-
-                ret, buffer = cv2.imencode(".jpg", frame)
-                if not ret:
-                    continue
+                    self.detect_motion(hub_frame)
 
-                frame_bytes = buffer.tobytes()
-                yield (
-                    b"--frame\r\nContent-Type: image/jpeg\r\n\r\n"
-                    + frame_bytes
-                    + b"\r\n"
+                if hub_frame.timestamp - last_sent_time < min_interval:
+                    continue
+                last_sent_time = hub_frame.timestamp
+
+                # 推論候補として登録 (推論自体は別スレッドで行う)
+                if scheduler is not None:
+                    scheduler.submit(hub_frame)
+
+                # リアルタイムの画像変換・エンコード (キャッシュ済みなら再利用)
+                encoded = self.jpeg_cache.get(
+                    hub_frame,
+                    transform_name=transform_name,
+                    transform_func=transform_func,
+                    quality=quality,
+                    width=width,
                 )
+                if encoded is None:
+                    continue
+
+                yield encoded.chunk
         finally:
-            cap.release()
-            logger.info("RTSP connection closed (generator finished)")
+            self.hub.unsubscribe()
+            logger.info("Stream subscriber left (generator finished)")
 
             # リセット
-            self.prev_frame = None
-            self.prev_frame_time = 0
-            self.is_motion = False
-            self.last_motion_time = None
+            if enable_motion_detection:
+                with self._motion_lock:
+                    self.motion_detector.reset()
+                    self.is_motion = False
+                    self.last_motion_time = None
+                    self.motion_zones = []
+                    self.motion_region = None
+
+    def detect_motion(self, hub_frame: HubFrame) -> bool:
+        """
+        フレームを動体検知にかけ、is_motionとlast_motion_timeを更新してis_motionを返す。
+        同じフレームは1度だけ検知する (録画・配信・推論のゲートで背景モデルを共有する)。
+        複数のスレッドから呼ばれるため、背景の更新と状態の書き込みはロック内で行い、
+        古いフレームの結果で新しい状態を上書きしない。
+        """
+        with self._motion_lock:
+            if hub_frame.seq <= self._motion_seq:
+                return self.is_motion
+            self._motion_seq = hub_frame.seq
+
+            self.is_motion, self.motion_zones, self.motion_region = (
+                self.motion_detector.analyze_region(hub_frame.image)
+            )
+            if self.is_motion:
+                self.last_motion_time = hub_frame.timestamp
+            return self.is_motion
 
     """
     以下、PTZ制御用の関数
@@ -206,47 +297,33 @@ class MyCamera:
             raise RuntimeError("ONVIFカメラに接続できません")
         return mycam
 
-    def move_initial_position(self):
-        # ONVIFカメラに接続
-        mycam = self._connect_onvif_camera()
-
-        # PTZサービスを取得
-        ptz = mycam.create_ptz_service()
-
-        # プリセットポジションの一覧を取得
-        presets = ptz.GetPresets({"ProfileToken": "profile1"})
-        for preset in presets:
-            print(f"Preset Name: {preset.Name}, Token: {preset.token}")
+    def move_initial_position(self, name: Optional[str] = None):
+        """
+        プリセットポジションに移動する。nameが無ければ最初のプリセットを使う。
+        プリセットが見つからなければRuntimeErrorを発生させる。
+        """
+        # プリセットポジションの一覧を取得 (一覧はキャッシュしたものを使う)
+        if name is None:
+            presets = self.ptz.get_presets()
+            preset = presets[0] if presets else None
+        else:
+            preset = self.ptz.find_preset(name)
+        if preset is None:
+            raise RuntimeError("プリセットポジションが見つかりません")
 
         # カメラをプリセットポジションに移動
-        if presets:
-            preset_token = presets[0].token  # 最初のプリセットを使用
-            ptz.GotoPreset({"ProfileToken": "profile1", "PresetToken": preset_token})
-        else:
-            print("プリセットポジションが見つかりません")
+        self.ptz_worker.cancel()
+        self.ptz.goto_preset(preset["token"])
 
     def pan_tilt(self, dir, duration=0.2):
-        # ONVIFカメラに接続
-        mycam = self._connect_onvif_camera()
-
+        """
+        移動が終わるまで待つパン・チルト。
+        APIからはptz_worker.submit()を使い、呼び出し元を待たせないこと。
+        """
         # 移動方向に応じたパン・チルトの速度を設定
-        # (速度設定1.0以外では異音が出る。回転角はtimesecで調整すること)
-        if dir == "up":
-            x, y = 0.0, 1.0
-        elif dir == "down":
-            x, y = 0.0, -1.0
-        elif dir == "left":
-            x, y = -1.0, 0.0
-        elif dir == "right":
-            x, y = 1.0, 0.0
-
-        # PTZサービスを取得
-        ptz = mycam.create_ptz_service()
+        x, y = PAN_TILT_VELOCITIES[dir]
 
         # カメラをパン・チルト
-        request = ptz.create_type("ContinuousMove")
-        request.ProfileToken = "profile1"
-        request.Velocity = {"PanTilt": {"x": x, "y": y}, "Zoom": {"x": 0.0}}
-        ptz.ContinuousMove(request)
+        self.ptz.continuous_move(x, y)
         time.sleep(duration)  # 移動時間
-        ptz.Stop({"ProfileToken": "profile1"})
+        self.ptz.stop()
@@ -0,0 +1,316 @@
+import threading
+import time
+import logging
+from typing import Any, Callable, List, Optional
+
+logger = logging.getLogger("uvicorn")
+
+"""
+ONVIFのPTZ操作
+ONVIFCameraの作成(WSDLの解析・SOAPの接続)とPTZサービスの作成は重いため、
+1度だけ行って使い回し、失敗した時だけ接続し直す
+"""
+
+
+class _Session:
+    """
+    接続済みのONVIFカメラと、その上に作ったPTZサービス・使い回すリクエスト
+    """
+
+    def __init__(self, camera, profile_token: str):
+        self.camera = camera
+        self.ptz = camera.create_ptz_service()
+        # ContinuousMoveのリクエストは1度だけ作り、速度だけ差し替えて使う
+        self.move_request = self.ptz.create_type("ContinuousMove")
+        self.move_request.ProfileToken = profile_token
+        self.created_at = time.time()
+        self._profile_token = profile_token
+        self._requests = {"ContinuousMove": self.move_request}
+
+    def request(self, name: str):
+        """
+        リクエスト型を初回だけ作成して使い回す (AbsoluteMoveなど)
+        """
+        if name not in self._requests:
+            request = self.ptz.create_type(name)
+            request.ProfileToken = self._profile_token
+            self._requests[name] = request
+        return self._requests[name]
+
+
+def _parse_status(status) -> dict:
+    """
+    GetStatusの結果から位置と移動状態を取り出す
+    """
+    position = getattr(status, "Position", None)
+    pan_tilt = getattr(position, "PanTilt", None)
+    zoom = getattr(position, "Zoom", None)
+    move_status = getattr(status, "MoveStatus", None)
+    return {
+        "pan": getattr(pan_tilt, "x", None),
+        "tilt": getattr(pan_tilt, "y", None),
+        "zoom": getattr(zoom, "x", None),
+        "move_status": getattr(move_status, "PanTilt", None),
+        "updated_at": time.time(),
+    }
+
+
+class PTZService:
+    """
+    ONVIFの接続とPTZサービスを遅延作成して保持するクライアント。
+    呼び出しに失敗した場合は接続を破棄し、1度だけ接続し直して再実行する。
+    PTZ操作はカメラ1台に対して順番に行うため、全ての呼び出しをロックで直列化する。
+
+    connectはONVIFCameraを返す関数 (接続できなければ例外を送出する)。
+    位置・プリセットのキャッシュと接続の状態は別の軽いロックで守るため、
+    SOAPの呼び出し中や再接続中でもposition()などはすぐに返る。
+    """
+
+    def __init__(
+        self,
+        connect: Callable[[], Any],
+        profile_token: str = "profile1",
+        health_interval: float = 60.0,
+    ):
+        self._connect = connect
+        self.profile_token = profile_token
+        self._health_interval = health_interval
+
+        self._session: Optional[_Session] = None
+        # SOAPの呼び出し(と再接続)を直列化するロック
+        self._lock = threading.RLock()
+        # キャッシュと接続の状態を守るロック (SOAPの呼び出し中は保持しない)
+        self._cache_lock = threading.Lock()
+        self._last_ok = 0.0
+        self._last_error: Optional[str] = None
+
+        # プリセット一覧のキャッシュ (プリセットの登録・削除・再接続時に破棄する)
+        self._presets: Optional[List[dict]] = None
+        # キャッシュを破棄した回数 (取得中に破棄された古い一覧を保存しないため)
+        self._presets_version = 0
+        # 定期的にGetStatusで取得した位置のキャッシュ
+        self._position: Optional[dict] = None
+        self._poll_stop_event = threading.Event()
+        self._poll_thread: Optional[threading.Thread] = None
+
+    def _get_session(self) -> _Session:
+        if self._session is None:
+            start = time.time()
+            self._session = _Session(self._connect(), self.profile_token)
+            logger.info("ONVIFカメラに接続しました (%.2f秒)", time.time() - start)
+        return self._session
+
+    def invalidate(self):
+        """
+        保持している接続を破棄する。次の呼び出しで接続し直す。
+        """
+        with self._lock:
+            self._session = None
+        self._invalidate_presets()
+
+    def _invalidate_presets(self):
+        with self._cache_lock:
+            self._presets = None
+            self._presets_version += 1
+
+    def call(self, func: Callable[[_Session], Any]) -> Any:
+        """
+        接続済みのセッションでfuncを実行する。
+        失敗した場合は接続し直して1度だけ再実行し、それでも失敗すればRuntimeErrorを送出する。
+        """
+        with self._lock:
+            for attempt in range(2):
+                try:
+                    result = func(self._get_session())
+                except Exception as e:
+                    self._session = None
+                    self._invalidate_presets()
+                    with self._cache_lock:
+                        self._last_error = str(e)
+                    if attempt == 0:
+                        logger.warning("PTZの操作に失敗したため接続し直します: %s", e)
+                        continue
+                    raise RuntimeError(f"PTZの操作に失敗しました: {e}") from e
+                with self._cache_lock:
+                    self._last_ok = time.time()
+                    self._last_error = None
+                return result
+
+    def continuous_move(self, x: float, y: float, zoom: float = 0.0):
+        def move(session: _Session):
+            session.move_request.Velocity = {
+                "PanTilt": {"x": x, "y": y},
+                "Zoom": {"x": zoom},
+            }
+            session.ptz.ContinuousMove(session.move_request)
+
+        self.call(move)
+
+    def stop(self):
+        self.call(
+            lambda session: session.ptz.Stop({"ProfileToken": self.profile_token})
+        )
+
+    def absolute_move(self, pan: float, tilt: float, zoom: Optional[float] = None):
+        """
+        指定した位置(-1.0〜1.0)へ移動する
+        """
+
+        def move(session: _Session):
+            request = session.request("AbsoluteMove")
+            request.Position = {"PanTilt": {"x": pan, "y": tilt}}
+            if zoom is not None:
+                request.Position["Zoom"] = {"x": zoom}
+            session.ptz.AbsoluteMove(request)
+
+        self.call(move)
+
+    def relative_move(self, pan: float, tilt: float, zoom: Optional[float] = None):
+        """
+        現在の位置から指定した量だけ移動する
+        """
+
+        def move(session: _Session):
+            request = session.request("RelativeMove")
+            request.Translation = {"PanTilt": {"x": pan, "y": tilt}}
+            if zoom is not None:
+                request.Translation["Zoom"] = {"x": zoom}
+            session.ptz.RelativeMove(request)
+
+        self.call(move)
+
+    def get_presets(self) -> List[dict]:
+        """
+        プリセットの一覧を{"token", "name"}のリストで返す (取得結果はキャッシュする)
+        """
+        with self._cache_lock:
+            if self._presets is not None:
+                return list(self._presets)
+            version = self._presets_version
+
+        presets = self.call(
+            lambda session: session.ptz.GetPresets({"ProfileToken": self.profile_token})
+        )
+        presets = [
+            {"token": preset.token, "name": preset.Name} for preset in presets or []
+        ]
+        with self._cache_lock:
+            # 取得中に登録・削除・再接続があれば、古い一覧はキャッシュしない
+            if self._presets_version == version:
+                self._presets = presets
+        return list(presets)
+
+    def find_preset(self, name: str) -> Optional[dict]:
+        for preset in self.get_presets():
+            if preset["name"] == name:
+                return preset
+        return None
+
+    def goto_preset(self, preset_token: str):
+        self.call(
+            lambda session: session.ptz.GotoPreset(
+                {"ProfileToken": self.profile_token, "PresetToken": preset_token}
+            )
+        )
+
+    def set_preset(self, name: str) -> str:
+        """
+        現在の位置を名前付きのプリセットとして登録し、トークンを返す。
+        同じ名前のプリセットがあれば上書きする。
+        """
+        # 同じ名前の確認と登録の間に他の操作が入らないよう、SOAPのロックを通して保持する
+        with self._lock:
+            params = {"ProfileToken": self.profile_token, "PresetName": name}
+            existing = self.find_preset(name)
+            if existing is not None:
+                params["PresetToken"] = existing["token"]
+            try:
+                return self.call(lambda session: session.ptz.SetPreset(params))
+            finally:
+                self._invalidate_presets()
+
+    def remove_preset(self, preset_token: str):
+        try:
+            self.call(
+                lambda session: session.ptz.RemovePreset(
+                    {"ProfileToken": self.profile_token, "PresetToken": preset_token}
+                )
+            )
+        finally:
+            self._invalidate_presets()
+
+    def get_status(self) -> dict:
+        """
+        GetStatusでカメラに問い合わせて位置を返し、キャッシュを更新する
+        """
+        status = self.call(
+            lambda session: session.ptz.GetStatus({"ProfileToken": self.profile_token})
+        )
+        position = _parse_status(status)
+        with self._cache_lock:
+            self._position = position
+        return position
+
+    def position(self) -> Optional[dict]:
+        """
+        キャッシュした位置を返す (カメラには問い合わせない)。未取得ならNoneを返す。
+        """
+        with self._cache_lock:
+            return dict(self._position) if self._position is not None else None
+
+    def start_status_polling(self, interval: float = 2.0):
+        """
+        interval秒毎にGetStatusで位置を取得し、キャッシュするスレッドを開始する
+        """
+        with self._cache_lock:
+            if self._poll_thread is not None or interval <= 0:
+                return
+            self._poll_stop_event = threading.Event()
+            self._poll_thread = threading.Thread(
+                target=self._poll_status,
+                args=(self._poll_stop_event, interval),
+                daemon=True,
+            )
+            self._poll_thread.start()
+
+    def stop_status_polling(self):
+        with self._cache_lock:
+            thread, self._poll_thread = self._poll_thread, None
+            self._poll_stop_event.set()
+        if thread is not None:
+            thread.join(timeout=5.0)
+
+    def _poll_status(self, stop_event: threading.Event, interval: float):
+        while not stop_event.is_set():
+            try:
+                self.get_status()
+            except RuntimeError as e:
+                logger.warning("PTZの位置を取得できませんでした: %s", e)
+            stop_event.wait(interval)
+
+    def health_check(self, force: bool = False) -> dict:
+        """
+        接続の状態を返す。接続済みで直近health_interval秒以内の呼び出しが成功していれば
+        通信せずに正常とし、そうでなければ(またはforce=Trueなら)GetStatusで確認する。
+        """
+        with self._cache_lock:
+            recently_ok = (
+                self._session is not None
+                and self._last_error is None
+                and time.time() - self._last_ok < self._health_interval
+            )
+        if recently_ok and not force:
+            healthy = True
+        else:
+            try:
+                self.get_status()
+                healthy = True
+            except RuntimeError:
+                healthy = False
+        with self._cache_lock:
+            return {
+                "healthy": healthy,
+                "connected": self._session is not None,
+                "last_ok": self._last_ok or None,
+                "last_error": self._last_error,
+            }
@@ -0,0 +1,204 @@
+import itertools
+import threading
+import time
+import logging
+from collections import OrderedDict, deque
+from typing import Deque, Optional
+
+from src.camera.ptz_service import PTZService
+
+logger = logging.getLogger("uvicorn")
+
+"""
+PTZ操作の非同期実行
+パン・チルトの指示をキューに積み、専用のワーカースレッドで順に実行する
+"""
+
+# 移動方向ごとのパン・チルトの速度
+# (速度設定1.0以外では異音が出る。回転角は移動時間で調整すること)
+PAN_TILT_VELOCITIES = {
+    "up": (0.0, 1.0),
+    "down": (0.0, -1.0),
+    "left": (-1.0, 0.0),
+    "right": (1.0, 0.0),
+}
+
+OPPOSITE_DIRECTIONS = {"up": "down", "down": "up", "left": "right", "right": "left"}
+
+
+class _Command:
+    def __init__(self, command_id: str, direction: str, duration: float):
+        self.id = command_id
+        self.direction = direction
+        self.duration = duration
+        # queued / running / merged / done / cancelled / failed
+        self.status = "queued"
+        self.merged_into: Optional[str] = None
+        self.error: Optional[str] = None
+        self.created_at = time.time()
+
+    def to_dict(self) -> dict:
+        return {
+            "id": self.id,
+            "direction": self.direction,
+            "duration": self.duration,
+            "status": self.status,
+            "merged_into": self.merged_into,
+            "error": self.error,
+        }
+
+
+class PTZWorker:
+    """
+    パン・チルトの指示を受け付けて即座にIDを返し、ワーカースレッドで実行するキュー。
+    - 実行中(または最後に積んだ)指示と同じ方向の指示は、1つの長い移動にまとめる
+    - 実行中の移動と逆方向の指示は、実行中の移動と積まれた指示を取り消して実行する
+    - それ以外の方向の指示は順番に実行する
+    SOAPの呼び出しと移動の待ち時間はワーカースレッドで行うため、配信などを止めない。
+    """
+
+    def __init__(self, ptz: PTZService, history: int = 256):
+        self._ptz = ptz
+        self._history = history
+
+        self._cond = threading.Condition()
+        self._queue: Deque[_Command] = deque()
+        self._commands: "OrderedDict[str, _Command]" = OrderedDict()
+        self._current: Optional[_Command] = None
+        self._end_time = 0.0
+        self._cancel_current = False
+        self._ids = itertools.count(1)
+        self._stop_event = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self):
+        with self._cond:
+            if self._thread is not None:
+                return
+            self._stop_event = threading.Event()
+            self._thread = threading.Thread(
+                target=self._run, args=(self._stop_event,), daemon=True
+            )
+            self._thread.start()
+
+    def stop(self):
+        with self._cond:
+            thread, self._thread = self._thread, None
+            self._stop_event.set()
+            self._cond.notify_all()
+        if thread is not None:
+            thread.join(timeout=5.0)
+
+    def submit(self, direction: str, duration: float) -> str:
+        """
+        移動の指示を積み、指示のIDを返す (移動の完了は待たない)
+        """
+        if direction not in PAN_TILT_VELOCITIES:
+            raise ValueError(f"不正な方向です: {direction}")
+
+        with self._cond:
+            command = _Command(str(next(self._ids)), direction, duration)
+            self._remember(command)
+
+            tail = self._queue[-1] if self._queue else self._current
+            current = self._current
+            if tail is not None and tail.direction == direction and not (
+                tail is current and self._cancel_current
+            ):
+                # 同じ方向の連続した指示は1つの移動にまとめる
+                command.status = "merged"
+                command.merged_into = tail.id
+                tail.duration += duration
+                if tail is current:
+                    self._end_time += duration
+            else:
+                if current is not None and OPPOSITE_DIRECTIONS[direction] == (
+                    current.direction
+                ):
+                    # 逆方向の指示は実行中の移動と積まれた指示を取り消す
+                    self._cancel_current = True
+                    for queued in self._queue:
+                        queued.status = "cancelled"
+                    self._queue.clear()
+                self._queue.append(command)
+
+            self._cond.notify_all()
+            return command.id
+
+    def cancel(self, timeout: float = 2.0) -> bool:
+        """
+        実行中の移動と積まれた指示を全て取り消し、移動が止まるまで最大timeout秒待つ。
+        (絶対位置への移動の前などに呼び、後から停止の指示が届かないようにする)
+        止まればTrueを返す。
+        """
+        with self._cond:
+            if self._current is not None:
+                self._cancel_current = True
+            for queued in self._queue:
+                queued.status = "cancelled"
+            self._queue.clear()
+            self._cond.notify_all()
+            return self._cond.wait_for(lambda: self._current is None, timeout)
+
+    def status(self, command_id: str) -> Optional[dict]:
+        """
+        指示の状態を返す。古くて保持していない指示はNoneを返す。
+        """
+        with self._cond:
+            command = self._commands.get(command_id)
+            return command.to_dict() if command is not None else None
+
+    def _remember(self, command: _Command):
+        self._commands[command.id] = command
+        while len(self._commands) > self._history:
+            self._commands.popitem(last=False)
+
+    def _run(self, stop_event: threading.Event):
+        while True:
+            with self._cond:
+                if self._current is None:
+                    self._cond.wait_for(lambda: self._queue or stop_event.is_set())
+                    if stop_event.is_set():
+                        return
+                    command = self._queue.popleft()
+                    command.status = "running"
+                    self._current = command
+                    self._cancel_current = False
+                    action = "start"
+                else:
+                    command = self._current
+                    remaining = self._end_time - time.time()
+                    if stop_event.is_set() or self._cancel_current:
+                        action = "cancel"
+                    elif remaining <= 0:
+                        action = "finish"
+                    else:
+                        self._cond.wait(remaining)
+                        continue
+
+            # SOAPの呼び出しはロックの外で行い、その間も指示を受け付ける
+            try:
+                if action == "start":
+                    self._ptz.continuous_move(*PAN_TILT_VELOCITIES[command.direction])
+                else:
+                    self._ptz.stop()
+                error = None
+            except Exception as e:
+                logger.warning("PTZの操作に失敗しました: %s", e)
+                error = str(e)
+
+            with self._cond:
+                if action == "start" and error is None:
+                    # 移動時間は実際に動き出した時点から数える (待ちの間にまとめた分を含む)
+                    self._end_time = time.time() + command.duration
+                    continue
+                if error is not None:
+                    command.status = "failed"
+                    command.error = error
+                else:
+                    command.status = "cancelled" if action == "cancel" else "done"
+                self._current = None
+                self._cancel_current = False
+                self._cond.notify_all()
+                if stop_event.is_set():
+                    return
@@ -11,3 +11,47 @@ IP_ADDRESS = os.environ["IP_ADDRESS"]
 PORT = os.environ["PORT"]
 STREAM = os.environ.get("STREAM")
 ONVIF_PORT = os.environ["ONVIF_PORT"]
+
+# スナップショットとして許容する最新フレームの古さ(秒)
+SNAPSHOT_MAX_STALENESS = float(os.environ.get("SNAPSHOT_MAX_STALENESS", 1.0))
+# 視聴者がいなくなってからRTSP接続を維持する時間(秒)
+CAPTURE_LINGER_SECONDS = float(os.environ.get("CAPTURE_LINGER_SECONDS", 30.0))
+# スナップショット用に保持するFaceMeshエンジンの最大数
+FACE_MESH_POOL_SIZE = int(os.environ.get("FACE_MESH_POOL_SIZE", 2))
+# 顔検出する最大人数
+MAX_NUM_FACES = int(os.environ.get("MAX_NUM_FACES", 1))
+# ストリーミングでクライアント毎に溜めておくフレーム数 (超えた分は古い順に捨てる)
+STREAM_QUEUE_SIZE = int(os.environ.get("STREAM_QUEUE_SIZE", 2))
+# 配信時に推論するフレームの間隔 (0の場合は推論が終わり次第最新のフレームで推論する)
+INFERENCE_EVERY_N = int(os.environ.get("INFERENCE_EVERY_N", 0))
+# 動体検知のエリア (JSON。座標は画像の幅・高さに対する比率。未指定の場合は画像全体)
+# 例: [{"name": "door", "points": [[0.1, 0.2], [0.4, 0.2], [0.4, 0.9]]},
+#      {"name": "tv", "points": [[0.6, 0.1], [0.9, 0.1], [0.9, 0.4], [0.6, 0.4]], "exclude": true}]
+MOTION_ZONES = os.environ.get("MOTION_ZONES", "")
+# PTZの位置を取得する間隔(秒) (0の場合は取得しない)
+PTZ_STATUS_INTERVAL = float(os.environ.get("PTZ_STATUS_INTERVAL", 2.0))
+# 動体検知時の録画の保存先 (未指定の場合は録画しない)
+CLIP_DIR = os.environ.get("CLIP_DIR", "")
+# 録画に含める検知前・最後の検知後の秒数
+CLIP_PRE_SECONDS = float(os.environ.get("CLIP_PRE_SECONDS", 5.0))
+CLIP_POST_SECONDS = float(os.environ.get("CLIP_POST_SECONDS", 10.0))
+# 検知前のフレームを保持するバッファの大きさ(MB)
+CLIP_BUFFER_MB = int(os.environ.get("CLIP_BUFFER_MB", 64))
+# 物体検出の推論スレッド数 (スレッド毎にモデルを保持する)
+DETECTION_WORKERS = int(os.environ.get("DETECTION_WORKERS", 2))
+# 物体検出で1回にまとめて推論する最大枚数と、まとめるために待つ最大時間(ミリ秒)
+DETECTION_MAX_BATCH = int(os.environ.get("DETECTION_MAX_BATCH", 4))
+DETECTION_MAX_WAIT_MS = float(os.environ.get("DETECTION_MAX_WAIT_MS", 10))
+# 映像に変化が無い間は推論(顔・表情・物体検出)を省略し、直前の結果を使い回すか (1: 有効, 0: 無効)
+INFERENCE_MOTION_GATE = os.environ.get("INFERENCE_MOTION_GATE", "1") == "1"
+# 変化が無くても推論し直す間隔(秒)と、動体が無くなってから推論を続ける時間(秒)
+INFERENCE_KEEPALIVE_SECONDS = float(os.environ.get("INFERENCE_KEEPALIVE_SECONDS", 30.0))
+INFERENCE_MOTION_HOLD_SECONDS = float(
+    os.environ.get("INFERENCE_MOTION_HOLD_SECONDS", 2.0)
+)
+# 表情認識で顔検出を行う画像の幅(px)と、笑顔判定に使う顔領域の最大幅(px) (0の場合は縮小しない)
+EMOTION_DETECT_WIDTH = int(os.environ.get("EMOTION_DETECT_WIDTH", 640))
+EMOTION_SMILE_ROI_WIDTH = int(os.environ.get("EMOTION_SMILE_ROI_WIDTH", 160))
+# 配信で表情認識の顔を画像全体から検出し直す間隔(推論フレーム数)
+# 間のフレームは前回の顔の周辺だけを探索する (0の場合は毎回画像全体から検出する)
+FACE_REDETECT_INTERVAL = int(os.environ.get("FACE_REDETECT_INTERVAL", 10))
@@ -0,0 +1,197 @@
+import queue
+import threading
+import time
+import logging
+import numpy as np
+from concurrent.futures import Future, TimeoutError as FutureTimeoutError
+from typing import Callable, List, Optional, Tuple
+
+logger = logging.getLogger("uvicorn")
+
+"""
+DNN推論のまとめ実行
+複数の配信・スナップショットから届いたblobを小さなバッチ(N x 3 x H x W)にまとめ、
+スレッド毎に保持したネットワークで1回のforwardで推論する
+"""
+
+# キューを閉じる目印
+_STOP = object()
+
+
+class DetectionService:
+    """
+    SSD系の検出モデルの推論をまとめて行うサービス。
+    submit(blob)で1枚分のblob(1 x 3 x H x W)を受け付け、Futureを返す。
+    各ワーカースレッドは最初の1件が届いてからmax_wait秒待つか、max_batch件集まった時点で
+    バッチにまとめて推論し、検出結果(DetectionOutputの各行: [画像番号, クラス, 信頼度, x1, y1, x2, y2])を
+    画像毎に振り分けて呼び出し元に返す。
+    cv2.dnnのネットワークはスレッドセーフではないため、load_netでスレッド毎に作成する。
+    """
+
+    def __init__(
+        self,
+        load_net: Callable[[], object],
+        workers: int = 2,
+        max_batch: int = 4,
+        max_wait: float = 0.01,
+    ):
+        self._load_net = load_net
+        self._workers = max(1, workers)
+        self._max_batch = max(1, max_batch)
+        self._max_wait = max(0.0, max_wait)
+
+        self._queue: "queue.Queue" = queue.Queue()
+        self._threads: List[threading.Thread] = []
+        self._lock = threading.Lock()
+        self._closed = False
+
+        # 統計 (推論したバッチ数・画像数)
+        self._batches = 0
+        self._frames = 0
+
+    def start(self):
+        with self._lock:
+            if self._threads or self._closed:
+                return
+            for i in range(self._workers):
+                thread = threading.Thread(
+                    target=self._run, name=f"detection-{i}", daemon=True
+                )
+                thread.start()
+                self._threads.append(thread)
+
+    def close(self):
+        """
+        ワーカーを終了する。未処理の要求はRuntimeErrorで失敗させる。
+        """
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+            threads, self._threads = self._threads, []
+        for _ in threads:
+            self._queue.put(_STOP)
+        for thread in threads:
+            thread.join(timeout=5.0)
+        self._fail_pending()
+
+    def submit(self, blob: np.ndarray) -> Future:
+        """
+        1枚分のblobの推論を予約し、検出結果(K x 7の配列)を返すFutureを返す
+        """
+        if blob.ndim != 4 or blob.shape[0] != 1:
+            raise ValueError(f"blobは1枚分(1 x C x H x W)を指定してください: {blob.shape}")
+
+        self.start()
+        future: Future = Future()
+        with self._lock:
+            if self._closed:
+                raise RuntimeError("DetectionServiceは終了済みです")
+            self._queue.put((blob, future))
+        return future
+
+    def infer(self, blob: np.ndarray, timeout: Optional[float] = 10.0) -> np.ndarray:
+        """
+        1枚分のblobを推論し、その画像の検出結果(K x 7の配列)を返す (完了まで待つ)
+        """
+        future = self.submit(blob)
+        try:
+            return future.result(timeout)
+        except FutureTimeoutError:
+            future.cancel()
+            raise RuntimeError("物体検出の推論が時間内に終わりませんでした")
+
+    def stats(self) -> dict:
+        with self._lock:
+            batches, frames = self._batches, self._frames
+        return {
+            "workers": self._workers,
+            "max_batch": self._max_batch,
+            "max_wait_ms": self._max_wait * 1000,
+            "batches": batches,
+            "frames": frames,
+            "mean_batch_size": frames / batches if batches else None,
+            "pending": self._queue.qsize(),
+        }
+
+    def _collect(self) -> Tuple[List[tuple], bool]:
+        """
+        最初の1件を待ち、max_wait秒以内に届いた分をmax_batch件までまとめて返す。
+        2つ目の戻り値は終了の指示を受け取ったかどうか。
+        """
+        item = self._queue.get()
+        if item is _STOP:
+            return [], True
+
+        items = [item]
+        shape = item[0].shape
+        deadline = time.monotonic() + self._max_wait
+        while len(items) < self._max_batch:
+            remaining = deadline - time.monotonic()
+            try:
+                item = (
+                    self._queue.get(timeout=remaining)
+                    if remaining > 0
+                    else self._queue.get_nowait()
+                )
+            except queue.Empty:
+                break
+            if item is _STOP:
+                # 手元の分を推論してから終了する
+                return items, True
+            if item[0].shape != shape:
+                # 大きさの違うblobは同じバッチにできないため、次のバッチに回す
+                self._queue.put(item)
+                break
+            items.append(item)
+        return items, False
+
+    def _run(self):
+        net = None
+        while True:
+            items, stop = self._collect()
+            # 呼び出し元が諦めた(取り消した)要求は推論しない
+            items = [item for item in items if item[1].set_running_or_notify_cancel()]
+
+            if items:
+                try:
+                    if net is None:
+                        net = self._load_net()
+                    results = self._forward(net, [blob for blob, _ in items])
+                except Exception as e:
+                    logger.exception("物体検出の推論に失敗しました")
+                    for _, future in items:
+                        future.set_exception(RuntimeError(f"物体検出に失敗しました: {e}"))
+                else:
+                    for (_, future), result in zip(items, results):
+                        future.set_result(result)
+                    with self._lock:
+                        self._batches += 1
+                        self._frames += len(items)
+
+            if stop:
+                return
+
+    @staticmethod
+    def _forward(net, blobs: List[np.ndarray]) -> List[np.ndarray]:
+        """
+        blobを連結して1回で推論し、画像番号(0列目)で結果を振り分ける
+        """
+        batch = blobs[0] if len(blobs) == 1 else np.concatenate(blobs, axis=0)
+        net.setInput(batch)
+        detections = net.forward()
+        rows = detections.reshape(-1, detections.shape[-1])
+        image_ids = rows[:, 0].astype(np.int64)
+        return [rows[image_ids == i] for i in range(len(blobs))]
+
+    def _fail_pending(self):
+        while True:
+            try:
+                item = self._queue.get_nowait()
+            except queue.Empty:
+                return
+            if item is _STOP:
+                continue
+            _, future = item
+            if future.set_running_or_notify_cancel():
+                future.set_exception(RuntimeError("DetectionServiceは終了済みです"))
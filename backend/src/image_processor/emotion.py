@@ -1,35 +1,134 @@
 import cv2
+import threading
 
 """
 表情認識
 """
 
-face_cascade = cv2.CascadeClassifier(
-    cv2.data.haarcascades + "haarcascade_frontalface_default.xml"
-)
-smile_cascade = cv2.CascadeClassifier(cv2.data.haarcascades + "haarcascade_smile.xml")
+FACE_CASCADE_PATH = cv2.data.haarcascades + "haarcascade_frontalface_default.xml"
+SMILE_CASCADE_PATH = cv2.data.haarcascades + "haarcascade_smile.xml"
 
+# 顔検出を行う画像の幅(px) (これより大きい画像は縮小して検出し、座標を元の解像度に戻す。0の場合は縮小しない)
+detect_width = 640
+# 笑顔判定に使う顔領域の最大幅(px) (これより大きい顔領域は縮小して判定する。0の場合は縮小しない)
+smile_roi_width = 160
 
-def to_emotion_frame(frame):
+# 分類器はスレッド毎に読み込んで使い回す (CascadeClassifierはスレッド間で共有できない)
+_cascades = threading.local()
+
+
+def configure_emotion_detection(face_width: int = 640, smile_width: int = 160):
     """
-    顔検出＋表情判定＋ラベル描画
+    アプリ起動時に呼び出し、顔検出・笑顔判定を行う解像度を設定する
     """
-    result_frame = frame.copy()
-    gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+    global detect_width, smile_roi_width
+    detect_width = face_width
+    smile_roi_width = smile_width
 
-    faces = face_cascade.detectMultiScale(gray, 1.3, 5)
 
-    if len(faces) == 0:
-        return result_frame  # 顔なしの場合は元画像を返す
+def get_cascades():
+    """
+    呼び出したスレッド用の(顔の分類器, 笑顔の分類器)を返す (初回のみ読み込む)
+    """
+    cascades = getattr(_cascades, "value", None)
+    if cascades is None:
+        cascades = (
+            cv2.CascadeClassifier(FACE_CASCADE_PATH),
+            cv2.CascadeClassifier(SMILE_CASCADE_PATH),
+        )
+        _cascades.value = cascades
+    return cascades
+
 
+def _shrink(gray, max_width):
+    """
+    幅がmax_widthを超える画像を縮小し、(縮小した画像, 元の画像に対する倍率)を返す
+    """
+    width = gray.shape[1]
+    if not max_width or width <= max_width:
+        return gray, 1.0
+    ratio = max_width / width
+    height = max(1, round(gray.shape[0] * ratio))
+    return cv2.resize(gray, (max_width, height), interpolation=cv2.INTER_AREA), ratio
+
+
+def detect_faces(gray, max_width=None):
+    """
+    白黒画像から顔を検出し、元の解像度の(x, y, w, h)のリストを返す
+    max_width(未指定の場合はdetect_width)を超える画像は縮小して検出する
+    """
+    face_cascade, _ = get_cascades()
+    small, ratio = _shrink(gray, detect_width if max_width is None else max_width)
+    faces = face_cascade.detectMultiScale(small, 1.3, 5)
+    if ratio == 1.0:
+        return [tuple(int(v) for v in face) for face in faces]
+
+    # 縮小した画像の座標を元の解像度に戻す (画像の範囲に収める)
+    height, width = gray.shape[:2]
+    boxes = []
+    for x, y, w, h in faces:
+        x1 = min(width - 1, round(x / ratio))
+        y1 = min(height - 1, round(y / ratio))
+        x2 = min(width, round((x + w) / ratio))
+        y2 = min(height, round((y + h) / ratio))
+        boxes.append((x1, y1, x2 - x1, y2 - y1))
+    return boxes
+
+
+def is_smiling(roi_gray, max_width=None) -> bool:
+    """
+    顔領域の白黒画像から笑顔かを判定する
+    max_width(未指定の場合はsmile_roi_width)を超える顔領域は縮小して判定する
+    """
+    _, smile_cascade = get_cascades()
+    roi, _ = _shrink(roi_gray, smile_roi_width if max_width is None else max_width)
+    smiles = smile_cascade.detectMultiScale(roi, 1.8, 20)
+    return len(smiles) > 0
+
+
+def detect_emotions(
+    frame, gray=None, face_width=None, smile_width=None, roi_tracker=None
+):
+    """
+    顔検出＋表情判定
+    顔毎の (x, y, w, h, label, score) のリストを返す (座標は元の解像度)
+    grayに白黒化済みの画像を渡すと白黒化を省略する
+    face_width・smile_widthで検出する解像度を指定できる (未指定の場合は設定値、0の場合は縮小しない)
+    roi_tracker(RoiTracker)を渡すと、前回の顔の周辺だけを追跡し、
+    画像全体の顔検出は一定フレーム毎か見失った時だけ行う
+    """
+    if gray is None:
+        gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+
+    if roi_tracker is not None:
+        faces = roi_tracker.update(gray, lambda g: detect_faces(g, face_width))
+    else:
+        faces = detect_faces(gray, face_width)
+
+    emotions = []
     for x, y, w, h in faces:
         roi_gray = gray[y : y + h, x : x + w]
-        smiles = smile_cascade.detectMultiScale(roi_gray, 1.8, 20)
 
         # 表情判定
-        label = "Smile" if len(smiles) > 0 else "Neutral"
+        label = "Smile" if is_smiling(roi_gray, smile_width) else "Neutral"
         score = 1.0 if label == "Smile" else 0.5
 
+        emotions.append((int(x), int(y), int(w), int(h), label, score))
+
+    return emotions
+
+
+def draw_emotions(frame, emotions, scale=1.0):
+    """
+    検出済みの顔にバウンディングボックスとラベルを描画した画像のコピーを返す
+    scaleは検出した画像に対する描画先の画像の倍率
+    """
+    result_frame = frame.copy()
+
+    for x, y, w, h, label, score in emotions:
+        if scale != 1.0:
+            x, y, w, h = (round(v * scale) for v in (x, y, w, h))
+
         # バウンディングボックス
         cv2.rectangle(result_frame, (x, y), (x + w, y + h), (255, 0, 0), 2)
 
@@ -47,3 +146,10 @@ def to_emotion_frame(frame):
         )
 
     return result_frame
+
+
+def to_emotion_frame(frame):
+    """
+    顔検出＋表情判定＋ラベル描画
+    """
+    return draw_emotions(frame, detect_emotions(frame))
@@ -1,8 +1,7 @@
 import cv2
-import mediapipe as mp
-import math
+import numpy as np
 
-mp_face_mesh = mp.solutions.face_mesh
+from src.image_processor.face_mesh_engine import get_face_mesh_pool
 
 # -----------------------------
 # Landmark index constants (reused by new helpers)
@@ -23,285 +22,355 @@ NOSE_TIP_IDX = 1
 LEFT_EYE_BOTH = LEFT_EYE_LOWER | LEFT_EYE_UPPER
 RIGHT_EYE_BOTH = RIGHT_EYE_LOWER | RIGHT_EYE_UPPER
 
-
-def _determine_face_orientation(landmarks, image_width, image_height):
+# 配列演算用のインデックス
+LEFT_EYE_BOTH_IDX = np.array(sorted(LEFT_EYE_BOTH))
+RIGHT_EYE_BOTH_IDX = np.array(sorted(RIGHT_EYE_BOTH))
+# (上まぶた, 下まぶた, 目頭, 目尻) x (左目, 右目)
+EYE_EAR_IDX = np.array([[386, 374, 133, 33], [159, 145, 362, 263]])
+# (上唇, 下唇, 左口角, 右口角)
+MOUTH_RATIO_IDX = np.array([13, 14, 61, 291])
+
+# 描画するランドマークの色分け (上から優先)
+LANDMARK_COLORS = [
+    (LEFT_EYE_UPPER, (0, 255, 0)),
+    (LEFT_EYE_LOWER, (0, 255, 255)),
+    (RIGHT_EYE_UPPER, (0, 255, 0)),
+    (RIGHT_EYE_LOWER, (0, 255, 255)),
+    (NOSE, (0, 0, 255)),
+    (MOUTH, (0, 255, 255)),
+    (FACE_CONTOUR, (255, 255, 255)),
+]
+LANDMARK_RADIUS = 5
+
+
+def _build_render_plan():
     """
-    顔の向きを推定します。
-    入力:
-      - landmarks: Mediapipe の face_landmarks オブジェクト (一つの顔のランドマーク集合)
-      - image_width, image_height: 画像サイズ
-    出力:
-      {'yaw': float, 'pitch': float, 'roll': float, 'orientation': 'frontal'|'left'|'right'|'up'|'down'|'tilted'}
+    描画するランドマーク番号と色の配列を作成します。
+    cv2.circle と同じ重なり方になるよう、番号順に並べます。
     """
-    if landmarks is None:
-        return None
+    indices = sorted(set().union(*(group for group, _ in LANDMARK_COLORS)))
+    colors = []
+    for idx in indices:
+        colors.append(next(color for group, color in LANDMARK_COLORS if idx in group))
+    return np.array(indices), np.array(colors, dtype=np.uint8)
 
-    w, h = image_width, image_height
-
-    # 左右の目の座標を取得
-    left_pts = []
-    for idx in LEFT_EYE_BOTH:
-        lm = landmarks.landmark[idx]
-        left_pts.append((lm.x * w, lm.y * h))
-
-    right_pts = []
-    for idx in RIGHT_EYE_BOTH:
-        lm = landmarks.landmark[idx]
-        right_pts.append((lm.x * w, lm.y * h))
-
-    if not left_pts or not right_pts:
-        return {"yaw": 0.0, "pitch": 0.0, "roll": 0.0, "orientation": "unknown"}
-
-    # 目の中心座標を計算
-    left_center_x = sum(p[0] for p in left_pts) / len(left_pts)
-    left_center_y = sum(p[1] for p in left_pts) / len(left_pts)
-    right_center_x = sum(p[0] for p in right_pts) / len(right_pts)
-    right_center_y = sum(p[1] for p in right_pts) / len(right_pts)
-
-    # 眉間の位置を取得
-    eye_dist = math.hypot(
-        left_center_x - right_center_x, left_center_y - right_center_y
-    )
-    center_eye_x = (left_center_x + right_center_x) / 2.0
-    center_eye_y = (left_center_y + right_center_y) / 2.0
 
-    # 鼻先の位置を取得
-    nose = landmarks.landmark[NOSE_TIP_IDX]
-    nose_x = nose.x * w
-    nose_y = nose.y * h
-
-    # yaw, pitch, roll を計算
-    dx = nose_x - center_eye_x
-    dy = nose_y - center_eye_y
-    yaw = math.degrees(math.atan2(dx, eye_dist)) if eye_dist > 1e-6 else 0.0
-    pitch = math.degrees(math.atan2(dy, eye_dist)) if eye_dist > 1e-6 else 0.0
-    dy_eye = left_center_y - right_center_y
-    roll = math.degrees(math.atan2(dy_eye, eye_dist)) if eye_dist > 1e-6 else 0.0
+def _build_disk_offsets(radius):
+    """
+    cv2.circle (塗りつぶし) が描く画素の、中心からの相対座標 (画素数, 2) の [dy, dx] を返します。
+    """
+    size = 2 * radius + 1
+    sprite = np.zeros((size, size), dtype=np.uint8)
+    cv2.circle(sprite, (radius, radius), radius, 255, -1)
+    return np.argwhere(sprite > 0) - radius
 
-    # カテゴリ分類
-    orientation = "frontal"
-    if yaw > 20:
-        orientation = "left"
-    elif yaw < -20:
-        orientation = "right"
-    elif pitch > 35:
-        orientation = "down"
-    elif pitch < 10:
-        orientation = "up"
-    else:
-        orientation = "frontal"
 
-    return {"yaw": yaw, "pitch": pitch, "roll": roll, "orientation": orientation}
+# 描画計画 (モジュール読み込み時に1度だけ作成)
+RENDER_IDX, RENDER_COLORS = _build_render_plan()
+DISK_OFFSETS = _build_disk_offsets(LANDMARK_RADIUS)
 
 
-def _is_eyes_closed(landmarks, image_width, image_height, threshold=0.20):
+def _landmarks_to_array(multi_face_landmarks, image_width, image_height):
     """
-    両眼が閉じているかを判定します。
+    Mediapipe の face_landmarks のリストを、画素座標の配列に一括変換します。
     入力:
-      - landmarks: Mediapipe の face_landmarks オブジェクト
+      - multi_face_landmarks: Mediapipe の face_landmarks オブジェクトのリスト
       - image_width, image_height: 画像サイズ
-      - threshold: EAR に相当する指標の閾値
     出力:
-      {'eyes_closed': bool, 'left_eye_ear': float, 'right_eye_ear': float}
+      shape (顔の数, ランドマーク数, 3) の ndarray (x, y は画素単位、z は x と同じ尺度)
     """
-    w, h = image_width, image_height
-    # 左目
-    ## 上まぶたの中心座標
-    lm = landmarks.landmark[386]
-    eye_left_upper = [lm.x * w, lm.y * h]
-
-    ## 下まぶたの中心座標
-    lm = landmarks.landmark[374]
-    eye_left_lower = [lm.x * w, lm.y * h]
-
-    ## 2点距離を計算
-    left_height = math.hypot(
-        eye_left_upper[0] - eye_left_lower[0], eye_left_upper[1] - eye_left_lower[1]
+    points = np.array(
+        [
+            [(lm.x, lm.y, lm.z) for lm in face_landmarks.landmark]
+            for face_landmarks in multi_face_landmarks
+        ],
+        dtype=np.float64,
     )
+    points[..., 0] *= image_width
+    points[..., 1] *= image_height
+    points[..., 2] *= image_width
+    return points
 
-    ## 目頭の中心座標
-    lm = landmarks.landmark[133]
-    eye_left_inner = [lm.x * w, lm.y * h]
-
-    ## 目尻の中心座標
-    lm = landmarks.landmark[33]
-    eye_left_outer = [lm.x * w, lm.y * h]
 
-    ## 2点距離を計算
-    left_width = math.hypot(
-        eye_left_inner[0] - eye_left_outer[0], eye_left_inner[1] - eye_left_outer[1]
-    )
+def _determine_face_orientation(points):
+    """
+    顔の向きを推定します。
+    入力:
+      - points: _landmarks_to_array で変換した (顔の数, ランドマーク数, 3) の配列
+    出力:
+      顔毎の {'yaw': float, 'pitch': float, 'roll': float, 'orientation': 'frontal'|'left'|'right'|'up'|'down'} のリスト
+    """
+    # 左右の目の中心座標 (顔の数, 2)
+    left_center = points[:, LEFT_EYE_BOTH_IDX, :2].mean(axis=1)
+    right_center = points[:, RIGHT_EYE_BOTH_IDX, :2].mean(axis=1)
 
-    ## アスペクト比
-    left_ear = left_height / left_width if left_width > 1e-6 else 0.0
+    # 眉間の位置を取得
+    eye_vec = left_center - right_center
+    eye_dist = np.hypot(eye_vec[:, 0], eye_vec[:, 1])
+    center_eye = (left_center + right_center) / 2.0
 
-    # 右目
-    ## 上まぶたの中心座標
-    lm = landmarks.landmark[159]
-    eye_right_upper = [lm.x * w, lm.y * h]
+    # 鼻先の位置を取得
+    nose = points[:, NOSE_TIP_IDX, :2]
 
-    ## 下まぶたの中心座標
-    lm = landmarks.landmark[145]
-    eye_right_lower = [lm.x * w, lm.y * h]
+    # yaw, pitch, roll を計算 (目の間隔が潰れている顔は0とする)
+    d = nose - center_eye
+    valid = eye_dist > 1e-6
+    safe_dist = np.where(valid, eye_dist, 1.0)
+    yaw = np.where(valid, np.degrees(np.arctan2(d[:, 0], safe_dist)), 0.0)
+    pitch = np.where(valid, np.degrees(np.arctan2(d[:, 1], safe_dist)), 0.0)
+    roll = np.where(valid, np.degrees(np.arctan2(eye_vec[:, 1], safe_dist)), 0.0)
 
-    ## 2点距離を計算
-    right_height = math.hypot(
-        eye_right_upper[0] - eye_right_lower[0], eye_right_upper[1] - eye_right_lower[1]
+    # カテゴリ分類
+    orientation = np.select(
+        [yaw > 20, yaw < -20, pitch > 35, pitch < 10],
+        ["left", "right", "down", "up"],
+        default="frontal",
     )
 
-    ## 目頭の中心座標
-    lm = landmarks.landmark[362]
-    eye_right_inner = [lm.x * w, lm.y * h]
+    return [
+        {
+            "yaw": float(yaw[i]),
+            "pitch": float(pitch[i]),
+            "roll": float(roll[i]),
+            "orientation": str(orientation[i]),
+        }
+        for i in range(len(points))
+    ]
 
-    ## 目尻の中心座標
-    lm = landmarks.landmark[263]
-    eye_right_outer = [lm.x * w, lm.y * h]
 
-    ## 2点距離を計算
-    right_width = math.hypot(
-        eye_right_inner[0] - eye_right_outer[0], eye_right_inner[1] - eye_right_outer[1]
-    )
+def _ratio(points, idx):
+    """
+    idx の各行 (a, b, c, d) について |a - b| / |c - d| を計算します。
+    分母が潰れている場合は0とします。
+    """
+    p = points[:, idx, :2]
+    num = np.linalg.norm(p[..., 0, :] - p[..., 1, :], axis=-1)
+    den = np.linalg.norm(p[..., 2, :] - p[..., 3, :], axis=-1)
+    return np.divide(num, den, out=np.zeros_like(num), where=den > 1e-6)
+
 
-    ## アスペクト比
-    right_ear = right_height / right_width if right_width > 1e-6 else 0.0
+def _is_eyes_closed(points, threshold=0.20):
+    """
+    両眼が閉じているかを判定します。
+    入力:
+      - points: _landmarks_to_array で変換した (顔の数, ランドマーク数, 3) の配列
+      - threshold: EAR に相当する指標の閾値
+    出力:
+      顔毎の {'eyes_closed': bool, 'left_eye_ear': float, 'right_eye_ear': float} のリスト
+    """
+    # アスペクト比 (顔の数, 2) : まぶたの上下の距離 / 目頭と目尻の距離
+    ear = _ratio(points, EYE_EAR_IDX)
 
     # 閾値と比較して閉じているかを判定
-    eyes_closed = (left_ear < threshold) and (right_ear < threshold)
+    eyes_closed = (ear < threshold).all(axis=1)
 
-    # 結果を辞書で返す
-    return {
-        "eyes_closed": eyes_closed,
-        "left_eye_ear": left_ear,
-        "right_eye_ear": right_ear,
-    }
+    return [
+        {
+            "eyes_closed": bool(eyes_closed[i]),
+            "left_eye_ear": float(ear[i, 0]),
+            "right_eye_ear": float(ear[i, 1]),
+        }
+        for i in range(len(points))
+    ]
 
 
-def _is_mouth_closed(landmarks, image_width, image_height, threshold=0.20):
+def _is_mouth_closed(points, threshold=0.20):
     """
     口が閉じているかを判定します。
     入力:
-      - landmarks: Mediapipe の face_landmarks オブジェクト
-      - image_width, image_height: 画像サイズ
+      - points: _landmarks_to_array で変換した (顔の数, ランドマーク数, 3) の配列
       - threshold: mouth opening_ratio の閾値
     出力:
-      {'mouth_closed': bool, 'opening_ratio': float}
+      顔毎の {'mouth_closed': bool, 'opening_ratio': float} のリスト
     """
-    w, h = image_width, image_height
-
-    # 口の立幅
-    lm = landmarks.landmark[13]
-    mouth_upper = [lm.x * w, lm.y * h]
-    lm = landmarks.landmark[14]
-    mouth_lower = [lm.x * w, lm.y * h]
-    open_dist = math.hypot(
-        mouth_upper[0] - mouth_lower[0], mouth_upper[1] - mouth_lower[1]
-    )
-
-    # 口の横幅
-    lm = landmarks.landmark[61]
-    mouth_left = [lm.x * w, lm.y * h]
-    lm = landmarks.landmark[291]
-    mouth_right = [lm.x * w, lm.y * h]
-    width_dist = math.hypot(
-        mouth_left[0] - mouth_right[0], mouth_left[1] - mouth_right[1]
-    )
-
-    # 開口率
-    opening_ratio = open_dist / width_dist if width_dist > 1e-6 else 0.0
+    # 開口率 (顔の数,) : 口の立幅 / 口の横幅
+    opening_ratio = _ratio(points, MOUTH_RATIO_IDX)
 
     # 閾値と比較して閉じているかを判定
     mouth_closed = opening_ratio < threshold
 
-    return {"mouth_closed": mouth_closed, "opening_ratio": opening_ratio}
+    return [
+        {
+            "mouth_closed": bool(mouth_closed[i]),
+            "opening_ratio": float(opening_ratio[i]),
+        }
+        for i in range(len(points))
+    ]
 
 
-def _detect_face_mesh(frame):
+def _face_boxes(points):
     """
-    mediapipe face meshを使って顔の点群を検出し、(x, y, z)のリストを返す
+    顔毎のランドマークを囲むボックス (顔の数, 4) の [x1, y1, x2, y2] を返します。
     """
-    face_mesh = mp_face_mesh.FaceMesh(
-        static_image_mode=False, max_num_faces=1, refine_landmarks=True
-    )
-    rgb_frame = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
+    xy = points[..., :2]
+    return np.concatenate([xy.min(axis=1), xy.max(axis=1)], axis=1)
+
+
+def _face_features(points):
+    """
+    顔毎の特徴量辞書のリストを返します。
+    """
+    features = []
+    orientations = _determine_face_orientation(points)
+    eyes = _is_eyes_closed(points)
+    mouths = _is_mouth_closed(points)
+    for orientation, eye, mouth in zip(orientations, eyes, mouths):
+        face = {}
+        face.update(orientation)
+        face.update(eye)
+        face.update(mouth)
+        features.append(face)
+    return features
 
-    # 顔検出
-    results = face_mesh.process(rgb_frame)
 
-    # close
-    face_mesh.close()
+def _detect_face_mesh(frame, engine=None):
+    """
+    mediapipe face meshを使って顔の点群を検出し、(x, y, z)のリストを返す
+    engine(FaceMeshEngine)が指定されていればそれを使い、追跡状態を引き継ぐ。
+    指定が無ければ共有プールから静止画モードのエンジンを借りる。
+    """
+    if engine is not None:
+        return engine.process(frame)
 
-    return results
+    with get_face_mesh_pool().borrow() as pooled_engine:
+        return pooled_engine.process(frame)
 
 
-def extract_face_features(frame):
+def extract_face_features(frame, engine=None):
     """
     Mediapipe face meshを使って顔のランドマークを検出し、
     determine_face_orientation, is_eyes_closed, is_mouth_closedを使って
     特徴量辞書を返す。
     """
-    features = {}
+    h, w = frame.shape[:2]
+    results = _detect_face_mesh(frame, engine)
+
+    if not results.multi_face_landmarks:
+        return None
+
+    points = _landmarks_to_array(results.multi_face_landmarks[:1], w, h)
+    return _face_features(points)[0]
 
+
+def extract_multi_face_features(frame, engine=None, tracker=None):
+    """
+    検出した全ての顔について特徴量辞書を返す。
+    各辞書には顔を囲むボックス (bbox) と追跡ID (track_id) を含む。
+    tracker(FaceTracker)を渡すとフレーム間で同じ人物に同じIDを振る。
+    無い場合は検出順の番号をIDとする。
+    顔が無ければ空のリストを返す。
+    """
     h, w = frame.shape[:2]
-    results = _detect_face_mesh(frame)
+    results = _detect_face_mesh(frame, engine)
 
+    if not results.multi_face_landmarks:
+        if tracker is not None:
+            tracker.update([])
+        return []
+
+    # 全ての顔をまとめて計算
+    points = _landmarks_to_array(results.multi_face_landmarks, w, h)
+    boxes = _face_boxes(points)
+    if tracker is not None:
+        track_ids = tracker.update(boxes)
+    else:
+        track_ids = list(range(len(points)))
+
+    faces = _face_features(points)
+    for face, track_id, box in zip(faces, track_ids, boxes.round().astype(int).tolist()):
+        face["track_id"] = track_id
+        face["bbox"] = box
+    return faces
+
+
+def detect_face_points(frame, engine=None):
+    """
+    Mediapipe face meshを使って顔のランドマークを検出し、
+    (顔の数, ランドマーク数, 3) の画素座標の配列を返す。顔が無ければNoneを返す。
+    """
+    h, w = frame.shape[:2]
+    results = _detect_face_mesh(frame, engine)
     if not results.multi_face_landmarks:
         return None
+    return _landmarks_to_array(results.multi_face_landmarks, w, h)
 
-    face_landmarks = results.multi_face_landmarks[0]
 
-    orientation = _determine_face_orientation(face_landmarks, w, h)
-    eyes = _is_eyes_closed(face_landmarks, w, h)
-    mouth = _is_mouth_closed(face_landmarks, w, h)
+def detect_tracked_face_points(frame, engine=None, tracker=None):
+    """
+    detect_face_pointsに加えて、tracker(FaceTracker)で各顔の追跡IDを求め、
+    (ランドマーク配列, 追跡IDのリスト) を返す。trackerが無ければ追跡IDはNone。
+    """
+    points = detect_face_points(frame, engine)
+    track_ids = None
+    if tracker is not None:
+        track_ids = tracker.update(_face_boxes(points) if points is not None else [])
+    return points, track_ids
 
-    features.update(orientation)
-    features.update(eyes)
-    features.update(mouth)
 
-    return features
+def draw_face_points(frame, points, track_ids=None, scale=1.0):
+    """
+    検出済みのランドマークを画像のコピーへ色分けして描画する
+    track_idsがあれば各顔に追跡IDを描画します
+    scaleは検出した画像に対する描画先の画像の倍率です
+    顔が無ければ元画像をそのまま返します
+    """
+    if points is None or len(points) == 0:
+        return frame
+    if scale != 1.0:
+        points = points * scale
+
+    frame_copy = frame.copy()
+    _draw_landmarks(frame_copy, points)
+    if track_ids is not None:
+        _draw_track_ids(frame_copy, points, track_ids)
+    return frame_copy
 
 
-def to_mesh_frame(frame):
+def to_mesh_frame(frame, engine=None, tracker=None):
     """
     Mediapipe face meshを使って顔のランドマークを検出し、画像へ色分けして描画する
     左目、右目、鼻、口を色分けして描画します
+    tracker(FaceTracker)を渡すと各顔に追跡IDを描画します
+    """
+    points, track_ids = detect_tracked_face_points(frame, engine, tracker)
+    return draw_face_points(frame, points, track_ids)
+
+
+def _draw_landmarks(frame, points):
+    """
+    描画計画に従って、全ての顔のランドマークを円で一括描画する
+    (cv2.circle を点毎に呼ぶのと同じ結果になる)
     """
-    # 画像コピー
-    frame_copy = frame.copy()
     h, w = frame.shape[:2]
 
-    # 顔検出
-    results = _detect_face_mesh(frame)
-
-    if results.multi_face_landmarks:
-        # 検出時の処理
-        for face_landmarks in results.multi_face_landmarks:
-            for idx, landmark in enumerate(face_landmarks.landmark):
-                # 各ランドマークの色分け
-                if idx in LEFT_EYE_UPPER:
-                    color = (0, 255, 0)
-                elif idx in LEFT_EYE_LOWER:
-                    color = (0, 255, 255)
-                elif idx in RIGHT_EYE_UPPER:
-                    color = (0, 255, 0)
-                elif idx in RIGHT_EYE_LOWER:
-                    color = (0, 255, 255)
-                elif idx in NOSE:
-                    color = (0, 0, 255)
-                elif idx in MOUTH:
-                    color = (0, 255, 255)
-                elif idx in FACE_CONTOUR:
-                    color = (255, 255, 255)
-                else:
-                    continue
-
-                # 画素座標に変換
-                x = int(landmark.x * w)
-                y = int(landmark.y * h)
-
-                # 元画像に重ねて描画
-                cv2.circle(frame_copy, (x, y), 5, color, -1)
-        return frame_copy
+    # 画素座標に変換 (顔の数, 点数, 2)
+    centers = points[:, RENDER_IDX, :2].astype(np.int64)
 
-    else:
-        # 検出なしは元画像をそのまま返す
-        return frame
+    # 各円が塗る画素の座標 (顔の数, 点数, 円の画素数)
+    ys = centers[..., 1, None] + DISK_OFFSETS[:, 0]
+    xs = centers[..., 0, None] + DISK_OFFSETS[:, 1]
+    colors = np.broadcast_to(
+        RENDER_COLORS[None, :, None, :], ys.shape + (RENDER_COLORS.shape[1],)
+    )
+
+    # 画像内の画素だけ、描画順(顔・番号順)に塗る (重なりは後の点が上書き)
+    inside = (ys >= 0) & (ys < h) & (xs >= 0) & (xs < w)
+    frame[ys[inside], xs[inside]] = colors[inside]
+
+
+def _draw_track_ids(frame, points, track_ids):
+    """
+    各顔のボックスの左上に追跡IDを描画する
+    """
+    boxes = _face_boxes(points).astype(int)
+    for track_id, (x1, y1, _, _) in zip(track_ids, boxes.tolist()):
+        y_text = y1 - 10 if y1 - 10 > 10 else y1 + 20
+        cv2.putText(
+            frame,
+            f"ID {track_id}",
+            (x1, y_text),
+            cv2.FONT_HERSHEY_SIMPLEX,
+            0.8,
+            (255, 255, 255),
+            2,
+        )
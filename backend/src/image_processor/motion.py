@@ -0,0 +1,235 @@
+import cv2
+import json
+import numpy as np
+import threading
+from dataclasses import dataclass
+from typing import List, Optional, Sequence, Tuple
+
+"""
+動体検知
+縮小した白黒画像で背景を移動平均により更新し、背景との差分で動体を判定する
+判定は検知エリア(多角形)毎に行い、除外エリアは計算しない
+"""
+
+
+@dataclass(frozen=True)
+class MotionZone:
+    """
+    動体検知のエリア。
+    pointsは多角形の頂点で、画像の幅・高さに対する比率(0-1)で指定する。
+    exclude=Trueの場合は除外エリア(窓やテレビなど)として、他のエリアから取り除く。
+    min_ratioはエリアの面積に対して動体とみなす変化画素の割合 (Noneの場合は検知器の既定値)。
+    """
+
+    name: str
+    points: Tuple[Tuple[float, float], ...]
+    exclude: bool = False
+    min_ratio: Optional[float] = None
+
+
+# エリア未指定時に使う画像全体のエリア
+FULL_FRAME_ZONE = MotionZone("all", ((0.0, 0.0), (1.0, 0.0), (1.0, 1.0), (0.0, 1.0)))
+
+
+def parse_zones(text: Optional[str]) -> List[MotionZone]:
+    """
+    JSONの文字列からエリアのリストを作る。空の場合は空のリストを返す。
+    例: [{"name": "door", "points": [[0.1, 0.2], [0.4, 0.2], [0.4, 0.9]]},
+         {"name": "tv", "points": [...], "exclude": true}]
+    形式が不正な場合はValueErrorを送出する。
+    """
+    if not text or not text.strip():
+        return []
+    try:
+        zones = [
+            MotionZone(
+                name=str(zone["name"]),
+                points=tuple((float(x), float(y)) for x, y in zone["points"]),
+                exclude=bool(zone.get("exclude", False)),
+                min_ratio=zone.get("min_ratio"),
+            )
+            for zone in json.loads(text)
+        ]
+    except (TypeError, KeyError, ValueError) as e:
+        raise ValueError(f"不正な検知エリアです: {e}")
+    for zone in zones:
+        if len(zone.points) < 3:
+            raise ValueError(f"検知エリアの頂点が足りません: {zone.name}")
+    return zones
+
+
+class _ZoneLayout:
+    """
+    画像サイズ毎に1度だけ作るエリアのラスタ。
+    labelsは検知エリアの外接矩形(bbox)内の各画素のエリア番号(1始まり、0はエリア外)。
+    エリアが重なる場合は後に指定したエリアを優先する。
+    """
+
+    def __init__(self, zones: Sequence[MotionZone], shape: Tuple[int, int]):
+        height, width = shape
+        scale = np.array([width - 1, height - 1], dtype=np.float64)
+        labels = np.zeros(shape, dtype=np.uint8)
+
+        includes = [zone for zone in zones if not zone.exclude]
+        for i, zone in enumerate(includes, start=1):
+            polygon = np.round(np.array(zone.points) * scale).astype(np.int32)
+            cv2.fillPoly(labels, [polygon], i)
+        for zone in zones:
+            if zone.exclude:
+                polygon = np.round(np.array(zone.points) * scale).astype(np.int32)
+                cv2.fillPoly(labels, [polygon], 0)
+
+        # エリア外は計算しないよう、全エリアの外接矩形で切り出す
+        ys, xs = np.nonzero(labels)
+        if len(ys):
+            self.bbox = (ys.min(), ys.max() + 1, xs.min(), xs.max() + 1)
+        else:
+            self.bbox = (0, 0, 0, 0)
+        y1, y2, x1, x2 = self.bbox
+
+        self.zones = includes
+        self.labels = labels[y1:y2, x1:x2]
+        self.areas = np.bincount(self.labels.ravel(), minlength=len(includes) + 1)
+
+    def crop(self, image):
+        y1, y2, x1, x2 = self.bbox
+        return image[y1:y2, x1:x2]
+
+
+class MotionDetector:
+    """
+    移動平均の背景モデルによる動体検知。
+    1フレーム前との比較ではなく、徐々に更新される背景と比較するため、
+    ゆっくりした明るさの変化は背景に取り込まれて誤検知しにくい。
+    前処理(縮小・白黒化・ぼかし)は各フレーム1度だけ行い、背景として保持する。
+    背景と差分は検知エリアの外接矩形内だけで計算し、エリア毎の変化画素数はbincountで数える。
+
+    - width: 前処理で縮小する幅(px)。これより小さい画像は縮小しない
+    - alpha: 背景の更新率 (大きいほど早く背景に取り込む)
+    - threshold: 背景との差分を動体とみなす輝度差
+    - min_area_ratio: 動体とみなす変化画素の割合 (エリアの面積に対する比率)
+    - zones: 検知エリア。未指定の場合は画像全体
+    """
+
+    def __init__(
+        self,
+        width: int = 320,
+        alpha: float = 0.05,
+        threshold: int = 25,
+        min_area_ratio: float = 0.002,
+        blur_ksize: int = 5,
+        zones: Optional[Sequence[MotionZone]] = None,
+    ):
+        self.width = width
+        self.alpha = alpha
+        self.threshold = threshold
+        self.min_area_ratio = min_area_ratio
+        self.blur_ksize = blur_ksize
+
+        zones = list(zones or [])
+        if not any(not zone.exclude for zone in zones):
+            zones.insert(0, FULL_FRAME_ZONE)
+        self.zones = zones
+
+        self._layout: Optional[_ZoneLayout] = None
+        self._layout_shape: Optional[Tuple[int, int]] = None
+        self._background: Optional[np.ndarray] = None
+        self._lock = threading.Lock()
+
+    def preprocess(self, frame):
+        """
+        縮小・白黒化・ぼかし。白黒画像を渡した場合は白黒化を省略する。
+        """
+        if frame.shape[1] > self.width:
+            height = round(frame.shape[0] * self.width / frame.shape[1])
+            frame = cv2.resize(frame, (self.width, height), interpolation=cv2.INTER_AREA)
+        if frame.ndim == 3:
+            frame = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+        return cv2.GaussianBlur(frame, (self.blur_ksize, self.blur_ksize), 0)
+
+    def update(self, frame) -> bool:
+        """
+        フレームを背景と比較していずれかのエリアに動体があるかを返し、背景を更新する。
+        """
+        motion, _ = self.analyze(frame)
+        return motion
+
+    def analyze(self, frame) -> Tuple[bool, List[dict]]:
+        """
+        フレームを背景と比較し、(動体の有無, エリア毎の状態のリスト)を返して背景を更新する。
+        エリア毎の状態は name, active(動体の有無), ratio(変化画素の割合)。
+        最初のフレーム(と解像度が変わった直後)は背景にするだけで動体なしを返す。
+        """
+        motion, states, _ = self.analyze_region(frame)
+        return motion, states
+
+    def analyze_region(
+        self, frame
+    ) -> Tuple[bool, List[dict], Optional[Tuple[float, float, float, float]]]:
+        """
+        analyzeに加えて、動体がある場合は検知エリア内で変化した範囲の外接矩形
+        (x1, y1, x2, y2。画像の幅・高さに対する比率)を返す。動体が無ければNone。
+        """
+        gray = self.preprocess(frame)
+
+        with self._lock:
+            # エリアのラスタは画像サイズが変わった時だけ作り直す
+            if self._layout is None or self._layout_shape != gray.shape:
+                self._layout = _ZoneLayout(self.zones, gray.shape)
+                self._layout_shape = gray.shape
+                self._background = None
+            layout = self._layout
+
+            roi = layout.crop(gray)
+            if self._background is None or roi.size == 0:
+                self._background = roi.astype(np.float32)
+                return False, self._zone_states(layout, None), None
+
+            # 背景との差分抽出
+            frame_delta = cv2.absdiff(roi, cv2.convertScaleAbs(self._background))
+            cv2.accumulateWeighted(roi, self._background, self.alpha)
+
+        # エリア毎の変化画素数
+        changed_mask = frame_delta > self.threshold
+        changed = layout.labels[changed_mask]
+        counts = np.bincount(changed, minlength=len(layout.zones) + 1)
+
+        states = self._zone_states(layout, counts)
+        motion = any(state["active"] for state in states)
+        region = None
+        if motion:
+            region = self._changed_region(layout, changed_mask, gray.shape)
+        return motion, states, region
+
+    @staticmethod
+    def _changed_region(layout: _ZoneLayout, changed_mask, shape):
+        # 検知エリア内で変化した画素の外接矩形を画像全体に対する比率で返す
+        points = (changed_mask & (layout.labels > 0)).view(np.uint8)
+        x, y, w, h = cv2.boundingRect(points)
+        if w == 0 or h == 0:
+            return None
+        y1, _, x1, _ = layout.bbox
+        height, width = shape
+        return (
+            float(x1 + x) / width,
+            float(y1 + y) / height,
+            float(x1 + x + w) / width,
+            float(y1 + y + h) / height,
+        )
+
+    def _zone_states(self, layout: _ZoneLayout, counts) -> List[dict]:
+        states = []
+        for i, zone in enumerate(layout.zones, start=1):
+            area = int(layout.areas[i])
+            ratio = float(counts[i]) / area if counts is not None and area else 0.0
+            min_ratio = (
+                self.min_area_ratio if zone.min_ratio is None else zone.min_ratio
+            )
+            states.append(
+                {"name": zone.name, "active": ratio > min_ratio, "ratio": ratio}
+            )
+        return states
+
+    def reset(self):
+        with self._lock:
+            self._background = None
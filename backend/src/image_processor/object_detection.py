@@ -1,5 +1,9 @@
 import numpy as np
 import cv2
+import threading
+from typing import List, Optional
+
+from src.image_processor.detection_service import DetectionService
 
 """
 ダミーの処理: 2値化した画像を返却する
@@ -43,40 +47,195 @@ CLASSES = [
 # カラーマップ
 COLORS = np.random.uniform(0, 255, size=(len(CLASSES), 3))
 
-# モデルの読み込み
-net = cv2.dnn.readNetFromCaffe(
-    "pretrain_models/MobileNetSSD_deploy.prototxt",
-    "pretrain_models/MobileNetSSD_deploy.caffemodel",
-)
+# モデルのファイル
+PROTOTXT_PATH = "pretrain_models/MobileNetSSD_deploy.prototxt"
+CAFFEMODEL_PATH = "pretrain_models/MobileNetSSD_deploy.caffemodel"
 
 
-def detect_objects(frame, confidence_threshold=0.5):
-    # 入力画像のサイズ調整
-    h, w = frame.shape[:2]
-    blob = cv2.dnn.blobFromImage(
-        cv2.resize(frame, (300, 300)), 0.007843, (300, 300), 127.5
+def load_net():
+    """
+    MobileNet-SSDのモデルを読み込んで返す
+    (ネットワークはスレッドセーフではないため、推論サービスのスレッド毎に作成する)
+    """
+    return cv2.dnn.readNetFromCaffe(PROTOTXT_PATH, CAFFEMODEL_PATH)
+
+
+# 推論サービス (配信・スナップショットで共有し、届いたblobをまとめて推論する)
+_service: Optional[DetectionService] = None
+_service_lock = threading.Lock()
+# close_detection_service()の後に作り直さないための目印
+_service_closed = False
+
+
+def init_detection_service(workers: int = 2, max_batch: int = 4, max_wait: float = 0.01):
+    """
+    アプリ起動時に呼び出し、推論サービスを作成して開始する
+    """
+    global _service, _service_closed
+    with _service_lock:
+        if _service is not None:
+            _service.close()
+        _service = DetectionService(load_net, workers, max_batch, max_wait)
+        _service_closed = False
+        _service.start()
+
+
+def close_detection_service():
+    """
+    アプリ終了時に呼び出し、推論サービスを終了する
+    """
+    global _service, _service_closed
+    with _service_lock:
+        if _service is not None:
+            _service.close()
+        _service = None
+        _service_closed = True
+
+
+def get_detection_service() -> DetectionService:
+    """
+    推論サービスを返す。未作成であれば既定の設定で作成する。
+    close_detection_service()の後はRuntimeErrorを送出する。
+    """
+    global _service
+    with _service_lock:
+        if _service_closed:
+            raise RuntimeError("物体検出の推論サービスは終了済みです")
+        if _service is None:
+            _service = DetectionService(load_net)
+        return _service
+
+
+def resize_for_detection(frame):
+    """
+    入力画像をモデルの入力サイズに縮小する
+    """
+    return cv2.resize(frame, (300, 300))
+
+
+def blob_from_resized(resized):
+    """
+    縮小済みの画像をモデルの入力(blob)に変換する
+    """
+    return cv2.dnn.blobFromImage(resized, 0.007843, (300, 300), 127.5)
+
+
+class Detections:
+    """
+    1枚分の物体検出結果。検出した物体はクラス番号・信頼度・ボックスの配列で保持する。
+    ボックスは元画像の画素座標 (startX, startY, endX, endY)。
+    """
+
+    __slots__ = ("class_ids", "scores", "boxes", "image_width", "image_height")
+
+    def __init__(self, class_ids, scores, boxes, image_width, image_height):
+        self.class_ids = np.asarray(class_ids, dtype=np.int32).reshape(-1)
+        self.scores = np.asarray(scores, dtype=np.float32).reshape(-1)
+        self.boxes = np.asarray(boxes, dtype=np.int32).reshape(-1, 4)
+        self.image_width = image_width
+        self.image_height = image_height
+
+    @classmethod
+    def empty(cls, image_width, image_height) -> "Detections":
+        return cls([], [], [], image_width, image_height)
+
+    def __len__(self) -> int:
+        return len(self.class_ids)
+
+    def labels(self) -> List[str]:
+        return [CLASSES[idx] for idx in self.class_ids]
+
+    def to_dict(self) -> dict:
+        """
+        JSONで返せる形式に変換する
+        """
+        return {
+            "width": self.image_width,
+            "height": self.image_height,
+            "objects": [
+                {
+                    "class_id": int(idx),
+                    "label": CLASSES[idx],
+                    "confidence": round(float(score), 4),
+                    "box": box.tolist(),
+                }
+                for idx, score, box in zip(self.class_ids, self.scores, self.boxes)
+            ],
+        }
+
+
+def infer_objects(
+    blob, image_width, image_height, confidence_threshold=0.5, nms_threshold=0.45
+) -> Detections:
+    """
+    blobから物体検出を行い、Detectionsを返す
+    ボックスは元画像(image_width x image_height)の画素座標
+    """
+    w, h = image_width, image_height
+    # 推論は他の配信・スナップショットの要求とまとめて行う (結果はこの画像の分のみ)
+    detections = get_detection_service().infer(blob)
+
+    # 信頼度でフィルター
+    detections = detections[detections[:, 2] > confidence_threshold]
+    if not len(detections):
+        return Detections.empty(w, h)
+
+    # バウンディングボックス (元画像の範囲に収める)
+    boxes = detections[:, 3:7] * np.array([w, h, w, h], dtype=np.float32)
+    boxes = np.clip(boxes, 0, [w - 1, h - 1, w - 1, h - 1]).astype(np.int32)
+    class_ids = detections[:, 1].astype(np.int32)
+    scores = detections[:, 2]
+
+    # クラス毎に重なったボックスをまとめる
+    xywh = boxes.copy()
+    xywh[:, 2:] -= xywh[:, :2]
+    keep = cv2.dnn.NMSBoxesBatched(
+        xywh.tolist(),
+        scores.tolist(),
+        class_ids.tolist(),
+        confidence_threshold,
+        nms_threshold,
     )
+    keep = np.asarray(keep, dtype=np.int64).reshape(-1)
+    keep = keep[np.argsort(-scores[keep], kind="stable")]
+    return Detections(class_ids[keep], scores[keep], boxes[keep], w, h)
+
 
-    net.setInput(blob)
-    detections = net.forward()
-
-    # 検出結果を描画
-    for i in range(detections.shape[2]):
-        # 信頼度でフィルター
-        confidence = detections[0, 0, i, 2]
-        if confidence > confidence_threshold:
-            idx = int(detections[0, 0, i, 1])
-
-            # バウンディングボックス
-            box = detections[0, 0, i, 3:7] * np.array([w, h, w, h])
-            (startX, startY, endX, endY) = box.astype("int")
-            cv2.rectangle(frame, (startX, startY), (endX, endY), COLORS[idx], 2)
-
-            # ラベル
-            label = f"{CLASSES[idx]}: {confidence:.2f}"
-            y = startY - 15 if startY - 15 > 15 else startY + 15
-            cv2.putText(
-                frame, label, (startX, y), cv2.FONT_HERSHEY_SIMPLEX, 3.0, COLORS[idx], 2
-            )
-
-    return frame
+def _draw_objects(frame, objects: Detections, scale=1.0):
+    boxes = np.rint(objects.boxes * scale).astype(int)
+    for idx, confidence, box in zip(objects.class_ids, objects.scores, boxes):
+        (startX, startY, endX, endY) = box.tolist()
+        cv2.rectangle(frame, (startX, startY), (endX, endY), COLORS[idx], 2)
+
+        # ラベル
+        label = f"{CLASSES[idx]}: {confidence:.2f}"
+        y = startY - 15 if startY - 15 > 15 else startY + 15
+        cv2.putText(
+            frame, label, (startX, y), cv2.FONT_HERSHEY_SIMPLEX, 3.0, COLORS[idx], 2
+        )
+
+
+def draw_objects(frame, objects: Detections, scale=1.0):
+    """
+    検出済みの物体にボックスとラベルを描画した画像のコピーを返す
+    scaleは検出した画像に対する描画先の画像の倍率
+    """
+    result_frame = frame.copy()
+    _draw_objects(result_frame, objects, scale)
+    return result_frame
+
+
+def find_objects(frame, confidence_threshold=0.5) -> Detections:
+    """
+    画像から物体検出を行い、Detectionsを返す (画像は変更しない)
+    """
+    h, w = frame.shape[:2]
+    blob = blob_from_resized(resize_for_detection(frame))
+    return infer_objects(blob, w, h, confidence_threshold)
+
+
+def detect_objects(frame, confidence_threshold=0.5):
+    """
+    物体検出を行い、ボックスとラベルを描画した画像のコピーを返す (元の画像は変更しない)
+    """
+    return draw_objects(frame, find_objects(frame, confidence_threshold))
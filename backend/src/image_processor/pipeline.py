@@ -0,0 +1,218 @@
+import cv2
+from typing import Callable, Dict, Optional, Sequence, Tuple
+
+from src.image_processor import emotion, mesh_points, object_detection
+from src.image_processor.roi_tracker import RoiTracker
+
+"""
+画像処理パイプライン
+各段(Stage)は入力と出力の名前を宣言し、1フレーム内の中間結果(白黒画像や縮小画像など)は
+1度だけ計算して、必要とする全ての段で使い回す。
+
+段の流れ:
+    frame (ハブでデコード済みのフレーム)
+      ├─ gray (白黒化) ──┬─ binary (2値化)
+      │                  └─ emotions (顔・表情検出。配信では前回の顔の周辺を追跡)
+      ├─ detection_input (300x300に縮小) ─ blob ─ objects (物体検出)
+      └─ face_points (顔のメッシュ検出)
+    → 各プロセッサの描画 → JPEGエンコード (JpegCache)
+"""
+
+
+class Stage:
+    """
+    パイプラインの1段。inputsの中間結果を受け取り、outputを計算する。
+    """
+
+    def __init__(self, output: str, inputs: Tuple[str, ...], func: Callable):
+        self.output = output
+        self.inputs = inputs
+        self.func = func
+
+
+class FrameContext:
+    """
+    1フレーム分の中間結果を保持し、要求された時に1度だけ計算する。
+    """
+
+    def __init__(self, frame, stages: Dict[str, Stage]):
+        self._stages = stages
+        self._values = {"frame": frame}
+
+    def get(self, key: str):
+        if key not in self._values:
+            stage = self._stages[key]
+            self._values[key] = stage.func(*(self.get(k) for k in stage.inputs))
+        return self._values[key]
+
+
+class Processor:
+    """
+    利用者が選択できる処理の単位。
+    requiresの中間結果を使い、annotate(canvas, *values, scale)で描画した画像を返す。
+    realtime=Trueの処理は推論を間引かず、描画するフレーム毎に計算する。
+    """
+
+    def __init__(
+        self,
+        name: str,
+        requires: Tuple[str, ...],
+        annotate: Callable,
+        realtime: bool = False,
+    ):
+        self.name = name
+        self.requires = requires
+        self.annotate = annotate
+        self.realtime = realtime
+
+
+def _binary_to_canvas(canvas, binary, scale):
+    # 2値画像で置き換える (後続の処理がカラーで描画できるようBGRにする)
+    if binary.shape[:2] != canvas.shape[:2]:
+        binary = cv2.resize(binary, (canvas.shape[1], canvas.shape[0]))
+    return cv2.cvtColor(binary, cv2.COLOR_GRAY2BGR)
+
+
+def _build_stages(
+    face_mesh_engine=None, face_tracker=None, redetect_interval: int = 0
+) -> Dict[str, Stage]:
+    # 表情の顔検出の探索範囲を前回の顔の周辺に限定する追跡 (連続したフレームを処理する配信でのみ使う)
+    # メッシュはFaceMeshが追跡モードで前フレームのランドマークから探すため、画像全体をそのまま渡す
+    emotion_roi = RoiTracker(redetect_interval) if redetect_interval > 0 else None
+    stages = [
+        Stage("gray", ("frame",), lambda frame: cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)),
+        Stage(
+            "binary",
+            ("gray",),
+            lambda gray: cv2.threshold(gray, 127, 255, cv2.THRESH_BINARY)[1],
+        ),
+        Stage(
+            "emotions",
+            ("frame", "gray"),
+            lambda frame, gray: emotion.detect_emotions(
+                frame, gray=gray, roi_tracker=emotion_roi
+            ),
+        ),
+        Stage(
+            "detection_input", ("frame",), object_detection.resize_for_detection
+        ),
+        Stage("blob", ("detection_input",), object_detection.blob_from_resized),
+        Stage(
+            "objects",
+            ("frame", "blob"),
+            lambda frame, blob: object_detection.infer_objects(
+                blob, frame.shape[1], frame.shape[0]
+            ),
+        ),
+        Stage(
+            "face_points",
+            ("frame",),
+            lambda frame: mesh_points.detect_tracked_face_points(
+                frame, face_mesh_engine, face_tracker
+            ),
+        ),
+    ]
+    return {stage.output: stage for stage in stages}
+
+
+PROCESSORS = {
+    "binarize": Processor("binarize", ("binary",), _binary_to_canvas, realtime=True),
+    "emotion": Processor(
+        "emotion",
+        ("emotions",),
+        lambda canvas, emotions, scale: emotion.draw_emotions(
+            canvas, emotions, scale=scale
+        ),
+    ),
+    "objects": Processor(
+        "objects",
+        ("objects",),
+        lambda canvas, objects, scale: object_detection.draw_objects(
+            canvas, objects, scale=scale
+        ),
+    ),
+    "mesh": Processor(
+        "mesh",
+        ("face_points",),
+        lambda canvas, face_points, scale: mesh_points.draw_face_points(
+            canvas, *face_points, scale=scale
+        ),
+    ),
+}
+
+
+def parse_stages(stages: str) -> Tuple[str, ...]:
+    """
+    カンマ区切りのプロセッサ名を検証してタプルで返す。
+    不正な名前があればValueErrorを送出する。
+    """
+    names = tuple(name.strip() for name in stages.split(",") if name.strip())
+    if not names:
+        raise ValueError("プロセッサが指定されていません")
+    unknown = [name for name in names if name not in PROCESSORS]
+    if unknown:
+        raise ValueError(f"不正なプロセッサです: {', '.join(unknown)}")
+    return names
+
+
+class Pipeline:
+    """
+    選択されたプロセッサを指定順に適用するパイプライン。
+    infer()で推論結果をまとめて計算し、render()で描画する。
+    InferenceSchedulerに渡す場合はinferとrenderを分けて使い、
+    スナップショットなど1フレームだけ処理する場合は__call__を使う。
+    redetect_interval>0の場合、表情の顔検出は前回の顔の周辺だけを探索し、
+    画像全体の検出はredetect_intervalフレーム毎か見失った時だけ行う (配信用)。
+    """
+
+    def __init__(
+        self,
+        names: Sequence[str],
+        face_mesh_engine=None,
+        face_tracker=None,
+        redetect_interval: int = 0,
+    ):
+        self.processors = [PROCESSORS[name] for name in names]
+        self.name = "+".join(names)
+        self._stages = _build_stages(face_mesh_engine, face_tracker, redetect_interval)
+
+    def infer(self, frame, ctx: Optional[FrameContext] = None) -> dict:
+        """
+        推論が必要な(realtimeでない)プロセッサの中間結果を計算して返す
+        """
+        ctx = ctx or FrameContext(frame, self._stages)
+        return {
+            key: ctx.get(key)
+            for processor in self.processors
+            if not processor.realtime
+            for key in processor.requires
+        }
+
+    def render(
+        self,
+        frame,
+        results: dict,
+        scale: float = 1.0,
+        ctx: Optional[FrameContext] = None,
+    ):
+        """
+        推論結果をフレームに描画する。realtimeのプロセッサは描画するフレームから計算する。
+        元のフレームは変更しない。
+        """
+        ctx = ctx or FrameContext(frame, self._stages)
+        canvas = frame
+        for processor in self.processors:
+            if processor.realtime:
+                values = [ctx.get(key) for key in processor.requires]
+                canvas = processor.annotate(canvas, *values, 1.0)
+            else:
+                values = [results[key] for key in processor.requires]
+                canvas = processor.annotate(canvas, *values, scale)
+        return canvas
+
+    def __call__(self, frame):
+        """
+        1フレームを推論・描画する (中間結果は推論と描画で共有する)
+        """
+        ctx = FrameContext(frame, self._stages)
+        return self.render(frame, self.infer(frame, ctx), ctx=ctx)
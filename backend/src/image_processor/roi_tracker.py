@@ -0,0 +1,140 @@
+import cv2
+import numpy as np
+import threading
+from typing import Callable, List, Optional, Sequence, Tuple
+
+"""
+検出結果の追跡による探索範囲の限定
+顔を検出した後のフレームでは、前回のボックスの周辺だけを探索し、
+画像全体の検出は一定フレーム毎か追跡を見失った時だけ行う
+"""
+
+Box = Tuple[int, int, int, int]
+
+
+def expand_box(box: Box, margin: float, shape) -> Tuple[int, int, int, int]:
+    """
+    (x, y, w, h)のボックスを幅・高さのmargin倍ずつ広げ、画像の範囲に収めた
+    (x1, y1, x2, y2)を返す
+    """
+    x, y, w, h = box
+    height, width = shape[:2]
+    dx, dy = round(w * margin), round(h * margin)
+    return (
+        max(0, x - dx),
+        max(0, y - dy),
+        min(width, x + w + dx),
+        min(height, y + h + dy),
+    )
+
+
+class RoiTracker:
+    """
+    Haar分類器などで検出した顔のボックス(x, y, w, h)を、テンプレートマッチングで追跡するトラッカー。
+    update()で毎フレームのボックスを返す。
+    - redetect_intervalフレーム毎と、いずれかの顔を見失った時(一致度がmin_score未満)は
+      detect(gray)で画像全体から検出し直す
+    - それ以外のフレームでは、前回のボックスをmargin倍広げた範囲だけを縮小して探索する
+    テンプレートと顔の大きさは全体の検出時のものを使い続ける
+    (毎フレーム更新すると、縮小による位置の誤差が積み重なってずれていくため)。
+    状態を持つため、連続したフレームを処理するストリーム毎に1つ作成すること。
+    """
+
+    def __init__(
+        self,
+        redetect_interval: int = 10,
+        margin: float = 0.5,
+        min_score: float = 0.6,
+        template_width: int = 48,
+    ):
+        self.redetect_interval = redetect_interval
+        self.margin = margin
+        self.min_score = min_score
+        self.template_width = template_width
+
+        self._boxes: List[Box] = []
+        self._templates: List[np.ndarray] = []
+        self._since_detect = 0
+        self._lock = threading.Lock()
+
+    def update(self, gray, detect: Callable[[np.ndarray], Sequence[Box]]) -> List[Box]:
+        """
+        白黒画像の顔のボックス(x, y, w, h)のリストを返す
+        """
+        with self._lock:
+            boxes = None
+            if self._boxes and self._since_detect < self.redetect_interval:
+                boxes = self._track(gray)
+            if boxes is None:
+                boxes = [tuple(int(v) for v in box) for box in detect(gray)]
+                self._since_detect = 0
+                self._set(gray, boxes)
+            self._boxes = boxes
+            self._since_detect += 1
+            return list(boxes)
+
+    def reset(self):
+        with self._lock:
+            self._boxes = []
+            self._templates = []
+            self._since_detect = 0
+
+    def _scale(self, box: Box) -> float:
+        return min(1.0, self.template_width / max(box[2], 1))
+
+    def _set(self, gray, boxes: List[Box]):
+        # 次のフレームから探すテンプレートを、縮小した顔領域として保持する
+        self._templates = []
+        for x, y, w, h in boxes:
+            s = self._scale((x, y, w, h))
+            size = (max(1, round(w * s)), max(1, round(h * s)))
+            face = gray[y : y + h, x : x + w]
+            self._templates.append(
+                cv2.resize(face, size, interpolation=cv2.INTER_AREA)
+            )
+
+    def _track(self, gray) -> Optional[List[Box]]:
+        """
+        全ての顔を前回の周辺で探し、新しいボックスのリストを返す。1つでも見失えばNone。
+        """
+        boxes = []
+        for box, template in zip(self._boxes, self._templates):
+            x1, y1, x2, y2 = expand_box(box, self.margin, gray.shape)
+            s = self._scale(box)
+            region = gray[y1:y2, x1:x2]
+            size = (round(region.shape[1] * s), round(region.shape[0] * s))
+            if size[0] < template.shape[1] or size[1] < template.shape[0]:
+                return None
+            if s != 1.0:
+                region = cv2.resize(region, size, interpolation=cv2.INTER_AREA)
+
+            scores = cv2.matchTemplate(region, template, cv2.TM_CCOEFF_NORMED)
+            _, score, _, (mx, my) = cv2.minMaxLoc(scores)
+            if score < self.min_score:
+                return None
+            # 縮小した画像の1画素より細かい位置を、一致度のピークの形から求める
+            dx = _subpixel_offset(scores[my, max(mx - 1, 0) : mx + 2], mx)
+            dy = _subpixel_offset(scores[max(my - 1, 0) : my + 2, mx], my)
+            boxes.append(
+                (
+                    x1 + round((mx + dx) / s),
+                    y1 + round((my + dy) / s),
+                    box[2],
+                    box[3],
+                )
+            )
+        return boxes
+
+
+def _subpixel_offset(values, peak: int) -> float:
+    """
+    ピークとその両隣の値に放物線を当てはめ、ピークからのずれ(-0.5〜0.5)を返す
+    """
+    if peak == 0 or len(values) < 3:
+        return 0.0
+    left, center, right = (float(v) for v in values)
+    denominator = left - 2 * center + right
+    if denominator >= 0:
+        return 0.0
+    return max(-0.5, min(0.5, 0.5 * (left - right) / denominator))
+
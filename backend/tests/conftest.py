@@ -0,0 +1,98 @@
+import time
+from types import SimpleNamespace
+
+import pytest
+
+from src.camera.ptz_service import PTZService
+
+"""
+PTZのテストで共有する偽のONVIFカメラ
+PTZServiceの接続関数から渡し、SOAPの呼び出しを記録する
+"""
+
+
+class FakePTZ:
+    def __init__(self, camera):
+        self.camera = camera
+
+    def create_type(self, name):
+        return SimpleNamespace()
+
+    def _record(self, name):
+        self.camera.calls.append(name)
+        if self.camera.failures > 0:
+            self.camera.failures -= 1
+            raise ConnectionError("接続が切れました")
+
+    def ContinuousMove(self, request):
+        self._record("ContinuousMove")
+        pan_tilt = request.Velocity["PanTilt"]
+        self.camera.moves.append(
+            ("ContinuousMove", time.monotonic(), (pan_tilt["x"], pan_tilt["y"]))
+        )
+
+    def Stop(self, params):
+        self._record("Stop")
+        self.camera.moves.append(("Stop", time.monotonic(), None))
+
+    def GetPresets(self, params):
+        self._record("GetPresets")
+        return [
+            SimpleNamespace(token=token, Name=name)
+            for token, name in self.camera.presets.items()
+        ]
+
+    def SetPreset(self, params):
+        self._record("SetPreset")
+        token = params.get("PresetToken") or f"token{len(self.camera.presets) + 1}"
+        self.camera.presets[token] = params["PresetName"]
+        return token
+
+    def RemovePreset(self, params):
+        self._record("RemovePreset")
+        self.camera.presets.pop(params["PresetToken"], None)
+
+    def GetStatus(self, params):
+        self._record("GetStatus")
+        self.camera.pan += 0.1
+        return SimpleNamespace(
+            Position=SimpleNamespace(
+                PanTilt=SimpleNamespace(x=self.camera.pan, y=0.0),
+                Zoom=SimpleNamespace(x=0.0),
+            ),
+            MoveStatus=SimpleNamespace(PanTilt="IDLE"),
+        )
+
+
+class FakeCamera:
+    def __init__(self):
+        self.calls = []
+        # 移動・停止の記録 (名前, 時刻, パン・チルトの速度)
+        self.moves = []
+        self.failures = 0
+        self.presets = {"token1": "home"}
+        self.pan = 0.0
+
+    def create_ptz_service(self):
+        return FakePTZ(self)
+
+
+@pytest.fixture
+def camera():
+    return FakeCamera()
+
+
+@pytest.fixture
+def connects():
+    return []
+
+
+@pytest.fixture
+def service(camera, connects):
+    def connect():
+        connects.append(time.time())
+        return camera
+
+    service = PTZService(connect)
+    yield service
+    service.stop_status_polling()
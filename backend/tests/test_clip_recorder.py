@@ -0,0 +1,92 @@
+import random
+
+import pytest
+
+from src.camera.clip_recorder import FrameRing
+
+"""
+FrameRingのテスト
+容量を超えて追加し、残ったフレームが最新の連続したフレームで、内容が壊れていないことを確認する
+"""
+
+
+def frame_bytes(seq: int, size: int) -> bytes:
+    # フレーム毎に異なる内容にし、上書きや切り出しのずれを検出できるようにする
+    return bytes((seq * 7 + i) % 251 for i in range(size))
+
+
+def check_suffix(ring: FrameRing, appended: list):
+    frames = ring.frames_since(float("-inf"))
+    assert len(frames) == len(ring)
+    assert frames, "最新のフレームは必ず残る"
+    # 最新から連続したフレームが古い順に残る
+    assert frames == appended[-len(frames) :]
+    return frames
+
+
+@pytest.mark.parametrize("seed", [0, 1, 2])
+def test_wraps_and_keeps_newest_contiguous_suffix(seed):
+    rng = random.Random(seed)
+    capacity = 1000
+    ring = FrameRing(capacity, max_frames=16)
+    appended = []
+    for seq in range(300):
+        data = frame_bytes(seq, rng.randint(1, 300))
+        assert ring.append(seq, seq * 0.1, data)
+        appended.append((seq, seq * 0.1, data))
+
+        frames = check_suffix(ring, appended)
+        assert sum(len(data) for _, _, data in frames) <= capacity
+        assert len(frames) <= 16
+
+
+def test_max_frames_evicts_oldest():
+    ring = FrameRing(10000, max_frames=4)
+    appended = []
+    for seq in range(10):
+        data = frame_bytes(seq, 10)
+        ring.append(seq, float(seq), data)
+        appended.append((seq, float(seq), data))
+    frames = check_suffix(ring, appended)
+    assert [seq for seq, _, _ in frames] == [6, 7, 8, 9]
+
+
+def test_frames_since_returns_pre_roll():
+    ring = FrameRing(500, max_frames=8)
+    appended = []
+    for seq in range(20):
+        data = frame_bytes(seq, 60)
+        ring.append(seq, float(seq), data)
+        appended.append((seq, float(seq), data))
+
+    retained = check_suffix(ring, appended)
+    assert ring.frames_since(17.0) == appended[17:]
+    assert ring.frames_since(17.5) == appended[18:]
+    assert ring.frames_since(100.0) == []
+    # 保持している範囲より前を指定すれば、残っている全てのフレームを返す
+    assert ring.frames_since(0.0) == retained
+
+
+def test_frame_larger_than_buffer_is_rejected():
+    ring = FrameRing(100, max_frames=4)
+    ring.append(0, 0.0, frame_bytes(0, 50))
+    assert not ring.append(1, 1.0, frame_bytes(1, 101))
+    assert ring.frames_since(0.0) == [(0, 0.0, frame_bytes(0, 50))]
+
+
+def test_frame_of_buffer_size_replaces_all():
+    ring = FrameRing(100, max_frames=4)
+    ring.append(0, 0.0, frame_bytes(0, 30))
+    ring.append(1, 1.0, frame_bytes(1, 30))
+    assert ring.append(2, 2.0, frame_bytes(2, 100))
+    assert ring.frames_since(0.0) == [(2, 2.0, frame_bytes(2, 100))]
+
+
+def test_clear():
+    ring = FrameRing(100, max_frames=4)
+    ring.append(0, 0.0, frame_bytes(0, 30))
+    ring.clear()
+    assert len(ring) == 0
+    assert ring.frames_since(0.0) == []
+    ring.append(1, 1.0, frame_bytes(1, 30))
+    assert ring.frames_since(0.0) == [(1, 1.0, frame_bytes(1, 30))]
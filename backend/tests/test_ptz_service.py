@@ -0,0 +1,121 @@
+import threading
+import time
+
+import pytest
+
+from src.camera.ptz_service import PTZService
+
+"""
+PTZServiceのテスト
+ONVIFCameraの代わりに、呼び出しを記録する偽のカメラ(conftest.py)を接続関数から渡す
+"""
+
+
+def test_presets_are_cached(service, camera, connects):
+    assert service.get_presets() == [{"token": "token1", "name": "home"}]
+    assert service.find_preset("home") == {"token": "token1", "name": "home"}
+    assert camera.calls.count("GetPresets") == 1
+    assert len(connects) == 1
+
+
+def test_set_preset_invalidates_cache(service, camera):
+    service.get_presets()
+    token = service.set_preset("door")
+    assert {"token": token, "name": "door"} in service.get_presets()
+    assert camera.calls.count("GetPresets") == 2
+
+
+def test_set_preset_reuses_token_of_same_name(service, camera):
+    assert service.set_preset("home") == "token1"
+    assert camera.presets == {"token1": "home"}
+
+
+def test_remove_preset_invalidates_cache(service, camera):
+    service.get_presets()
+    service.remove_preset("token1")
+    assert service.get_presets() == []
+    assert camera.calls.count("GetPresets") == 2
+
+
+def test_reconnect_invalidates_cache(service, camera, connects):
+    service.get_presets()
+    camera.failures = 1
+    service.get_status()
+    assert len(connects) == 2
+    service.get_presets()
+    assert camera.calls.count("GetPresets") == 2
+
+
+def test_invalidate_drops_session_and_cache(service, camera, connects):
+    service.get_presets()
+    service.invalidate()
+    service.get_presets()
+    assert len(connects) == 2
+    assert camera.calls.count("GetPresets") == 2
+
+
+def test_retries_once_after_reconnect(service, camera, connects):
+    camera.failures = 1
+    assert service.get_status()["pan"] == pytest.approx(0.1)
+    assert camera.calls == ["GetStatus", "GetStatus"]
+    assert len(connects) == 2
+    assert service.health_check()["last_error"] is None
+
+
+def test_raises_after_second_failure(service, camera, connects):
+    camera.failures = 4
+    with pytest.raises(RuntimeError):
+        service.get_status()
+    assert camera.calls == ["GetStatus", "GetStatus"]
+    assert len(connects) == 2
+    status = service.health_check()
+    assert not status["healthy"]
+    assert not status["connected"]
+    assert status["last_error"] is not None
+
+
+def test_connect_failure_raises(camera):
+    def connect():
+        raise ConnectionError("カメラに接続できません")
+
+    with pytest.raises(RuntimeError):
+        PTZService(connect).get_status()
+
+
+def test_poller_updates_position(service):
+    assert service.position() is None
+    service.start_status_polling(interval=0.01)
+    deadline = time.time() + 2.0
+    first = None
+    while time.time() < deadline:
+        position = service.position()
+        if first is None and position is not None:
+            first = position
+        elif first is not None and position["pan"] > first["pan"]:
+            break
+        time.sleep(0.01)
+    else:
+        pytest.fail("ポーリングで位置が更新されませんでした")
+    assert position["move_status"] == "IDLE"
+
+
+def test_position_does_not_wait_for_soap_call(service, camera):
+    service.get_status()
+    started = threading.Event()
+    release = threading.Event()
+
+    def slow(session):
+        started.set()
+        release.wait(5.0)
+
+    thread = threading.Thread(target=service.call, args=(slow,))
+    thread.start()
+    try:
+        assert started.wait(1.0)
+        start = time.monotonic()
+        assert service.position() is not None
+        assert service.health_check()["healthy"]
+        assert time.monotonic() - start < 0.5
+    finally:
+        release.set()
+        thread.join()
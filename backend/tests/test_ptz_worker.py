@@ -0,0 +1,116 @@
+import time
+
+import pytest
+
+from src.camera.ptz_worker import PAN_TILT_VELOCITIES, PTZWorker
+
+"""
+PTZWorkerのテスト
+偽のカメラ(conftest.py)に届いた移動・停止の回数と時刻から、指示のまとめ方と取り消しを確認する
+"""
+
+
+@pytest.fixture
+def worker(service):
+    worker = PTZWorker(service)
+    worker.start()
+    yield worker
+    worker.stop()
+
+
+def wait_status(worker, command_id, statuses, timeout=3.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        status = worker.status(command_id)
+        if status["status"] in statuses:
+            return status
+        time.sleep(0.005)
+    pytest.fail(f"指示{command_id}が{statuses}になりませんでした: {status}")
+
+
+def names(camera):
+    return [name for name, _, _ in camera.moves]
+
+
+def test_same_direction_is_merged(worker, camera):
+    first = worker.submit("left", 0.2)
+    wait_status(worker, first, ("running",))
+    second = worker.submit("left", 0.2)
+
+    status = worker.status(second)
+    assert status["status"] == "merged"
+    assert status["merged_into"] == first
+
+    status = wait_status(worker, first, ("done",))
+    assert status["duration"] == pytest.approx(0.4)
+    assert names(camera) == ["ContinuousMove", "Stop"]
+    (_, started, velocity), (_, stopped, _) = camera.moves
+    assert velocity == PAN_TILT_VELOCITIES["left"]
+    assert stopped - started >= 0.35
+
+
+def test_opposite_direction_cancels_current(worker, camera):
+    first = worker.submit("left", 2.0)
+    wait_status(worker, first, ("running",))
+    second = worker.submit("right", 0.1)
+
+    wait_status(worker, second, ("done",))
+    assert worker.status(first)["status"] == "cancelled"
+    assert names(camera) == ["ContinuousMove", "Stop", "ContinuousMove", "Stop"]
+    started = camera.moves[0][1]
+    stopped = camera.moves[1][1]
+    assert stopped - started < 1.0
+    assert camera.moves[2][2] == PAN_TILT_VELOCITIES["right"]
+
+
+def test_other_directions_run_in_order(worker, camera):
+    first = worker.submit("up", 0.05)
+    second = worker.submit("left", 0.05)
+
+    wait_status(worker, second, ("done",))
+    assert worker.status(first)["status"] == "done"
+    velocities = [v for name, _, v in camera.moves if name == "ContinuousMove"]
+    assert velocities == [PAN_TILT_VELOCITIES["up"], PAN_TILT_VELOCITIES["left"]]
+
+
+def test_failed_move_is_reported(worker, camera):
+    camera.failures = 2
+    command_id = worker.submit("up", 0.05)
+    status = wait_status(worker, command_id, ("failed",))
+    assert status["error"]
+
+
+def test_invalid_direction(worker):
+    with pytest.raises(ValueError):
+        worker.submit("forward", 0.1)
+
+
+def test_pan_tilt_endpoint_reports_done(worker, monkeypatch):
+    # アプリの読み込みにはonvifなどカメラ用の依存が必要
+    pytest.importorskip("onvif")
+    from fastapi.testclient import TestClient
+
+    from src import app as app_module
+
+    monkeypatch.setattr(app_module.my_camera, "ptz_worker", worker)
+    client = TestClient(app_module.app)
+
+    resp = client.post("/pan_tilt", json={"direction": "up", "duration": 0.05})
+    assert resp.status_code == 200
+    command_id = resp.json()["command_id"]
+
+    deadline = time.monotonic() + 3.0
+    while time.monotonic() < deadline:
+        resp = client.get(f"/pan_tilt/{command_id}")
+        assert resp.status_code == 200
+        if resp.json()["status"] == "done":
+            break
+        time.sleep(0.01)
+    else:
+        pytest.fail("指示が完了しませんでした")
+
+    assert client.get("/pan_tilt/unknown").status_code == 404
+    assert (
+        client.post("/pan_tilt", json={"direction": "up", "duration": 0}).status_code
+        == 400
+    )
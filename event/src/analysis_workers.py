@@ -0,0 +1,93 @@
+import cv2
+import numpy as np
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from typing import List, Optional, Sequence
+
+from src.face_mesh_engine import FaceMeshEngine
+from src.mesh_processing import extract_multi_face_features
+from src.motion_detection import MotionDetector, MotionZone
+
+"""
+動体検知・顔の特徴取得のワーカープロセス
+CPUを使う解析はイベントループと別のプロセスで行い、SSEの配信を止めない
+各ワーカーは検知器・FaceMeshを初期化時に1度だけ作成し、温めたまま使い回す
+"""
+
+# ワーカープロセス内で保持する検知器・エンジン
+_motion_detector: Optional[MotionDetector] = None
+_face_mesh_engine: Optional[FaceMeshEngine] = None
+
+
+def _init_motion_worker(alpha: float, min_area_ratio: float, zones: Sequence[MotionZone]):
+    global _motion_detector
+    _motion_detector = MotionDetector(
+        alpha=alpha, min_area_ratio=min_area_ratio, zones=zones
+    )
+
+
+def _init_face_worker(max_num_faces: int):
+    global _face_mesh_engine
+    # ワーカー間でフレームが振り分けられるため、追跡状態を持たない静止画モードで使う
+    _face_mesh_engine = FaceMeshEngine(
+        static_image_mode=True, max_num_faces=max_num_faces
+    )
+    # モデルの読み込みを初回の解析より前に済ませておく
+    _face_mesh_engine.process(np.zeros((64, 64, 3), dtype=np.uint8))
+
+
+def analyze_motion(jpeg: bytes):
+    """
+    JPEGを縮小した白黒画像としてデコードし、(動体の有無, エリア毎の状態, 変化した範囲)を返す。
+    デコードできなければNoneを返す。
+    """
+    arr = np.frombuffer(jpeg, dtype=np.uint8)
+    gray = cv2.imdecode(arr, cv2.IMREAD_REDUCED_GRAYSCALE_2)
+    if gray is None:
+        return None
+    return _motion_detector.analyze_region(gray)
+
+
+def reset_motion():
+    """
+    背景モデルを破棄する (配信の再接続時など)
+    """
+    _motion_detector.reset()
+
+
+def analyze_faces(jpeg: bytes) -> Optional[List[dict]]:
+    """
+    JPEGをデコードし、検出した全ての顔の特徴量辞書(bbox付き)のリストを返す。
+    追跡IDは呼び出し側で振る。デコードできなければNoneを返す。
+    """
+    arr = np.frombuffer(jpeg, dtype=np.uint8)
+    frame = cv2.imdecode(arr, cv2.IMREAD_COLOR)
+    if frame is None:
+        return None
+    return extract_multi_face_features(frame, _face_mesh_engine)
+
+
+def create_motion_pool(
+    alpha: float, min_area_ratio: float, zones: Sequence[MotionZone]
+) -> ProcessPoolExecutor:
+    """
+    動体検知用のプール。背景モデルは状態を持つため、フレームの順序を保つよう1プロセスとする。
+    """
+    return ProcessPoolExecutor(
+        max_workers=1,
+        mp_context=multiprocessing.get_context("spawn"),
+        initializer=_init_motion_worker,
+        initargs=(alpha, min_area_ratio, list(zones)),
+    )
+
+
+def create_face_pool(workers: int, max_num_faces: int) -> ProcessPoolExecutor:
+    """
+    顔の特徴取得用のプール。workers個のプロセスがそれぞれFaceMeshを保持する。
+    """
+    return ProcessPoolExecutor(
+        max_workers=workers,
+        mp_context=multiprocessing.get_context("spawn"),
+        initializer=_init_face_worker,
+        initargs=(max_num_faces,),
+    )
@@ -0,0 +1,90 @@
+import asyncio
+import json
+from collections import deque
+from typing import AsyncIterator, Callable, Hashable, Optional
+
+"""
+SSEの配信ハブ
+状態が変化した時だけ新しい版として1度だけシリアライズし、全購読者に配る
+"""
+
+
+class EventHub:
+    """
+    版番号付きの状態を保持し、SSEのメッセージとして購読者に配るハブ。
+    publish()された状態はfingerprintが前の版と同じなら配信しない(時刻などの変化は無視する)。
+    各版のメッセージは1度だけ作り、直近history件を保持してLast-Event-IDからの再開に使う。
+    変化が無い間はheartbeat秒毎にコメント行だけを送り、接続を維持する。
+    イベントループのスレッドから使うこと。
+    """
+
+    def __init__(
+        self,
+        history: int = 64,
+        heartbeat: float = 15.0,
+        fingerprint: Optional[Callable[[dict], Hashable]] = None,
+    ):
+        self._history: deque = deque(maxlen=history)
+        self._heartbeat = heartbeat
+        self._fingerprint = fingerprint or (
+            lambda state: json.dumps(state, sort_keys=True)
+        )
+        self._last_key = None
+        self._version = 0
+        self._changed = asyncio.Event()
+
+    @property
+    def version(self) -> int:
+        return self._version
+
+    def publish(self, state: dict) -> bool:
+        """
+        状態を登録する。前の版から変化していれば新しい版として配信し、Trueを返す。
+        """
+        key = self._fingerprint(state)
+        if self._version and key == self._last_key:
+            return False
+        self._last_key = key
+
+        self._version += 1
+        data = json.dumps(state, ensure_ascii=False)
+        self._history.append((self._version, f"id: {self._version}\ndata: {data}\n\n"))
+
+        # 待っている購読者を全て起こす
+        self._changed.set()
+        self._changed = asyncio.Event()
+        return True
+
+    def _messages_after(self, version: int) -> list:
+        """
+        versionより新しい版のメッセージを返す。
+        履歴から外れた(または不明な)版の場合は最新の版だけを返す。
+        """
+        if not self._history:
+            return []
+        oldest = self._history[0][0]
+        if version + 1 < oldest or version > self._version:
+            return [self._history[-1]]
+        return [item for item in self._history if item[0] > version]
+
+    async def subscribe(self, last_event_id: Optional[int] = None) -> AsyncIterator[str]:
+        """
+        SSEのメッセージを順に返す。
+        last_event_idがあればその続きから、無ければ最新の版から送る。
+        """
+        if last_event_id is None:
+            version = self._history[-1][0] - 1 if self._history else 0
+        else:
+            version = last_event_id
+
+        while True:
+            for version, message in self._messages_after(version):
+                yield message
+
+            changed = self._changed
+            if self._history and self._history[-1][0] > version:
+                continue
+            try:
+                await asyncio.wait_for(changed.wait(), timeout=self._heartbeat)
+            except asyncio.TimeoutError:
+                yield ": heartbeat\n\n"
@@ -1,112 +1,354 @@
-from fastapi import FastAPI
-from fastapi.responses import StreamingResponse
+from fastapi import FastAPI, HTTPException, Request
+from fastapi.responses import Response, StreamingResponse
 import asyncio
 import httpx
-import json
 import time
-import cv2
-import numpy as np
+import logging
 import os
+from concurrent.futures import ProcessPoolExecutor
+from typing import Optional
 from dotenv import load_dotenv
 
-from src.mesh_processing import extract_face_features
+from src.analysis_workers import (
+    analyze_faces,
+    analyze_motion,
+    create_face_pool,
+    create_motion_pool,
+    reset_motion,
+)
+from src.face_tracker import FaceTracker
+from src.mjpeg_stream import iter_mjpeg
+from src.motion_detection import parse_zones
+from src.event_hub import EventHub
+from src.event_store import EventStore
+
+logger = logging.getLogger("uvicorn")
 
 if os.path.exists(".env"):
     load_dotenv()
 
 CAMERA_SERVER_URL = os.environ["CAMERA_SERVER_URL"]
+# 顔検出する最大人数
+MAX_NUM_FACES = int(os.environ.get("MAX_NUM_FACES", 1))
+# 動体検知用に購読する配信の幅(px)・JPEG品質・最大フレームレート
+MOTION_FEED_WIDTH = int(os.environ.get("MOTION_FEED_WIDTH", 640))
+MOTION_FEED_QUALITY = int(os.environ.get("MOTION_FEED_QUALITY", 70))
+MOTION_FEED_FPS = float(os.environ.get("MOTION_FEED_FPS", 5))
+# 動体検知の背景の更新率と、動体とみなす最小面積(検知エリアの面積に対する比率)
+MOTION_ALPHA = float(os.environ.get("MOTION_ALPHA", 0.05))
+MOTION_MIN_AREA_RATIO = float(os.environ.get("MOTION_MIN_AREA_RATIO", 0.002))
+# 動体検知のエリア (JSON。座標は画像の幅・高さに対する比率。未指定の場合は画像全体)
+MOTION_ZONES = parse_zones(os.environ.get("MOTION_ZONES", ""))
+# 顔の特徴を取得する間隔(秒)
+FACE_INTERVAL_SECONDS = float(os.environ.get("FACE_INTERVAL_SECONDS", 1.0))
+# 映像に変化が無い間も顔の特徴を取得し直す間隔(秒)と、動体が無くなってから取得を続ける時間(秒)
+FACE_KEEPALIVE_SECONDS = float(os.environ.get("FACE_KEEPALIVE_SECONDS", 30.0))
+FACE_MOTION_HOLD_SECONDS = float(os.environ.get("FACE_MOTION_HOLD_SECONDS", 2.0))
+# 顔の特徴を取得するワーカープロセス数 (それぞれがFaceMeshを保持する)
+FACE_WORKERS = int(os.environ.get("FACE_WORKERS", 2))
+# 物体検出の結果を取得する間隔(秒) (0の場合は取得しない)
+OBJECT_INTERVAL_SECONDS = float(os.environ.get("OBJECT_INTERVAL_SECONDS", 2.0))
+# 配信が切れた場合に再接続するまでの待ち時間(秒)
+RECONNECT_INTERVAL_SECONDS = 2.0
+# イベント履歴のSQLiteファイル
+EVENT_DB_PATH = os.environ.get("EVENT_DB_PATH", "events.db")
+# 変化が無い間にSSEの接続維持のコメントを送る間隔(秒)
+SSE_HEARTBEAT_SECONDS = float(os.environ.get("SSE_HEARTBEAT_SECONDS", 15.0))
 
 app = FastAPI()
 
 # グローバルで動体検知の状態を保持
 motion_state = {"motion": False, "timestamp": None}
+# 最新の物体検出の結果 (動体検知の状態に合わせて配信する)
+object_state = {}
 
 
-def detect_motion(prev_frame, curr_frame, threshold=50, min_area=3000):
+def _state_fingerprint(state: dict):
     """
-    前フレームと現在フレームを比較して動体検知
+    配信するかを判定するための状態の要約 (時刻や数値の揺れだけの変化は配信しない)
     """
-    # 前処理 (白黒化&ぼかし)
-    prev_gray = cv2.cvtColor(prev_frame, cv2.COLOR_BGR2GRAY)
-    curr_gray = cv2.cvtColor(curr_frame, cv2.COLOR_BGR2GRAY)
-    prev_gray = cv2.GaussianBlur(prev_gray, (21, 21), 0)
-    curr_gray = cv2.GaussianBlur(curr_gray, (21, 21), 0)
-
-    # 差分抽出
-    frame_delta = cv2.absdiff(prev_gray, curr_gray)
-    _, thresh_img = cv2.threshold(frame_delta, threshold, 255, cv2.THRESH_BINARY)
-
-    # 輪郭抽出
-    contours, _ = cv2.findContours(
-        thresh_img, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE
+    return (
+        state.get("motion"),
+        state.get("error"),
+        state.get("face_detected"),
+        tuple((zone["name"], zone["active"]) for zone in state.get("zones", [])),
+        tuple(state.get("object_labels", [])),
+        tuple(
+            (
+                face.get("track_id"),
+                face.get("orientation"),
+                face.get("eyes_closed"),
+                face.get("mouth_closed"),
+            )
+            for face in state.get("faces", [])
+        ),
     )
 
-    # 十分に大きな動体があるか判定
-    for cnt in contours:
-        if cv2.contourArea(cnt) > min_area:
-            return True
-    return False
+
+# 状態の変化を全クライアントに配る配信ハブ
+event_hub = EventHub(heartbeat=SSE_HEARTBEAT_SECONDS, fingerprint=_state_fingerprint)
+
+
+def update_motion_state(state: dict):
+    """
+    最新の状態を保持し、変化していれば配信する
+    """
+    global motion_state
+    motion_state = state
+    event_hub.publish(state)
+
+
+# 解析用のプロセスプール (起動時に作成)
+motion_pool: Optional[ProcessPoolExecutor] = None
+face_pool: Optional[ProcessPoolExecutor] = None
+# フレーム間で同じ人物に同じIDを振るトラッカー (ワーカーの結果にメインプロセスで振る)
+face_tracker = FaceTracker()
+# イベント履歴 (起動時に開く)
+event_store: Optional[EventStore] = None
 
 
 @app.on_event("startup")
 async def startup_event():
     """
-    アプリケーション起動時に動体検知ジョブを開始
+    アプリケーション起動時に解析用のプロセスプールを作成し、動体検知ジョブを開始
     """
+    global motion_pool, face_pool, event_store
+    event_store = EventStore(EVENT_DB_PATH)
+    motion_pool = create_motion_pool(MOTION_ALPHA, MOTION_MIN_AREA_RATIO, MOTION_ZONES)
+    face_pool = create_face_pool(FACE_WORKERS, MAX_NUM_FACES)
 
     # 動体検知ジョブの定義
-    # 5秒おきにカメラサーバーからフレームを取得し、動体検知を行う
+    # カメラサーバーの縮小配信を購読し、届いたフレーム毎に動体検知を行う
+    # 解析はプロセスプールで行い、イベントループでは結果の反映と配信のみ行う
     async def motion_detection_job():
-        global motion_state
-        prev_frame = None
+        loop = asyncio.get_running_loop()
+        motion_part = {}
+        face_state = {}
+        face_tasks = set()
+        last_face_time = 0.0
+        last_face_seq = -1
+        last_motion_time = 0.0
+        params = {
+            "width": MOTION_FEED_WIDTH,
+            "quality": MOTION_FEED_QUALITY,
+            "fps": MOTION_FEED_FPS,
+        }
+
+        def publish():
+            update_motion_state({**motion_part, **face_state, **object_state})
+
+        async def record_event(kind, state, jpeg):
+            # 検知したフレームのJPEGと一緒に履歴へ追記し、イベントIDを返す
+            try:
+                return await asyncio.to_thread(event_store.append, kind, state, jpeg)
+            except Exception:
+                logger.exception("イベントを保存できませんでした")
+                return None
+
+        async def run_face_analysis(seq, jpeg):
+            # 顔の特徴取得 (先頭の顔の特徴はトップレベルにも展開する)
+            nonlocal face_state, last_face_seq
+            try:
+                faces = await loop.run_in_executor(face_pool, analyze_faces, jpeg)
+            except Exception as e:
+                logger.warning("顔の特徴取得に失敗しました: %s", e)
+                return
+            # ワーカーの完了順は前後するため、古いフレームの結果は捨てる
+            if faces is None or (seq is not None and seq < last_face_seq):
+                return
+            last_face_seq = seq if seq is not None else last_face_seq
+
+            track_ids = face_tracker.update([face["bbox"] for face in faces])
+            for face, track_id in zip(faces, track_ids):
+                face["track_id"] = track_id
+            was_detected = face_state.get("face_detected", False)
+            face_event_id = face_state.get("face_event_id")
+            face_state = {"face_detected": bool(faces)}
+            if faces:
+                face_state.update(faces[0])
+            face_state["faces"] = faces
+
+            # 顔が映った瞬間を記録
+            if faces and not was_detected:
+                face_event_id = await record_event("face", face_state, jpeg)
+            face_state["face_event_id"] = face_event_id
+            if motion_part:
+                publish()
+
+        async with httpx.AsyncClient() as client:
+            while True:
+                try:
+                    async for seq, jpeg in iter_mjpeg(
+                        client, f"{CAMERA_SERVER_URL}/video", params
+                    ):
+                        # 動体検知 (背景モデルと差分をとる)
+                        # 背景モデルは状態を持つため1プロセスで順に処理する
+                        result = await loop.run_in_executor(
+                            motion_pool, analyze_motion, jpeg
+                        )
+                        if result is None:
+                            continue
+                        motion, zones, region = result
+
+                        # 顔の特徴取得 (FACE_INTERVAL_SECONDS毎に、空いているワーカーがあれば依頼する)
+                        # 映像に変化が無い間はFACE_KEEPALIVE_SECONDS毎に間引き、直前の結果を使う
+                        now = time.time()
+                        if motion:
+                            last_motion_time = now
+                        changed = (
+                            not face_state
+                            or now - last_motion_time <= FACE_MOTION_HOLD_SECONDS
+                            or now - last_face_time >= FACE_KEEPALIVE_SECONDS
+                        )
+                        if (
+                            changed
+                            and now - last_face_time >= FACE_INTERVAL_SECONDS
+                            and len(face_tasks) < FACE_WORKERS
+                        ):
+                            last_face_time = now
+                            task = asyncio.create_task(run_face_analysis(seq, jpeg))
+                            face_tasks.add(task)
+                            task.add_done_callback(face_tasks.discard)
+
+                        was_motion = motion_part.get("motion", False)
+                        motion_event_id = motion_part.get("motion_event_id")
+                        motion_part = {
+                            "motion": bool(motion),
+                            "timestamp": time.strftime("%Y-%m-%d %H:%M:%S"),
+                            "seq": seq,
+                            "zones": zones,
+                            "region": region,
+                        }
+
+                        # 動体を検知した瞬間を、検知したフレームと一緒に記録
+                        if motion and not was_motion:
+                            motion_event_id = await record_event(
+                                "motion", motion_part, jpeg
+                            )
+                        motion_part["motion_event_id"] = motion_event_id
+                        publish()
 
+                    raise RuntimeError("配信が終了しました")
+
+                except Exception as e:
+                    update_motion_state({"motion": False, "error": str(e)})
+                    motion_part = {}
+                    face_state = {}
+                    try:
+                        await loop.run_in_executor(motion_pool, reset_motion)
+                    except Exception:
+                        logger.exception("背景モデルを破棄できませんでした")
+
+                await asyncio.sleep(RECONNECT_INTERVAL_SECONDS)  # 再接続までの待ち時間(秒)
+
+    # 物体検出ジョブの定義
+    # カメラサーバーから検出結果のみをJSONで取得する (JPEGは転送しない)
+    async def object_detection_job():
+        global object_state
+        labels = []
+        failing = False
         async with httpx.AsyncClient() as client:
             while True:
                 try:
-                    # カメラサーバーからスナップショットを取得
-                    resp = await client.get(f"{CAMERA_SERVER_URL}/snapshot", timeout=10)
-                    arr = np.frombuffer(resp.content, dtype=np.uint8)
-                    frame = cv2.imdecode(arr, cv2.IMREAD_COLOR)
-                    
-                    # 動体検知 (1つ前のフレームと差分をとる) 
-                    if prev_frame is not None:
-                        if detect_motion(prev_frame, frame):
-                            motion_state = {
-                                "motion": True,
-                                "timestamp": time.strftime("%Y-%m-%d %H:%M:%S"),
-                            }
-                        else:
-                            motion_state = {
-                                "motion": False, 
-                                "timestamp": time.strftime("%Y-%m-%d %H:%M:%S"
-                            )}
-
-                    prev_frame = frame
-
-                    # 顔の特徴取得
-                    features = extract_face_features(frame)
-                    if features:
-                        motion_state.update({"face_detected": True})
-                        motion_state.update(features)
-                    else:
-                        motion_state.update({"face_detected": False})
+                    resp = await client.get(
+                        f"{CAMERA_SERVER_URL}/snapshot",
+                        params={"mode": "objects"},
+                        timeout=10,
+                    )
+                    resp.raise_for_status()
+                    result = resp.json()
+                    failing = False
 
+                    previous_labels = labels
+                    labels = sorted({obj["label"] for obj in result["objects"]})
+                    object_state = {
+                        "objects": result["objects"],
+                        "object_labels": labels,
+                        "object_seq": result.get("result_seq"),
+                    }
+                    # 新しい種類の物体が映った時を記録
+                    if set(labels) - set(previous_labels):
+                        await asyncio.to_thread(
+                            event_store.append, "objects", object_state
+                        )
+                    update_motion_state({**motion_state, **object_state})
                 except Exception as e:
-                    motion_state = {"motion": False, "error": str(e)}
+                    # 失敗が続く間は1度だけ記録する
+                    if not failing:
+                        logger.warning("物体検出の結果を取得できませんでした: %s", e)
+                    failing = True
+
+                await asyncio.sleep(OBJECT_INTERVAL_SECONDS)
 
-                await asyncio.sleep(10)  # チェック間隔(秒)
+    # 接続直後のクライアントにも初期状態を送れるよう、最初の版として登録
+    event_hub.publish(motion_state)
 
     # バックグラウンドで動体検知ジョブを開始
     asyncio.create_task(motion_detection_job())
+    if OBJECT_INTERVAL_SECONDS > 0:
+        asyncio.create_task(object_detection_job())
 
 
-async def event_generator():
-    while True:
-        event = json.dumps(motion_state, ensure_ascii=False)
-        yield f"data: {event}\n\n"
-        await asyncio.sleep(1)  # イベント送信間隔(秒)
+@app.on_event("shutdown")
+async def shutdown_event():
+    """
+    アプリケーション終了時に解析用のプロセスプールを停止
+    """
+    for pool in (motion_pool, face_pool):
+        if pool is not None:
+            pool.shutdown(wait=False, cancel_futures=True)
+    if event_store is not None:
+        event_store.close()
 
 
 @app.get("/event")
-async def event_stream():
-    return StreamingResponse(event_generator(), media_type="text/event-stream")
+async def event_stream(request: Request):
+    """
+    状態が変化した時だけSSEで送る (変化が無い間は接続維持のコメントのみ)
+    Last-Event-IDヘッダがあれば、その続きの版から送る
+    """
+    try:
+        last_event_id = int(request.headers["last-event-id"])
+    except (KeyError, ValueError):
+        last_event_id = None
+
+    return StreamingResponse(
+        event_hub.subscribe(last_event_id), media_type="text/event-stream"
+    )
+
+
+@app.get("/events")
+async def events(
+    since: float = None,
+    until: float = None,
+    limit: int = 50,
+    kind: str = None,
+    before_id: int = None,
+):
+    """
+    since <= ts < until (UNIX時間) のイベントを新しい順に最大limit件返す
+    続きはnext_untilをuntilに、next_before_idをbefore_idに指定して取得する
+    """
+    if not 1 <= limit <= 1000:
+        raise HTTPException(status_code=400, detail="不正なlimitです")
+    rows = await asyncio.to_thread(
+        event_store.query, since, until, limit, kind, before_id
+    )
+    for row in rows:
+        row["image_url"] = f"/events/{row['id']}/image" if row["has_image"] else None
+    if len(rows) == limit:
+        next_until, next_before_id = rows[-1]["ts"], rows[-1]["id"]
+    else:
+        next_until = next_before_id = None
+    return {"events": rows, "next_until": next_until, "next_before_id": next_before_id}
+
+
+@app.get("/events/{event_id}/image")
+async def event_image(event_id: int):
+    """
+    イベントを検知したフレームのJPEGを返す
+    """
+    image = await asyncio.to_thread(event_store.get_image, event_id)
+    if image is None:
+        raise HTTPException(status_code=404, detail="画像がありません")
+    return Response(content=image, media_type="image/jpeg")
@@ -0,0 +1,111 @@
+import json
+import sqlite3
+import threading
+import time
+from typing import List, Optional
+
+"""
+イベント履歴の保存
+動体検知・顔検出のイベントを、検知したフレームのJPEGと一緒にSQLiteに追記する
+"""
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS events (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    ts REAL NOT NULL,
+    kind TEXT NOT NULL,
+    state TEXT NOT NULL,
+    image BLOB
+);
+CREATE INDEX IF NOT EXISTS events_ts ON events (ts);
+"""
+
+
+class EventStore:
+    """
+    追記専用のイベント履歴。時刻(ts)の索引で範囲検索する。
+    接続は1本をロックで守って共有するため、どのスレッドからでも呼び出せる。
+    """
+
+    def __init__(self, path: str = "events.db"):
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.executescript(_SCHEMA)
+        self._lock = threading.Lock()
+
+    def append(
+        self,
+        kind: str,
+        state: dict,
+        image: Optional[bytes] = None,
+        ts: Optional[float] = None,
+    ) -> int:
+        """
+        イベントを追記し、イベントIDを返す
+        """
+        ts = time.time() if ts is None else ts
+        with self._lock, self._conn:
+            cur = self._conn.execute(
+                "INSERT INTO events (ts, kind, state, image) VALUES (?, ?, ?, ?)",
+                (ts, kind, json.dumps(state, ensure_ascii=False), image),
+            )
+            return cur.lastrowid
+
+    def query(
+        self,
+        since: Optional[float] = None,
+        until: Optional[float] = None,
+        limit: int = 50,
+        kind: Optional[str] = None,
+        before_id: Optional[int] = None,
+    ) -> List[dict]:
+        """
+        since <= ts < until のイベントを新しい順に最大limit件返す (画像は含まない)
+        before_idを指定すると、ts = until でidがbefore_id未満のイベントも含める
+        (前のページの最後と同じ時刻のイベントを読み飛ばさないため)
+        """
+        where, params = [], []
+        if since is not None:
+            where.append("ts >= ?")
+            params.append(since)
+        if until is not None and before_id is not None:
+            where.append("(ts < ? OR (ts = ? AND id < ?))")
+            params.extend([until, until, before_id])
+        elif until is not None:
+            where.append("ts < ?")
+            params.append(until)
+        if kind is not None:
+            where.append("kind = ?")
+            params.append(kind)
+        sql = "SELECT id, ts, kind, state, image IS NOT NULL FROM events"
+        if where:
+            sql += " WHERE " + " AND ".join(where)
+        sql += " ORDER BY ts DESC, id DESC LIMIT ?"
+        params.append(limit)
+
+        with self._lock:
+            rows = self._conn.execute(sql, params).fetchall()
+        return [
+            {
+                "id": row[0],
+                "ts": row[1],
+                "kind": row[2],
+                "state": json.loads(row[3]),
+                "has_image": bool(row[4]),
+            }
+            for row in rows
+        ]
+
+    def get_image(self, event_id: int) -> Optional[bytes]:
+        """
+        イベントのJPEGを返す。無ければNoneを返す。
+        """
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT image FROM events WHERE id = ?", (event_id,)
+            ).fetchone()
+        return row[0] if row else None
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
@@ -0,0 +1,161 @@
+import cv2
+import mediapipe as mp
+import queue
+import threading
+from contextlib import contextmanager
+from typing import Iterator, Optional
+
+mp_face_mesh = mp.solutions.face_mesh
+
+"""
+MediaPipe FaceMeshの使い回し
+モデル(TFLiteグラフ)の読み込みは重いため、インスタンスを作り直さずに保持する
+"""
+
+
+class FaceMeshEngine:
+    """
+    MediaPipe FaceMeshを1つ保持し、使い回すエンジン。
+    static_image_mode=Falseの場合は前フレームの追跡状態を引き継ぐため、
+    ストリーム毎に1つ作成すること。
+    """
+
+    def __init__(
+        self,
+        static_image_mode: bool = False,
+        max_num_faces: int = 1,
+        refine_landmarks: bool = True,
+    ):
+        self._face_mesh = mp_face_mesh.FaceMesh(
+            static_image_mode=static_image_mode,
+            max_num_faces=max_num_faces,
+            refine_landmarks=refine_landmarks,
+        )
+        # FaceMesh.processはスレッドセーフではない
+        self._lock = threading.Lock()
+
+    def process(self, frame):
+        """
+        BGR画像から顔のランドマークを検出し、mediapipeの結果を返す
+        """
+        rgb_frame = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
+        with self._lock:
+            return self._face_mesh.process(rgb_frame)
+
+    def close(self):
+        with self._lock:
+            self._face_mesh.close()
+
+    def __enter__(self) -> "FaceMeshEngine":
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class FaceMeshPool:
+    """
+    単発のスナップショット処理用に、静止画モードのFaceMeshEngineを
+    最大size個まで保持するスレッドセーフなプール。
+    エンジンは必要になった時点で作成する。
+    """
+
+    def __init__(self, size: int = 2, max_num_faces: int = 1):
+        self._size = size
+        self._max_num_faces = max_num_faces
+        self._idle: "queue.LifoQueue[FaceMeshEngine]" = queue.LifoQueue()
+        self._created = 0
+        self._lock = threading.Lock()
+        self._closed = False
+
+    @contextmanager
+    def borrow(self, timeout: Optional[float] = None) -> Iterator[FaceMeshEngine]:
+        """
+        空いているエンジンを借りる。全て使用中で上限に達していれば返却を待つ。
+        """
+        engine = self._acquire(timeout)
+        try:
+            yield engine
+        finally:
+            self._release(engine)
+
+    def _acquire(self, timeout: Optional[float]) -> FaceMeshEngine:
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+
+        with self._lock:
+            if self._closed:
+                raise RuntimeError("FaceMeshPoolは終了済みです")
+            can_create = self._created < self._size
+            if can_create:
+                self._created += 1
+
+        if can_create:
+            return FaceMeshEngine(
+                static_image_mode=True, max_num_faces=self._max_num_faces
+            )
+
+        try:
+            return self._idle.get(timeout=timeout)
+        except queue.Empty:
+            raise RuntimeError("FaceMeshエンジンを確保できませんでした")
+
+    def _release(self, engine: FaceMeshEngine):
+        with self._lock:
+            closed = self._closed
+        if closed:
+            engine.close()
+        else:
+            self._idle.put(engine)
+
+    def close(self):
+        """
+        保持している全エンジンを解放する。使用中のエンジンは返却時に解放する。
+        """
+        with self._lock:
+            self._closed = True
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except queue.Empty:
+                break
+
+
+# スナップショット用の共有プール
+_pool: Optional[FaceMeshPool] = None
+_pool_lock = threading.Lock()
+
+
+def init_face_mesh_pool(size: int = 2, max_num_faces: int = 1):
+    """
+    アプリ起動時に呼び出し、共有プールを作成する
+    """
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.close()
+        _pool = FaceMeshPool(size, max_num_faces)
+
+
+def close_face_mesh_pool():
+    """
+    アプリ終了時に呼び出し、共有プールを解放する
+    """
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.close()
+        _pool = None
+
+
+def get_face_mesh_pool() -> FaceMeshPool:
+    """
+    共有プールを返す。未作成であれば既定のサイズで作成する。
+    """
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = FaceMeshPool()
+        return _pool
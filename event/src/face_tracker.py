@@ -0,0 +1,140 @@
+import numpy as np
+import threading
+
+"""
+顔の追跡
+フレーム間で顔のバウンディングボックスを対応付け、同じ人物に同じIDを振る
+"""
+
+
+def _iou_matrix(a, b):
+    """
+    (N, 4)と(M, 4)の[x1, y1, x2, y2]の全組み合わせのIoUを(N, M)で返す
+    """
+    x1 = np.maximum(a[:, None, 0], b[None, :, 0])
+    y1 = np.maximum(a[:, None, 1], b[None, :, 1])
+    x2 = np.minimum(a[:, None, 2], b[None, :, 2])
+    y2 = np.minimum(a[:, None, 3], b[None, :, 3])
+    inter = np.clip(x2 - x1, 0, None) * np.clip(y2 - y1, 0, None)
+
+    area_a = (a[:, 2] - a[:, 0]) * (a[:, 3] - a[:, 1])
+    area_b = (b[:, 2] - b[:, 0]) * (b[:, 3] - b[:, 1])
+    union = area_a[:, None] + area_b[None, :] - inter
+    return np.divide(inter, union, out=np.zeros_like(inter), where=union > 0)
+
+
+def _greedy_match(score, threshold, higher_is_better=True):
+    """
+    スコア行列から良い順に1対1で対応付ける。閾値を満たさない組は対応付けない。
+    (行番号, 列番号)のリストを返す
+    """
+    pairs = []
+    if score.size == 0:
+        return pairs
+
+    order = np.argsort(-score if higher_is_better else score, axis=None)
+    rows, cols = np.unravel_index(order, score.shape)
+    used_rows, used_cols = set(), set()
+    for r, c in zip(rows.tolist(), cols.tolist()):
+        s = score[r, c]
+        if (higher_is_better and s < threshold) or (
+            not higher_is_better and s > threshold
+        ):
+            break
+        if r in used_rows or c in used_cols:
+            continue
+        used_rows.add(r)
+        used_cols.add(c)
+        pairs.append((r, c))
+    return pairs
+
+
+class FaceTracker:
+    """
+    IoUと中心点距離による軽量な顔トラッカー。
+    update()に毎フレームの顔のボックスを渡すと、各ボックスの追跡IDを返す。
+    IoUで対応付けられなかった顔は、ボックスの大きさで正規化した中心点距離で対応付ける。
+    max_missedフレーム続けて見つからなかった追跡は破棄する。
+    """
+
+    def __init__(
+        self,
+        iou_threshold: float = 0.3,
+        max_centroid_distance: float = 0.5,
+        max_missed: int = 5,
+    ):
+        self.iou_threshold = iou_threshold
+        self.max_centroid_distance = max_centroid_distance
+        self.max_missed = max_missed
+
+        self._boxes = np.zeros((0, 4), dtype=np.float64)
+        self._ids = np.zeros(0, dtype=np.int64)
+        self._missed = np.zeros(0, dtype=np.int64)
+        self._next_id = 1
+        self._lock = threading.Lock()
+
+    def update(self, boxes) -> list:
+        """
+        入力:
+          - boxes: (顔の数, 4)の[x1, y1, x2, y2]
+        出力:
+          各ボックスの追跡IDのリスト
+        """
+        boxes = np.asarray(boxes, dtype=np.float64).reshape(-1, 4)
+
+        with self._lock:
+            ids = np.zeros(len(boxes), dtype=np.int64)
+            matched_tracks = np.zeros(len(self._boxes), dtype=bool)
+            matched_boxes = np.zeros(len(boxes), dtype=bool)
+
+            # IoUで対応付け
+            for t, d in _greedy_match(
+                _iou_matrix(self._boxes, boxes), self.iou_threshold
+            ):
+                ids[d] = self._ids[t]
+                matched_tracks[t] = matched_boxes[d] = True
+
+            # 残りを中心点距離で対応付け (高速に動いた顔向け)
+            rest_t = np.flatnonzero(~matched_tracks)
+            rest_d = np.flatnonzero(~matched_boxes)
+            if len(rest_t) and len(rest_d):
+                tb, db = self._boxes[rest_t], boxes[rest_d]
+                tc = (tb[:, :2] + tb[:, 2:]) / 2.0
+                dc = (db[:, :2] + db[:, 2:]) / 2.0
+                size = np.hypot(tb[:, 2] - tb[:, 0], tb[:, 3] - tb[:, 1])
+                dist = np.linalg.norm(tc[:, None, :] - dc[None, :, :], axis=-1)
+                dist /= np.maximum(size, 1e-6)[:, None]
+                for i, j in _greedy_match(
+                    dist, self.max_centroid_distance, higher_is_better=False
+                ):
+                    t, d = rest_t[i], rest_d[j]
+                    ids[d] = self._ids[t]
+                    matched_tracks[t] = matched_boxes[d] = True
+
+            # 対応付いた追跡を更新、見つからなかった追跡は見逃し回数を加算
+            self._missed[matched_tracks] = 0
+            self._missed[~matched_tracks] += 1
+            track_index = {tid: i for i, tid in enumerate(self._ids.tolist())}
+            for d in np.flatnonzero(matched_boxes):
+                self._boxes[track_index[int(ids[d])]] = boxes[d]
+
+            # 新しい顔に追跡IDを発行
+            new = np.flatnonzero(~matched_boxes)
+            new_ids = np.arange(self._next_id, self._next_id + len(new))
+            self._next_id += len(new)
+            ids[new] = new_ids
+
+            keep = self._missed <= self.max_missed
+            self._boxes = np.concatenate([self._boxes[keep], boxes[new]])
+            self._ids = np.concatenate([self._ids[keep], new_ids])
+            self._missed = np.concatenate(
+                [self._missed[keep], np.zeros(len(new), dtype=np.int64)]
+            )
+
+            return ids.tolist()
+
+    def reset(self):
+        with self._lock:
+            self._boxes = np.zeros((0, 4), dtype=np.float64)
+            self._ids = np.zeros(0, dtype=np.int64)
+            self._missed = np.zeros(0, dtype=np.int64)
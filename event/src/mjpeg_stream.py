@@ -0,0 +1,62 @@
+import httpx
+from typing import AsyncIterator, Optional, Tuple
+
+"""
+MJPEG配信(multipart/x-mixed-replace)の読み込み
+カメラサーバーの/videoを1本の接続で購読し、届いたJPEGを順に取り出す
+"""
+
+
+def _parse_part_headers(raw: bytes) -> dict:
+    headers = {}
+    for line in raw.split(b"\r\n"):
+        name, sep, value = line.partition(b":")
+        if sep:
+            headers[name.strip().lower().decode()] = value.strip().decode()
+    return headers
+
+
+async def iter_mjpeg(
+    client: httpx.AsyncClient, url: str, params: Optional[dict] = None
+) -> AsyncIterator[Tuple[Optional[int], bytes]]:
+    """
+    MJPEG配信を購読し、(フレーム連番, JPEGのバイト列)を順に返す。
+    フレーム連番はパートヘッダのX-Frame-Seqで、無ければNone。
+    Content-Lengthがあればそれで切り出し、無ければ次の区切りまでをJPEGとみなす。
+    接続が切れた場合は例外を送出する。
+    """
+    async with client.stream("GET", url, params=params, timeout=None) as resp:
+        resp.raise_for_status()
+
+        content_type = resp.headers.get("content-type", "")
+        boundary = b"--" + content_type.partition("boundary=")[2].encode()
+        if boundary == b"--":
+            raise RuntimeError("MJPEG配信ではありません")
+
+        buf = bytearray()
+        async for data in resp.aiter_bytes():
+            buf += data
+            while True:
+                start = buf.find(boundary)
+                if start < 0:
+                    break
+                header_end = buf.find(b"\r\n\r\n", start)
+                if header_end < 0:
+                    break
+                headers = _parse_part_headers(bytes(buf[start:header_end]))
+                body_start = header_end + 4
+
+                if "content-length" in headers:
+                    body_end = body_start + int(headers["content-length"])
+                    if len(buf) < body_end:
+                        break
+                    jpeg = bytes(buf[body_start:body_end])
+                else:
+                    body_end = buf.find(boundary, body_start)
+                    if body_end < 0:
+                        break
+                    jpeg = bytes(buf[body_start:body_end]).rstrip(b"\r\n")
+                del buf[:body_end]
+
+                seq = headers.get("x-frame-seq")
+                yield (int(seq) if seq is not None else None), jpeg
@@ -110,8 +110,13 @@ elif mode == "動体検知":
             """
             st.components.v1.html(sound_html, height=0)
 
-            # スナップショットとタイムスタンプを表示
-            url = f"{CAMERA_SERVER_URL}/snapshot?mode=mesh"
+            # 検知したフレームとタイムスタンプを表示
+            # (イベントサーバーに保存された検知時のフレーム。無ければ現在のスナップショット)
+            event_id = event.get("motion_event_id")
+            if event_id is not None:
+                url = f"{EVENT_SERVER_URL}/events/{event_id}/image"
+            else:
+                url = f"{CAMERA_SERVER_URL}/snapshot?mode=mesh"
             response = requests.get(url)
 
             if response.status_code == 200: